@@ -25,6 +25,7 @@ from structlog import configure, make_filtering_bound_logger
 from structlog import get_logger as get_structlogger
 
 from depositduck import BASE_DIR
+from depositduck.llm.drallam import build_drallam_client
 from depositduck.models.sql.auth import User
 from depositduck.settings import Settings
 
@@ -180,10 +181,21 @@ async def db_session_factory() -> async_sessionmaker:
     return async_sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
 
 
-# @cache
 async def get_drallam_client(
+    request: Request,
     settings: Annotated[Settings, Depends(get_settings)],
 ) -> AYieldFixture[httpx.AsyncClient]:
-    # create a new client for each request and close it once it is done
-    async with httpx.AsyncClient(base_url=settings.drallam_origin) as client:
+    """
+    Yield the pooled client created by the app lifespan (see `main.get_lifespan`).
+    The lifespan state is shared with mounted apps, so this works from `llmapp` too.
+    """
+    drallam_client: httpx.AsyncClient | None = getattr(
+        request.state, "drallam_client", None
+    )
+    if drallam_client is not None:
+        yield drallam_client
+        return
+
+    # outside of the app lifespan (eg. in tests) create a client for this request only
+    async with build_drallam_client(settings) as client:
         yield client
@@ -0,0 +1,242 @@
+"""
+Embed every Snippet that is missing an embedding from a model, eg. after registering a
+new model or loading many SourceTexts without embedding them.
+
+Usage: `python -m depositduck.llm.backfill [--model TAG] [--restart]`
+Queues an `EMBEDDINGS_BACKFILL` job, like `POST /llm/embeddings/backfill`, which a
+worker runs with `run_backfill`; see `depositduck.llm.worker`. Follow it at
+`GET /llm/jobs/{id}`. While a backfill of a model is queued or running, queueing
+another returns that job instead, as both would move the model's checkpoint.
+
+Snippets are walked in id order a page at a time, each page starting after the last id
+of the one before (keyset pagination), so every page is found through the primary key
+however far the backfill has got. Near-duplicates are skipped, as their embedding is
+the one of the Snippet they duplicate.
+
+Each page is embedded like a SourceText, committing embeddings in batches as they
+arrive, then the checkpoint in `llm__backfill_checkpoint` is moved past it. A backfill
+that is interrupted, eg. because its worker stopped, is queued again and resumes from
+the last page it finished. A page of which nothing could be embedded, eg. because
+draLLaM is down, fails the job without moving the checkpoint, and the job's retry
+resumes from it.
+
+To leave draLLaM and the database to live searches, at most `BACKFILL_CONCURRENCY`
+embedding requests are in flight and each request waits for a token bucket that lets
+through no more than `BACKFILL_MAX_RATE` Snippets per second.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+import argparse
+import asyncio
+from uuid import UUID
+
+import httpx
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from depositduck.dependables import db_session_factory as get_db_session_factory
+from depositduck.dependables import get_logger, get_settings
+from depositduck.llm.embeddings import EmbeddingError
+from depositduck.llm.ingestion import OnProgress, SnippetToEmbed, embed_snippets
+from depositduck.llm.jobs import enqueue_job
+from depositduck.llm.registry import embeddings_of
+from depositduck.llm.resilience import TokenBucket
+from depositduck.models.dto.llm import EmbeddingsCreated
+from depositduck.models.llm import EmbeddingModel, JobKind, get_embedding_model
+from depositduck.models.sql.llm import BackfillCheckpoint, Snippet
+from depositduck.settings import Settings
+
+LOG = get_logger()
+
+
+async def start_pass(
+    session: AsyncSession, model: EmbeddingModel, restart: bool = False
+) -> BackfillCheckpoint:
+    """
+    The checkpoint to resume the backfill for `model` from. A new pass starts from the
+    first Snippet if asked to `restart` or the previous pass completed, eg. to catch up
+    on Snippets added since or retry those that failed.
+    """
+    await session.execute(
+        insert(BackfillCheckpoint)
+        .values(llm_name=model.tag)
+        .on_conflict_do_nothing(index_elements=["llm_name"])
+    )
+    is_model = BackfillCheckpoint.llm_name == model.tag
+    new_pass = update(BackfillCheckpoint).where(is_model)  # type: ignore[arg-type]
+    if not restart:
+        new_pass = new_pass.where(BackfillCheckpoint.completed_at.is_not(None))  # type: ignore[union-attr]
+    await session.execute(
+        new_pass.values(
+            last_snippet_id=None,
+            visited_count=0,
+            created_count=0,
+            reused_count=0,
+            near_duplicate_count=0,
+            failed_count=0,
+            created_at=func.now(),
+            updated_at=func.now(),
+            completed_at=None,
+        )
+    )
+    result = await session.execute(select(BackfillCheckpoint).where(is_model))  # type: ignore[arg-type]
+    return result.scalar_one()
+
+
+async def find_page(
+    session: AsyncSession, model: EmbeddingModel, after: UUID | None, limit: int
+) -> list[SnippetToEmbed]:
+    """
+    The first `limit` Snippets with an id greater than `after` that need an embedding
+    from `model`, in id order.
+    """
+    embeddings = embeddings_of(model)
+    statement = (
+        select(Snippet.id, Snippet.source_text_id, Snippet.content, Snippet.content_hash)
+        .outerjoin(embeddings, embeddings.c.snippet_id == Snippet.id)
+        .where(
+            embeddings.c.id.is_(None),
+            Snippet.near_duplicate_of_id.is_(None),  # type: ignore[union-attr]
+        )
+        .order_by(Snippet.id)
+        .limit(limit)
+    )
+    if after is not None:
+        statement = statement.where(Snippet.id > after)  # type: ignore[operator]
+    result = await session.execute(statement)
+    return [SnippetToEmbed(*row) for row in result.all()]
+
+
+async def save_checkpoint(
+    session: AsyncSession,
+    model: EmbeddingModel,
+    last_snippet_id: UUID,
+    visited_count: int,
+    created: EmbeddingsCreated,
+) -> None:
+    await session.execute(
+        update(BackfillCheckpoint)
+        .where(BackfillCheckpoint.llm_name == model.tag)  # type: ignore[arg-type]
+        .values(
+            last_snippet_id=last_snippet_id,
+            visited_count=BackfillCheckpoint.visited_count + visited_count,
+            created_count=BackfillCheckpoint.created_count + created.created_count,
+            reused_count=BackfillCheckpoint.reused_count + created.reused_count,
+            near_duplicate_count=(
+                BackfillCheckpoint.near_duplicate_count + created.near_duplicate_count
+            ),
+            failed_count=BackfillCheckpoint.failed_count + created.failed_count,
+            updated_at=func.now(),
+        )
+    )
+
+
+async def complete_pass(session: AsyncSession, model: EmbeddingModel) -> None:
+    await session.execute(
+        update(BackfillCheckpoint)
+        .where(BackfillCheckpoint.llm_name == model.tag)  # type: ignore[arg-type]
+        .values(completed_at=func.now(), updated_at=func.now())
+    )
+
+
+async def run_backfill(
+    settings: Settings,
+    db_session_factory: async_sessionmaker,
+    drallam_client: httpx.AsyncClient,
+    model: EmbeddingModel,
+    restart: bool = False,
+    stopping: asyncio.Event | None = None,
+    on_progress: OnProgress | None = None,
+) -> tuple[EmbeddingsCreated, bool]:
+    """
+    Embed Snippets missing an embedding from `model`, from the checkpoint onwards,
+    until there are none left or `stopping` is set. `on_progress` is called after each
+    page with the number of Snippets visited by this run.
+
+    Returns what was embedded by this run and whether the pass completed.
+    Raises `EmbeddingError` if no Snippets of a page could be embedded.
+    """
+    settings = settings.model_copy(
+        update={"drallam_embeddings_concurrency": settings.backfill_concurrency}
+    )
+    rate_limit = TokenBucket(settings.backfill_max_rate)
+    session: AsyncSession
+    async with db_session_factory.begin() as session:
+        checkpoint = await start_pass(session, model, restart)
+    last_snippet_id = checkpoint.last_snippet_id
+    LOG.info(f"backfill {model.tag} starting after Snippet [id={last_snippet_id}]")
+
+    total = EmbeddingsCreated(created_count=0)
+    visited_count = 0
+    while stopping is None or not stopping.is_set():
+        async with db_session_factory.begin() as session:
+            snippets = await find_page(
+                session, model, last_snippet_id, settings.backfill_page_size
+            )
+        if not snippets:
+            async with db_session_factory.begin() as session:
+                await complete_pass(session, model)
+            LOG.info(f"backfill {model.tag} complete")
+            return total, True
+
+        created = await embed_snippets(
+            settings,
+            db_session_factory,
+            drallam_client,
+            snippets,
+            model,
+            rate_limit=rate_limit,
+        )
+        if created.failed_count and created.created_count == created.reused_count:
+            raise EmbeddingError(
+                f"could not generate embeddings for any of {len(snippets)} Snippets "
+                f"after Snippet [id={last_snippet_id}]"
+            )
+        last_snippet_id = snippets[-1].id
+        async with db_session_factory.begin() as session:
+            await save_checkpoint(session, model, last_snippet_id, len(snippets), created)
+        total.created_count += created.created_count
+        total.reused_count += created.reused_count
+        total.failed_count += created.failed_count
+        total.near_duplicate_count += created.near_duplicate_count
+        visited_count += len(snippets)
+        LOG.info(
+            f"backfill {model.tag} embedded {created.created_count} of {len(snippets)} "
+            f"Snippets up to [id={last_snippet_id}], {created.failed_count} failed"
+        )
+        if on_progress:
+            await on_progress(visited_count, None)
+    return total, False
+
+
+async def main(llm_name: str | None, restart: bool) -> None:
+    settings = get_settings()
+    model = get_embedding_model(llm_name or settings.drallam_embeddings_model)
+    payload: dict = {"llm_name": model.tag}
+    if restart:
+        payload["restart"] = True
+    db_session_factory = await get_db_session_factory()
+    session: AsyncSession
+    async with db_session_factory.begin() as session:
+        job = await enqueue_job(session, settings, JobKind.EMBEDDINGS_BACKFILL, payload)
+    LOG.info(f"backfill {model.tag} is job [id={job.id}], status {job.status}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Queue a job to embed every Snippet missing an embedding."
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        help="tag of a registered embedding model, defaults to DRALLAM_EMBEDDINGS_MODEL",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="start from the first Snippet instead of resuming from the checkpoint",
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.model, args.restart))
@@ -0,0 +1,138 @@
+"""
+Bulk writes of Snippets and embeddings.
+
+An executemany INSERT binds every value of every row as a separate parameter, which
+dominates the cost of saving thousands of 768-float vectors. With `BulkWriteMethod.COPY`
+rows are instead encoded straight into Postgres' binary COPY format and streamed by
+asyncpg into a temporary staging table, then moved into their table by a single
+`INSERT ... SELECT` that keeps the `ON CONFLICT DO NOTHING` behaviour of the INSERT.
+
+Rows are encoded here rather than by asyncpg's `copy_records_to_table`, which would need
+a binary codec for `vector` registered on each connection. That codec would then clash
+with the text-format vectors SQLAlchemy binds in every other query.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+import struct
+from typing import Any, Callable, Iterable, Sequence, cast
+from uuid import UUID, uuid4
+
+import asyncpg
+import sqlalchemy as sa
+from pgvector.sqlalchemy import Vector
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from depositduck.models.llm import BulkWriteMethod
+from depositduck.settings import Settings
+
+Encoder = Callable[[Any], bytes]
+
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+NULL_FIELD = struct.pack(">i", -1)
+
+
+def encode_uuid(value: UUID) -> bytes:
+    return value.bytes
+
+
+def encode_text(value: str) -> bytes:
+    return value.encode()
+
+
+def encode_vector(value: Sequence[float]) -> bytes:
+    """
+    pgvector's binary format: dimensions & an unused uint16, then big-endian float4s.
+    """
+    return struct.pack(f">HH{len(value)}f", len(value), 0, *value)
+
+
+def column_encoder(column: sa.Column) -> Encoder:
+    column_type = column.type
+    if isinstance(column_type, sa.TypeDecorator):
+        column_type = column_type.impl_instance
+    if isinstance(column_type, Vector):
+        return encode_vector
+    if isinstance(column_type, sa.Uuid):
+        return encode_uuid
+    if isinstance(column_type, sa.String):
+        return encode_text
+    raise TypeError(f"cannot COPY column '{column.name}' of type {column.type}")
+
+
+def encode_copy_binary(
+    rows: Iterable[Sequence[Any]], encoders: Sequence[Encoder]
+) -> bytes:
+    """
+    Encode `rows` as the payload of a `COPY ... FROM STDIN (FORMAT binary)`.
+    """
+    field_count = struct.pack(">h", len(encoders))
+    parts = [PGCOPY_HEADER]
+    for row in rows:
+        parts.append(field_count)
+        for encode, value in zip(encoders, row, strict=True):
+            if value is None:
+                parts.append(NULL_FIELD)
+                continue
+            data = encode(value)
+            parts.append(struct.pack(">i", len(data)))
+            parts.append(data)
+    parts.append(PGCOPY_TRAILER)
+    return b"".join(parts)
+
+
+async def copy_rows(
+    session: AsyncSession, table: sa.Table, rows: list[dict[str, Any]]
+) -> list[UUID]:
+    """
+    Insert `rows`, which must all have the same keys, using binary COPY within the
+    session's transaction. Rows that conflict with existing ones are skipped.
+
+    Returns the ids of the rows inserted.
+    """
+    columns = list(rows[0])
+    encoders = [column_encoder(table.c[name]) for name in columns]
+    payload = encode_copy_binary(
+        ([row[name] for name in columns] for row in rows), encoders
+    )
+
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    driver_connection = cast(asyncpg.Connection, raw_connection.driver_connection)
+    column_list = ", ".join(columns)
+    staging = f"staging_{uuid4().hex}"
+    await driver_connection.execute(
+        f"CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS "
+        f"SELECT {column_list} FROM {table.name} WITH NO DATA"
+    )
+    await driver_connection.copy_to_table(
+        staging, source=payload, columns=columns, format="binary"
+    )
+    inserted = await driver_connection.fetch(
+        f"INSERT INTO {table.name} ({column_list}) "
+        f"SELECT {column_list} FROM {staging} ON CONFLICT DO NOTHING RETURNING id"
+    )
+    await driver_connection.execute(f"DROP TABLE {staging}")
+    return [record["id"] for record in inserted]
+
+
+async def write_rows(
+    settings: Settings,
+    session: AsyncSession,
+    table: sa.Table,
+    rows: list[dict[str, Any]],
+) -> list[UUID]:
+    """
+    Insert `rows` using `ingestion_bulk_write_method`, skipping rows that conflict with
+    existing ones. Returns the ids of the rows inserted.
+    """
+    if not rows:
+        return []
+    if settings.ingestion_bulk_write_method == BulkWriteMethod.COPY:
+        return await copy_rows(session, table, rows)
+    result = await session.execute(
+        insert(table).on_conflict_do_nothing().returning(table.c.id), rows
+    )
+    return list(result.scalars().all())
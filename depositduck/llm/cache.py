@@ -0,0 +1,365 @@
+"""
+Bounded caches for the llm app, evicting entries by least-recent use and by age.
+
+Query embeddings are cached so that repeated user queries skip the embedding model.
+Keys combine the embedding model name with the normalised query text, so switching
+models never serves a stale vector.
+
+Search results are cached against the corpus generation, a counter bumped by every
+transaction that writes Snippets or embeddings. Entries found at an older generation
+are never served, so cached results are as fresh as a search would be.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+import hashlib
+import json
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import timedelta
+
+from pydantic import BaseModel, computed_field
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.sql import func
+
+from depositduck.models.dto.llm import RelevantSnippet
+from depositduck.models.llm import CacheBackend
+from depositduck.models.sql.llm import QueryEmbeddingCacheEntry, SearchResultCacheEntry
+from depositduck.settings import Settings
+
+# settings that change which Snippets a search returns or how they are ranked
+SEARCH_SETTINGS = {
+    "search_vector_weight",
+    "search_text_weight",
+    "search_rrf_k",
+    "search_candidates",
+    "search_mmr_pool",
+    "vector_distance",
+    "vector_index_type",
+    "vector_hnsw_ef_search",
+    "vector_ivfflat_probes",
+    "vector_quantisation",
+    "vector_rerank_candidates",
+}
+
+
+class CacheStats(BaseModel):
+    backend: CacheBackend
+    max_entries: int
+    ttl_seconds: int
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @computed_field  # type: ignore[misc]
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def normalise_query(query: str) -> str:
+    """
+    Collapse whitespace and ignore case so trivially different queries share an entry.
+    """
+    return " ".join(query.split()).casefold()
+
+
+def query_embedding_key(llm_name: str, query: str) -> str:
+    key_source = f"{llm_name}\n{normalise_query(query)}"
+    return hashlib.sha256(key_source.encode()).hexdigest()
+
+
+class QueryEmbeddingCache(ABC):
+    backend: CacheBackend
+
+    def __init__(self, max_entries: int, ttl_seconds: int) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = CacheStats(
+            backend=self.backend, max_entries=max_entries, ttl_seconds=ttl_seconds
+        )
+
+    async def get(self, llm_name: str, query: str) -> list[float] | None:
+        embedding = await self._get(query_embedding_key(llm_name, query))
+        if embedding is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return embedding
+
+    async def set(self, llm_name: str, query: str, embedding: list[float]) -> None:
+        await self._set(query_embedding_key(llm_name, query), llm_name, embedding)
+
+    @abstractmethod
+    async def _get(self, key: str) -> list[float] | None:
+        pass
+
+    @abstractmethod
+    async def _set(self, key: str, llm_name: str, embedding: list[float]) -> None:
+        pass
+
+
+class InProcessQueryEmbeddingCache(QueryEmbeddingCache):
+    backend = CacheBackend.MEMORY
+
+    def __init__(self, max_entries: int, ttl_seconds: int) -> None:
+        super().__init__(max_entries, ttl_seconds)
+        # key -> (expires_at, embedding), least recently used first
+        self._entries: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def _get(self, key: str) -> list[float] | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, embedding = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.stats.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return embedding
+
+    async def _set(self, key: str, llm_name: str, embedding: list[float]) -> None:
+        self._entries[key] = (time.time() + self.ttl_seconds, embedding)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+
+class PostgresQueryEmbeddingCache(QueryEmbeddingCache):
+    """
+    Shared by every app process via the `llm__query_embedding_cache` table.
+    Hit and miss counters are kept per process.
+    """
+
+    backend = CacheBackend.POSTGRES
+
+    def __init__(
+        self, db_session_factory: async_sessionmaker, max_entries: int, ttl_seconds: int
+    ) -> None:
+        super().__init__(max_entries, ttl_seconds)
+        self.db_session_factory = db_session_factory
+
+    def _is_fresh(self):
+        max_age = timedelta(seconds=self.ttl_seconds)
+        return QueryEmbeddingCacheEntry.created_at > func.now() - max_age  # type: ignore[operator]
+
+    async def _get(self, key: str) -> list[float] | None:
+        session: AsyncSession
+        async with self.db_session_factory.begin() as session:
+            # touch the entry in the same statement that reads it to track recency
+            result = await session.execute(
+                update(QueryEmbeddingCacheEntry)
+                .where(QueryEmbeddingCacheEntry.key == key, self._is_fresh())  # type: ignore[arg-type]
+                .values(last_used_at=func.now())
+                .returning(QueryEmbeddingCacheEntry.vector)  # type: ignore[arg-type]
+            )
+            vector = result.scalar_one_or_none()
+        return None if vector is None else vector.tolist()
+
+    async def _set(self, key: str, llm_name: str, embedding: list[float]) -> None:
+        entry_table = QueryEmbeddingCacheEntry.__table__  # type: ignore[attr-defined]
+        upsert = insert(entry_table).values(key=key, llm_name=llm_name, vector=embedding)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[entry_table.c.key],
+            set_=dict(
+                vector=upsert.excluded.vector,
+                created_at=func.now(),
+                last_used_at=func.now(),
+            ),
+        )
+        most_recent = (
+            select(QueryEmbeddingCacheEntry.key)
+            .order_by(QueryEmbeddingCacheEntry.last_used_at.desc())  # type: ignore[attr-defined]
+            .limit(self.max_entries)
+        )
+
+        session: AsyncSession
+        async with self.db_session_factory.begin() as session:
+            await session.execute(upsert)
+            evicted = await session.execute(
+                delete(QueryEmbeddingCacheEntry).where(
+                    ~self._is_fresh() | QueryEmbeddingCacheEntry.key.not_in(most_recent)  # type: ignore[attr-defined]
+                )
+            )
+        self.stats.evictions += evicted.rowcount
+
+
+def search_result_key(
+    settings: Settings,
+    llm_name: str,
+    query: str,
+    max_snippets: int,
+    rerank_candidates: int | None = None,
+    filters: dict | None = None,
+    mmr_lambda: float | None = None,
+    mmr_pool: int | None = None,
+) -> str:
+    """
+    The query embedding is identified by its own cache key rather than hashing its
+    vector, so a hit skips embedding the query as well as searching.
+    """
+    key_source = json.dumps(
+        [
+            query_embedding_key(llm_name, query),
+            max_snippets,
+            rerank_candidates,
+            filters or {},
+            mmr_lambda,
+            mmr_pool,
+            settings.model_dump(mode="json", include=SEARCH_SETTINGS),
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(key_source.encode()).hexdigest()
+
+
+class SearchResultCache(ABC):
+    backend: CacheBackend
+
+    def __init__(self, max_entries: int, ttl_seconds: int) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = CacheStats(
+            backend=self.backend, max_entries=max_entries, ttl_seconds=ttl_seconds
+        )
+
+    async def get(self, key: str, generation: int) -> list[RelevantSnippet] | None:
+        results = await self._get(key, generation)
+        if results is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return [RelevantSnippet.model_validate(result) for result in results]
+
+    async def set(
+        self, key: str, generation: int, snippets: list[RelevantSnippet]
+    ) -> None:
+        """
+        `generation` must have been read before searching, so that the results are at
+        least as recent as it.
+        """
+        results = [snippet.model_dump(mode="json") for snippet in snippets]
+        await self._set(key, generation, results)
+
+    @abstractmethod
+    async def _get(self, key: str, generation: int) -> list[dict] | None:
+        pass
+
+    @abstractmethod
+    async def _set(self, key: str, generation: int, results: list[dict]) -> None:
+        pass
+
+
+class InProcessSearchResultCache(SearchResultCache):
+    backend = CacheBackend.MEMORY
+
+    def __init__(self, max_entries: int, ttl_seconds: int) -> None:
+        super().__init__(max_entries, ttl_seconds)
+        # key -> (expires_at, generation, results), least recently used first
+        self._entries: OrderedDict[str, tuple[float, int, list[dict]]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def _get(self, key: str, generation: int) -> list[dict] | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, entry_generation, results = entry
+        if expires_at <= time.time() or entry_generation < generation:
+            del self._entries[key]
+            self.stats.evictions += 1
+            return None
+        if entry_generation > generation:
+            # found by a newer search than this one's, leave it for later requests
+            return None
+        self._entries.move_to_end(key)
+        return results
+
+    async def _set(self, key: str, generation: int, results: list[dict]) -> None:
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > generation:
+            return
+        self._entries[key] = (time.time() + self.ttl_seconds, generation, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+
+class PostgresSearchResultCache(SearchResultCache):
+    """
+    Shared by every app process via the `llm__search_result_cache` table.
+    Hit and miss counters are kept per process.
+    """
+
+    backend = CacheBackend.POSTGRES
+
+    def __init__(
+        self, db_session_factory: async_sessionmaker, max_entries: int, ttl_seconds: int
+    ) -> None:
+        super().__init__(max_entries, ttl_seconds)
+        self.db_session_factory = db_session_factory
+
+    def _is_fresh(self):
+        max_age = timedelta(seconds=self.ttl_seconds)
+        return SearchResultCacheEntry.created_at > func.now() - max_age  # type: ignore[operator]
+
+    async def _get(self, key: str, generation: int) -> list[dict] | None:
+        session: AsyncSession
+        async with self.db_session_factory.begin() as session:
+            result = await session.execute(
+                update(SearchResultCacheEntry)
+                .where(
+                    SearchResultCacheEntry.key == key,  # type: ignore[arg-type]
+                    SearchResultCacheEntry.generation == generation,  # type: ignore[arg-type]
+                    self._is_fresh(),
+                )
+                .values(last_used_at=func.now())
+                .returning(SearchResultCacheEntry.results)  # type: ignore[arg-type]
+            )
+            return result.scalar_one_or_none()
+
+    async def _set(self, key: str, generation: int, results: list[dict]) -> None:
+        entry_table = SearchResultCacheEntry.__table__  # type: ignore[attr-defined]
+        upsert = insert(entry_table).values(
+            key=key, generation=generation, results=results
+        )
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[entry_table.c.key],
+            set_=dict(
+                generation=upsert.excluded.generation,
+                results=upsert.excluded.results,
+                created_at=func.now(),
+                last_used_at=func.now(),
+            ),
+            # never replace results found at a newer generation
+            where=entry_table.c.generation <= upsert.excluded.generation,
+        )
+        most_recent = (
+            select(SearchResultCacheEntry.key)
+            .order_by(SearchResultCacheEntry.last_used_at.desc())  # type: ignore[attr-defined]
+            .limit(self.max_entries)
+        )
+
+        session: AsyncSession
+        async with self.db_session_factory.begin() as session:
+            await session.execute(upsert)
+            evicted = await session.execute(
+                delete(SearchResultCacheEntry).where(
+                    ~self._is_fresh()
+                    | (SearchResultCacheEntry.generation < generation)  # type: ignore[operator]
+                    | SearchResultCacheEntry.key.not_in(most_recent)  # type: ignore[attr-defined]
+                )
+            )
+        self.stats.evictions += evicted.rowcount
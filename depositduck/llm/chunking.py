@@ -0,0 +1,329 @@
+"""
+Split SourceText content into Snippets.
+
+Chunkers consume text incrementally and yield chunks as soon as they are complete, so
+they can stream over documents of any size without materialising every paragraph.
+
+- `ParagraphChunker`: one chunk per paragraph, ie. text between blank lines.
+- `TokenChunker`: packs sentences into chunks close to a target size in tokens, never
+  above a maximum, overlapping consecutive chunks by a few sentences.
+
+Token counts are estimated by counting words and punctuation, which tracks the
+WordPiece tokens used by nomic-embed-text closely enough for sizing chunks.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+import re
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import AsyncIterable, AsyncIterator, Callable, Iterable, Iterator, NamedTuple
+
+from depositduck.models.llm import ChunkerName
+from depositduck.settings import Settings
+
+PARAGRAPH_BREAK = re.compile(r"\n{2,}")
+# a paragraph longer than this is split, so a document without blank lines is never
+# held in memory whole
+MAX_PARAGRAPH_CHARACTERS = 16_384
+# end of a sentence: terminal punctuation followed by whitespace and an uppercase
+# letter, digit, quote or bracket. Avoids splitting on eg. "s.213" or "0.5".
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])[\"')\]]*\s+(?=[A-Z0-9\"'(\[])")
+TOKEN = re.compile(r"\w+|[^\w\s]")
+# a `TokenChunker` allows paragraphs of up to 16 of its largest chunks, at ~4 characters
+# a token, so splitting them rarely changes its chunks
+CHARACTERS_PER_PARAGRAPH_TOKEN = 16 * 4
+
+TokenCounter = Callable[[str], int]
+
+
+def estimate_tokens(text: str) -> int:
+    return len(TOKEN.findall(text))
+
+
+class ParagraphSplitter:
+    """
+    Incrementally splits text on two or more consecutive newlines.
+
+    Only newly received text is searched for a break, and a paragraph that grows past
+    `max_characters` is split at its last line break or space before the limit, so
+    the work and memory per character received stay constant however long the
+    paragraphs are.
+    """
+
+    def __init__(self, max_characters: int = MAX_PARAGRAPH_CHARACTERS) -> None:
+        if max_characters <= 0:
+            raise ValueError("paragraphs must be allowed at least one character")
+        self.max_characters = max_characters
+        # text received since the last paragraph ended, joined only once it ends one
+        self.parts: list[str] = []
+        self.length = 0
+
+    def _cut(self, text: str, start: int) -> int:
+        limit = start + self.max_characters
+        for separator in ("\n", " "):
+            if (cut := text.rfind(separator, start + 1, limit)) != -1:
+                return cut + 1
+        return limit
+
+    def _split(self, text: str, start: int, end: int) -> Iterator[str]:
+        while end - start > self.max_characters:
+            cut = self._cut(text, start)
+            yield text[start:cut]
+            start = cut
+        yield text[start:end]
+
+    def add(self, text: str) -> list[str]:
+        """Add the next text, returning the stripped, non-empty paragraphs it ends."""
+        if not text:
+            return []
+        # a newline ending the text before may start a break completed by this text
+        after_newline = bool(self.parts) and self.parts[-1].endswith("\n")
+        search_from = self.length - 1 if after_newline else self.length
+        self.parts.append(text)
+        self.length += len(text)
+        if self.length <= self.max_characters and not PARAGRAPH_BREAK.search(
+            "\n" + text if after_newline else text
+        ):
+            return []
+
+        pending = "".join(self.parts)
+        paragraphs: list[str] = []
+        start = 0
+        for match in PARAGRAPH_BREAK.finditer(pending, search_from):
+            paragraphs.extend(self._split(pending, start, match.start()))
+            start = match.end()
+        *complete, rest = self._split(pending, start, len(pending))
+        paragraphs.extend(complete)
+        self.parts, self.length = ([rest], len(rest)) if rest else ([], 0)
+        return [paragraph for p in paragraphs if (paragraph := p.strip())]
+
+    def finish(self) -> list[str]:
+        """Return the last paragraph once the text has ended."""
+        paragraph = "".join(self.parts).strip()
+        self.parts, self.length = [], 0
+        return [paragraph] if paragraph else []
+
+
+def split_paragraphs(
+    text_chunks: Iterable[str], max_characters: int = MAX_PARAGRAPH_CHARACTERS
+) -> Iterator[str]:
+    """
+    Split text on two or more consecutive newlines, yielding each stripped, non-empty
+    paragraph as soon as the break that ends it has been received. Paragraphs longer
+    than `max_characters` are split, see `ParagraphSplitter`.
+    """
+    splitter = ParagraphSplitter(max_characters)
+    for text in text_chunks:
+        yield from splitter.add(text)
+    yield from splitter.finish()
+
+
+async def iter_paragraphs(
+    text_chunks: AsyncIterable[str], max_characters: int = MAX_PARAGRAPH_CHARACTERS
+) -> AsyncIterator[str]:
+    """
+    Asynchronous counterpart to `split_paragraphs`.
+    """
+    splitter = ParagraphSplitter(max_characters)
+    async for text in text_chunks:
+        for paragraph in splitter.add(text):
+            yield paragraph
+    for paragraph in splitter.finish():
+        yield paragraph
+
+
+class ChunkBuilder(ABC):
+    """
+    Incrementally turns the paragraphs of a single document into chunks.
+    """
+
+    @abstractmethod
+    def add(self, paragraph: str) -> list[str]:
+        """Add the next paragraph, returning any chunks it completes."""
+
+    @abstractmethod
+    def finish(self) -> list[str]:
+        """Return any remaining chunks once the document has ended."""
+
+
+class Chunker(ABC):
+    name: ChunkerName
+    max_paragraph_characters = MAX_PARAGRAPH_CHARACTERS
+
+    @abstractmethod
+    def builder(self) -> ChunkBuilder:
+        pass
+
+    def chunk(self, text_chunks: Iterable[str]) -> Iterator[str]:
+        builder = self.builder()
+        paragraphs = split_paragraphs(text_chunks, self.max_paragraph_characters)
+        for paragraph in paragraphs:
+            yield from builder.add(paragraph)
+        yield from builder.finish()
+
+    async def achunk(self, text_chunks: AsyncIterable[str]) -> AsyncIterator[str]:
+        builder = self.builder()
+        paragraphs = iter_paragraphs(text_chunks, self.max_paragraph_characters)
+        async for paragraph in paragraphs:
+            for chunk in builder.add(paragraph):
+                yield chunk
+        for chunk in builder.finish():
+            yield chunk
+
+
+class _ParagraphBuilder(ChunkBuilder):
+    def add(self, paragraph: str) -> list[str]:
+        return [paragraph]
+
+    def finish(self) -> list[str]:
+        return []
+
+
+class ParagraphChunker(Chunker):
+    name = ChunkerName.PARAGRAPH
+
+    def builder(self) -> ChunkBuilder:
+        return _ParagraphBuilder()
+
+
+class _Unit(NamedTuple):
+    """A sentence, or part of one too long to fit in a chunk."""
+
+    text: str
+    tokens: int
+    starts_paragraph: bool
+
+
+class _TokenBuilder(ChunkBuilder):
+    def __init__(self, chunker: "TokenChunker") -> None:
+        self.chunker = chunker
+        self.units: deque[_Unit] = deque()
+        self.tokens = 0
+        # units carried over from the previous chunk, never emitted on their own
+        self.overlap_units = 0
+
+    def _units(self, paragraph: str) -> Iterator[_Unit]:
+        count_tokens = self.chunker.count_tokens
+        starts_paragraph = True
+        for sentence in SENTENCE_BREAK.split(paragraph):
+            if not (sentence := sentence.strip()):
+                continue
+            tokens = count_tokens(sentence)
+            if tokens <= self.chunker.max_tokens:
+                yield _Unit(sentence, tokens, starts_paragraph)
+                starts_paragraph = False
+                continue
+            # hard split sentences that alone exceed the maximum, on word boundaries
+            words: list[str] = []
+            words_tokens = 0
+            for word in sentence.split():
+                word_tokens = count_tokens(word)
+                if words and words_tokens + word_tokens > self.chunker.max_tokens:
+                    yield _Unit(" ".join(words), words_tokens, starts_paragraph)
+                    starts_paragraph = False
+                    words, words_tokens = [], 0
+                words.append(word)
+                words_tokens += word_tokens
+            if words:
+                yield _Unit(" ".join(words), words_tokens, starts_paragraph)
+                starts_paragraph = False
+
+    def _fits(self, unit: _Unit) -> bool:
+        if not self.units:
+            return True
+        new_tokens = self.tokens + unit.tokens
+        if new_tokens <= self.chunker.target_tokens:
+            return True
+        # allow growing past the target, up to the maximum, rather than emit a fragment
+        return (
+            self.tokens < self.chunker.target_tokens // 2
+            and new_tokens <= self.chunker.max_tokens
+        )
+
+    def _emit(self) -> str:
+        parts = []
+        for i, unit in enumerate(self.units):
+            if i > 0:
+                parts.append("\n\n" if unit.starts_paragraph else " ")
+            parts.append(unit.text)
+        chunk = "".join(parts)
+
+        # carry the trailing sentences that fit in the overlap into the next chunk
+        overlap: deque[_Unit] = deque()
+        overlap_tokens = 0
+        for unit in reversed(self.units):
+            if overlap_tokens + unit.tokens > self.chunker.overlap_tokens:
+                break
+            overlap.appendleft(unit)
+            overlap_tokens += unit.tokens
+        if len(overlap) == len(self.units):
+            overlap.clear()
+            overlap_tokens = 0
+        self.units, self.tokens, self.overlap_units = (
+            overlap,
+            overlap_tokens,
+            len(overlap),
+        )
+        return chunk
+
+    def add(self, paragraph: str) -> list[str]:
+        chunks = []
+        for unit in self._units(paragraph):
+            while not self._fits(unit):
+                if len(self.units) == self.overlap_units:
+                    # the overlap leaves no room for this unit: drop the overlap
+                    self.units.clear()
+                    self.tokens = self.overlap_units = 0
+                    break
+                chunks.append(self._emit())
+            self.units.append(unit)
+            self.tokens += unit.tokens
+        return chunks
+
+    def finish(self) -> list[str]:
+        if len(self.units) > self.overlap_units:
+            return [self._emit()]
+        return []
+
+
+class TokenChunker(Chunker):
+    name = ChunkerName.TOKEN
+
+    def __init__(
+        self,
+        target_tokens: int,
+        max_tokens: int,
+        overlap_tokens: int = 0,
+        count_tokens: TokenCounter = estimate_tokens,
+    ) -> None:
+        if not 0 < target_tokens <= max_tokens:
+            raise ValueError("chunk target must be positive and no larger than maximum")
+        if not 0 <= overlap_tokens < target_tokens:
+            raise ValueError("chunk overlap must be smaller than the target size")
+        self.target_tokens = target_tokens
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.count_tokens = count_tokens
+        self.max_paragraph_characters = max(
+            MAX_PARAGRAPH_CHARACTERS, max_tokens * CHARACTERS_PER_PARAGRAPH_TOKEN
+        )
+
+    def builder(self) -> ChunkBuilder:
+        return _TokenBuilder(self)
+
+
+def get_chunker(settings: Settings, name: ChunkerName | None = None) -> Chunker:
+    """
+    The chunker chosen for a SourceText, falling back to `Settings.chunker`.
+    """
+    match name or settings.chunker:
+        case ChunkerName.PARAGRAPH:
+            return ParagraphChunker()
+        case ChunkerName.TOKEN:
+            return TokenChunker(
+                target_tokens=settings.chunker_target_tokens,
+                max_tokens=settings.chunker_max_tokens,
+                overlap_tokens=settings.chunker_overlap_tokens,
+            )
+    raise ValueError(f"unknown chunker [{name=}]")
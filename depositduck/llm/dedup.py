@@ -0,0 +1,273 @@
+"""
+Avoid embedding the same text more than once.
+
+Snippets carry a hash of their content, so an embedding generated for a paragraph in
+one SourceText can be reused for an identical paragraph in any other SourceText or
+in a later re-ingestion of the same one.
+
+Boilerplate repeated with small changes in wording is caught by SimHash: a 64-bit
+signature of a Snippet's words, where similar texts differ in few bits. A Snippet whose
+signature is within `Settings.ingestion_near_duplicate_distance` bits of an earlier
+embedded Snippet's from the same SourceText is a near-duplicate of it. It records which
+(`near_duplicate_of_id`) and is not embedded itself, so vector search finds the earlier
+Snippet instead. Off by default, as a few bits can be a changed number, eg. "14 days"
+for "30 days". Only looking within a SourceText keeps filtered searches from returning
+a Snippet of another SourceText in place of one that matches the filter.
+https://www.cs.princeton.edu/courses/archive/spring04/cos598B/bib/CharikarEstim.pdf
+
+Signatures are split into `SIMHASH_BANDS` bands, each indexed per SourceText. Signatures
+differing in fewer bits than there are bands must share a band, so looking up each band
+finds every candidate (locality-sensitive hashing, LSH).
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+import hashlib
+import re
+from collections import Counter, defaultdict
+from typing import Iterable
+from uuid import UUID
+
+import numpy as np
+from sqlalchemy import (
+    BigInteger,
+    ColumnElement,
+    and_,
+    column,
+    literal_column,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy import values as sa_values
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from depositduck.llm.registry import (
+    copied_embedding_columns,
+    embedding_table,
+    embeddings_of,
+)
+from depositduck.models.llm import SIMHASH_BANDS, EmbeddingModel
+from depositduck.models.sql.llm import Snippet
+
+SIMHASH_BITS = 64
+BAND_BITS = SIMHASH_BITS // SIMHASH_BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+WORD_PATTERN = re.compile(r"\w+")
+
+
+async def find_snippets_with_embedding_status(
+    session: AsyncSession, source_text_id: UUID, model: EmbeddingModel
+) -> list[tuple[Snippet, bool]]:
+    """
+    Every Snippet of a SourceText paired with whether it already has an embedding
+    generated by `model`, or needs none as a near-duplicate.
+    """
+    embeddings = embeddings_of(model)
+    # near-duplicates are found through the Snippet they duplicate
+    is_embedded = embeddings.c.id.is_not(None) | Snippet.near_duplicate_of_id.is_not(None)  # type: ignore[union-attr]
+    result = await session.execute(
+        select(Snippet, is_embedded)
+        .outerjoin(embeddings, embeddings.c.snippet_id == Snippet.id)
+        .where(Snippet.source_text_id == source_text_id)  # type: ignore[arg-type]
+    )
+    return [(snippet, bool(is_embedded)) for snippet, is_embedded in result.all()]
+
+
+async def reuse_cached_embeddings(
+    session: AsyncSession, snippet_ids: Iterable[UUID], model: EmbeddingModel
+) -> set[UUID]:
+    """
+    Embeddings are cached by `(content_hash, model)`: give each of `snippet_ids` a
+    copy of any existing embedding generated by `model` for a Snippet with the same
+    content. Vectors are copied within the database, never loaded.
+
+    Returns the ids of the Snippets that were given an embedding.
+    """
+    snippet_ids = list(snippet_ids)
+    if not snippet_ids:
+        return set()
+
+    Embedding = embedding_table(model)
+    embeddings = embeddings_of(model)
+    copied_columns = copied_embedding_columns(model, embeddings)
+    Cached = aliased(Snippet)
+    cached_vectors = (
+        select(Snippet.id, *copied_columns.values())
+        .join(Cached, Cached.content_hash == Snippet.content_hash)  # type: ignore[arg-type]
+        .join(embeddings, embeddings.c.snippet_id == Cached.id)
+        .where(Snippet.id.in_(snippet_ids))  # type: ignore[union-attr]
+        .distinct(Snippet.id)
+    )
+    result = await session.execute(
+        insert(Embedding)
+        .from_select(["snippet_id", *copied_columns], cached_vectors)
+        .on_conflict_do_nothing()
+        .returning(Embedding.snippet_id)  # type: ignore[arg-type]
+    )
+    return set(result.scalars().all())
+
+
+def simhash(text: str) -> int:
+    """
+    64-bit SimHash of the words in `text`, ignoring case and punctuation, as a signed
+    integer to fit a Postgres `bigint`. Each bit is set if most words, weighted by how
+    often they occur, have that bit set in their own hash.
+    """
+    word_counts = Counter(WORD_PATTERN.findall(text.casefold()))
+    if not word_counts:
+        return 0
+    word_hashes = np.array(
+        [
+            int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest())
+            for word in word_counts
+        ],
+        dtype=np.uint64,
+    )
+    weights = np.array(list(word_counts.values()), dtype=np.int64)
+    bits = (word_hashes[:, None] >> np.arange(SIMHASH_BITS, dtype=np.uint64)) & 1
+    votes = weights @ np.where(bits == 1, 1, -1)
+    signature = sum(1 << bit for bit in np.flatnonzero(votes > 0).tolist())
+    return (
+        signature - (1 << SIMHASH_BITS) if signature >> (SIMHASH_BITS - 1) else signature
+    )
+
+
+def simhash_bands(signature: int) -> list[int]:
+    return [
+        (signature >> (band * BAND_BITS)) & BAND_MASK for band in range(SIMHASH_BANDS)
+    ]
+
+
+def simhash_band(signature: ColumnElement, band: int) -> ColumnElement:
+    """
+    Matches the expression of the `ix_llm__snippet_simhash_band_<band>` indexes, which
+    lead with `source_text_id`.
+    Constants are inlined, as a bound parameter would not match the index.
+    """
+    shifted = signature.op(">>")(literal_column(str(band * BAND_BITS)))
+    return shifted.op("&")(literal_column(str(BAND_MASK)))
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return ((a ^ b) & ((1 << SIMHASH_BITS) - 1)).bit_count()
+
+
+class NearDuplicateIndex:
+    """
+    In-process LSH index of SimHash signatures, to find near-duplicates among Snippets
+    that have not been saved with a signature yet.
+    """
+
+    def __init__(self, max_distance: int) -> None:
+        self.max_distance = max_distance
+        self._buckets: dict[tuple[int, int], list[tuple[UUID, int]]] = defaultdict(list)
+
+    def add(self, snippet_id: UUID, signature: int) -> None:
+        for band, value in enumerate(simhash_bands(signature)):
+            self._buckets[(band, value)].append((snippet_id, signature))
+
+    def find(self, signature: int) -> UUID | None:
+        """
+        The nearest Snippet within `max_distance` bits, if any.
+        """
+        nearest: tuple[int, UUID] | None = None
+        for band, value in enumerate(simhash_bands(signature)):
+            for snippet_id, other in self._buckets.get((band, value), []):
+                distance = hamming_distance(signature, other)
+                if distance <= self.max_distance and (
+                    nearest is None or distance < nearest[0]
+                ):
+                    nearest = (distance, snippet_id)
+        return nearest[1] if nearest else None
+
+
+async def collapse_near_duplicates(
+    session: AsyncSession,
+    snippets: dict[UUID, tuple[UUID, str]],
+    model: EmbeddingModel,
+    max_distance: int,
+) -> dict[UUID, UUID]:
+    """
+    Save a SimHash signature for each Snippet in `snippets`, a `(source_text_id,
+    content)` by id, and find which are near-duplicates of a Snippet of the same
+    SourceText already embedded by `model`, or of an earlier one in `snippets`.
+    Only Snippets that are not near-duplicates themselves are matched, so each
+    near-duplicate points directly at a Snippet that is, or will be, embedded.
+
+    Returns the id of each near-duplicate mapped to the id of the Snippet it duplicates.
+    """
+    if not snippets:
+        return {}
+    signatures = {id: simhash(content) for id, (_, content) in snippets.items()}
+
+    new = (
+        sa_values(
+            column("id", PG_UUID(as_uuid=True)),
+            column("source_text_id", PG_UUID(as_uuid=True)),
+            column("simhash", BigInteger),
+            name="new",
+        )
+        .data(
+            [
+                (id, source_text_id, signatures[id])
+                for id, (source_text_id, _) in snippets.items()
+            ]
+        )
+        .alias("new")
+    )
+    Earlier = aliased(Snippet)
+    embeddings = embeddings_of(model)
+    candidates = await session.execute(
+        select(new.c.id, Earlier.id, Earlier.simhash)
+        .join(
+            Earlier,
+            and_(
+                Earlier.source_text_id == new.c.source_text_id,  # type: ignore[arg-type]
+                or_(
+                    *(
+                        simhash_band(Earlier.simhash, band)  # type: ignore[arg-type]
+                        == simhash_band(new.c.simhash, band)
+                        for band in range(SIMHASH_BANDS)
+                    )
+                ),
+            ),
+        )
+        .join(embeddings, embeddings.c.snippet_id == Earlier.id)
+        .where(Earlier.near_duplicate_of_id.is_(None))  # type: ignore[union-attr]
+    )
+    nearest: dict[UUID, tuple[int, UUID]] = {}
+    for snippet_id, earlier_id, earlier_signature in candidates.all():
+        distance = hamming_distance(signatures[snippet_id], earlier_signature)
+        if earlier_id != snippet_id and distance <= max_distance:
+            if snippet_id not in nearest or distance < nearest[snippet_id][0]:
+                nearest[snippet_id] = (distance, earlier_id)
+
+    duplicates: dict[UUID, UUID] = {}
+    batch_indexes: dict[UUID, NearDuplicateIndex] = defaultdict(
+        lambda: NearDuplicateIndex(max_distance)
+    )
+    for snippet_id, signature in signatures.items():
+        batch_index = batch_indexes[snippets[snippet_id][0]]
+        if snippet_id in nearest:
+            duplicates[snippet_id] = nearest[snippet_id][1]
+        elif (earlier_id := batch_index.find(signature)) is not None:
+            duplicates[snippet_id] = earlier_id
+        else:
+            batch_index.add(snippet_id, signature)
+
+    await session.execute(
+        update(Snippet),
+        [
+            {
+                "id": snippet_id,
+                "simhash": signature,
+                "near_duplicate_of_id": duplicates.get(snippet_id),
+            }
+            for snippet_id, signature in signatures.items()
+        ],
+    )
+    return duplicates
@@ -0,0 +1,65 @@
+"""
+Dependables specific to the llm app.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from functools import cache
+from typing import Annotated
+
+from fastapi import Depends
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from depositduck.dependables import db_engine, get_settings
+from depositduck.llm.cache import (
+    InProcessQueryEmbeddingCache,
+    InProcessSearchResultCache,
+    PostgresQueryEmbeddingCache,
+    PostgresSearchResultCache,
+    QueryEmbeddingCache,
+    SearchResultCache,
+)
+from depositduck.models.llm import CacheBackend
+from depositduck.settings import Settings
+
+
+@cache
+def get_query_embedding_cache(
+    settings: Annotated[Settings, Depends(get_settings)],
+) -> QueryEmbeddingCache | None:
+    """
+    One cache per process, so that hits and misses accumulate across requests.
+    None when `query_embedding_cache_backend` is `none`.
+    """
+    max_entries = settings.query_embedding_cache_max_entries
+    ttl_seconds = settings.query_embedding_cache_ttl_seconds
+    match settings.query_embedding_cache_backend:
+        case CacheBackend.MEMORY:
+            return InProcessQueryEmbeddingCache(max_entries, ttl_seconds)
+        case CacheBackend.POSTGRES:
+            session_factory = async_sessionmaker(
+                db_engine, class_=AsyncSession, expire_on_commit=False
+            )
+            return PostgresQueryEmbeddingCache(session_factory, max_entries, ttl_seconds)
+    return None
+
+
+@cache
+def get_search_result_cache(
+    settings: Annotated[Settings, Depends(get_settings)],
+) -> SearchResultCache | None:
+    """
+    One cache per process, so that hits and misses accumulate across requests.
+    None when `search_result_cache_backend` is `none`.
+    """
+    max_entries = settings.search_result_cache_max_entries
+    ttl_seconds = settings.search_result_cache_ttl_seconds
+    match settings.search_result_cache_backend:
+        case CacheBackend.MEMORY:
+            return InProcessSearchResultCache(max_entries, ttl_seconds)
+        case CacheBackend.POSTGRES:
+            session_factory = async_sessionmaker(
+                db_engine, class_=AsyncSession, expire_on_commit=False
+            )
+            return PostgresSearchResultCache(session_factory, max_entries, ttl_seconds)
+    return None
@@ -0,0 +1,94 @@
+"""
+Re-rank relevance search results for diversity by maximal marginal relevance (MMR).
+
+The nearest Snippets to a query are often near-identical paragraphs from the same
+section, which spend the prompt's context on one idea. MMR picks results one at a time,
+each maximising
+    lambda * relevance - (1 - lambda) * (similarity to the closest result already picked)
+so `lambda = 1` keeps the original ranking and lower values favour variety.
+
+Relevance is the fused search score scaled to [0, 1], so text matches count as they do
+in `depositduck.llm.search`. Similarity is the cosine similarity of embeddings.
+Every pairwise similarity is computed in one matrix product up front, then each pick
+only updates a vector of closest similarities, so a pool of 100 takes well under a
+millisecond. https://www.cs.cmu.edu/~jgc/publication/The_Use_MMR_Diversity_Based_LTMCMU.pdf
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from uuid import UUID
+
+import numpy as np
+import numpy.typing as npt
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from depositduck.llm.registry import embeddings_of
+from depositduck.models.dto.llm import RelevantSnippet
+from depositduck.models.llm import EmbeddingModel
+
+
+def mmr_order(
+    relevance: npt.ArrayLike, vectors: npt.ArrayLike, limit: int, lambda_: float
+) -> list[int]:
+    """
+    Indices of the `limit` candidates picked by MMR, in the order they were picked.
+    `relevance` has one score per candidate, `vectors` one row per candidate. Rows of
+    zeros, eg. for candidates without an embedding, are similar to nothing.
+    """
+    relevance = np.asarray(relevance, dtype=np.float32)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    count = len(relevance)
+    limit = min(limit, count)
+    if limit == 0:
+        return []
+
+    spread = relevance.max() - relevance.min()
+    relevance = (relevance - relevance.min()) / spread if spread else np.ones(count)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit_vectors = np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+    similarity = unit_vectors @ unit_vectors.T
+
+    picked = [int(np.argmax(relevance))]
+    available = np.ones(count, dtype=bool)
+    available[picked[0]] = False
+    closest = similarity[picked[0]].copy()
+    while len(picked) < limit:
+        scores = lambda_ * relevance - (1 - lambda_) * closest
+        scores[~available] = -np.inf
+        pick = int(np.argmax(scores))
+        picked.append(pick)
+        available[pick] = False
+        np.maximum(closest, similarity[pick], out=closest)
+    return picked
+
+
+async def diversify(
+    session: AsyncSession,
+    snippets: list[RelevantSnippet],
+    limit: int,
+    lambda_: float,
+    model: EmbeddingModel,
+) -> list[RelevantSnippet]:
+    """
+    Re-rank a pool of search results by MMR and keep the first `limit`. Reads the
+    pool's embeddings from `model`; Snippets it has not embedded are found by text
+    alone and are never considered redundant.
+    """
+    if len(snippets) <= 1:
+        return snippets[:limit]
+    embeddings = embeddings_of(model)
+    snippet_ids: list[UUID] = [snippet.snippet_id for snippet in snippets]
+    result = await session.execute(
+        select(embeddings.c.snippet_id, embeddings.c.vector).where(
+            embeddings.c.snippet_id.in_(snippet_ids)
+        )
+    )
+    vector_by_id = {row.snippet_id: row.vector for row in result.all()}
+
+    vectors = np.zeros((len(snippets), model.dimensions), dtype=np.float32)
+    for index, snippet_id in enumerate(snippet_ids):
+        if (vector := vector_by_id.get(snippet_id)) is not None:
+            vectors[index] = vector
+    relevance = [snippet.score for snippet in snippets]
+    return [snippets[i] for i in mmr_order(relevance, vectors, limit, lambda_)]
@@ -0,0 +1,165 @@
+"""
+HTTP client used to talk to draLLaM, DepositDuck's dedicated LLM service.
+
+A single pooled client is created when the application starts and shared by every
+request for the lifetime of the app, so that connections to draLLaM are kept alive
+and reused instead of being set up and torn down on every request.
+
+Its transport counts the requests in flight and the connections left idle between them,
+so the pool can be reported on without reading httpx's private internals.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+import time
+from collections import deque
+from typing import AsyncIterator, Callable
+from weakref import WeakKeyDictionary
+
+import httpx
+from pydantic import BaseModel
+
+from depositduck.settings import Settings
+
+
+class DrallamPoolStats(BaseModel):
+    max_connections: int
+    max_keepalive_connections: int
+    # connections currently open to draLLaM, whether busy or idle
+    open_connections: int
+    # connections currently serving a request
+    active_connections: int
+    idle_connections: int
+    # requests waiting for a connection to become available
+    queued_requests: int
+    # proportion of `max_connections` currently serving a request
+    utilisation: float
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """
+    A response body that calls `release` once, when it is closed.
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self.stream = stream
+        self.release: Callable[[], None] | None = release
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()
+        finally:
+            if self.release is not None:
+                self.release()
+                self.release = None
+
+
+class PoolTrackingTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps a transport to count requests in flight, each holding a connection until its
+    response is closed. Idle connections are estimated as httpcore keeps them: a
+    connection released while no request is waiting stays open for `keepalive_expiry`
+    seconds, up to `max_keepalive_connections`, and is reused by the next request.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, settings: Settings) -> None:
+        self.transport = transport
+        self.max_connections = settings.drallam_max_connections
+        self.max_keepalive_connections = settings.drallam_max_keepalive_connections
+        self.keepalive_expiry = settings.drallam_keepalive_expiry
+        self.in_flight = 0
+        # when each idle connection was released, oldest first
+        self._idle_since: deque[float] = deque()
+
+    def idle_connections(self) -> int:
+        expired_before = time.monotonic() - self.keepalive_expiry
+        while self._idle_since and self._idle_since[0] < expired_before:
+            self._idle_since.popleft()
+        return len(self._idle_since)
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        # with requests waiting, the connection is handed straight to one of them
+        waiting = self.in_flight >= self.max_connections
+        if not waiting and self.idle_connections() < self.max_keepalive_connections:
+            self._idle_since.append(time.monotonic())
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self.idle_connections():
+            self._idle_since.pop()
+        self.in_flight += 1
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self._release()
+            raise
+        response.stream = _ReleasingStream(response.stream, self._release)  # type: ignore[arg-type]
+        return response
+
+    async def aclose(self) -> None:
+        self._idle_since.clear()
+        await self.transport.aclose()
+
+
+_POOLS: WeakKeyDictionary[httpx.AsyncClient, PoolTrackingTransport] = WeakKeyDictionary()
+
+
+def build_drallam_client(settings: Settings) -> httpx.AsyncClient:
+    """
+    Create a client sized by the `drallam_*` settings.
+    Setting `drallam_http2` requires the optional `h2` package (`httpx[http2]`).
+    With `drallam_standin` requests are answered in-process by a stand-in for draLLaM.
+    """
+    limits = httpx.Limits(
+        max_connections=settings.drallam_max_connections,
+        max_keepalive_connections=settings.drallam_max_keepalive_connections,
+        keepalive_expiry=settings.drallam_keepalive_expiry,
+    )
+    timeout = httpx.Timeout(
+        settings.drallam_timeout,
+        connect=settings.drallam_connect_timeout,
+        pool=settings.drallam_pool_timeout,
+    )
+    transport: httpx.AsyncBaseTransport
+    if settings.drallam_standin:
+        from depositduck.llm.drallam_standin import create_app
+
+        standin = create_app(
+            latency=settings.drallam_standin_latency,
+            error_rate=settings.drallam_standin_error_rate,
+        )
+        transport = httpx.ASGITransport(app=standin)
+    else:
+        transport = httpx.AsyncHTTPTransport(limits=limits, http2=settings.drallam_http2)
+    pool = PoolTrackingTransport(transport, settings)
+    client = httpx.AsyncClient(
+        base_url=settings.drallam_origin, timeout=timeout, transport=pool
+    )
+    _POOLS[client] = pool
+    return client
+
+
+def get_pool_stats(settings: Settings, client: httpx.AsyncClient) -> DrallamPoolStats:
+    """
+    Connections of the pool behind a client built by `build_drallam_client`.
+    Other clients report an empty pool.
+    """
+    pool = _POOLS.get(client)
+    in_flight = pool.in_flight if pool else 0
+    active_connections = min(in_flight, settings.drallam_max_connections)
+    idle_connections = pool.idle_connections() if pool else 0
+    queued_requests = in_flight - active_connections
+
+    return DrallamPoolStats(
+        max_connections=settings.drallam_max_connections,
+        max_keepalive_connections=settings.drallam_max_keepalive_connections,
+        open_connections=active_connections + idle_connections,
+        active_connections=active_connections,
+        idle_connections=idle_connections,
+        queued_requests=queued_requests,
+        utilisation=active_connections / settings.drallam_max_connections,
+    )
@@ -0,0 +1,153 @@
+"""
+Deterministic stand-in for draLLaM, to run the embedding and search pipelines without
+an ollama container, eg. in CI, on air-gapped hosts or for reproducible load tests.
+
+Implements the parts of the ollama API used by DepositDuck. Embeddings are built by
+hashing words into signed features, so the same text always gets the same vector and
+texts sharing words are close. Artificial latency and errors can be injected, drawn
+from a seeded random number generator.
+
+Run it in-process by setting `DRALLAM_STANDIN=true`, see `build_drallam_client`, or
+serve it at `DRALLAM_ORIGIN`:
+`python -m depositduck.llm.drallam_standin --port 11434 --latency-ms 20 --error-rate 0.01`
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+from datetime import datetime, timezone
+
+from fastapi import FastAPI, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+from depositduck.models.llm import EMBEDDING_MODELS
+
+WORD = re.compile(r"\w+")
+# dimensions each word adds to, fewer make collisions between words less likely
+FEATURES_PER_WORD = 4
+
+
+def standin_embedding(text: str, dimensions: int) -> list[float]:
+    """
+    Unit vector with ±1 added to `FEATURES_PER_WORD` hashed dimensions for each word.
+    """
+    vector = [0.0] * dimensions
+    for word in WORD.findall(text.casefold()) or [text]:
+        digest = hashlib.blake2b(
+            word.encode(), digest_size=4 * FEATURES_PER_WORD
+        ).digest()
+        for i in range(FEATURES_PER_WORD):
+            feature = int.from_bytes(digest[4 * i : 4 * i + 4], "little")
+            sign = 1.0 if feature & 1 else -1.0
+            vector[(feature >> 1) % dimensions] += sign
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else vector
+
+
+class EmbeddingsRequest(BaseModel):
+    model: str
+    prompt: str
+
+
+class EmbedRequest(BaseModel):
+    model: str
+    input: str | list[str]
+
+
+class GenerateRequest(BaseModel):
+    model: str
+    prompt: str
+    stream: bool = True
+
+
+def create_app(latency: float = 0.0, error_rate: float = 0.0, seed: int = 0) -> FastAPI:
+    """
+    `latency` is the mean delay in seconds added to each response, varying by ±50%.
+    A proportion `error_rate` of requests fail with status 500. Both are drawn from a
+    random number generator seeded by `seed`, so a sequence of requests is reproducible.
+    """
+    app = FastAPI(title="draLLaM stand-in")
+    rng = random.Random(seed)
+
+    async def simulate() -> JSONResponse | None:
+        delay = latency * rng.uniform(0.5, 1.5)
+        fails = rng.random() < error_rate
+        if delay:
+            await asyncio.sleep(delay)
+        if fails:
+            return JSONResponse(
+                {"error": "stand-in error"},
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+        return None
+
+    def model_not_found(model: str) -> JSONResponse:
+        return JSONResponse(
+            {"error": f"model '{model}' not found, try pulling it first"},
+            status_code=status.HTTP_404_NOT_FOUND,
+        )
+
+    @app.post("/api/embeddings")
+    async def embeddings(request: EmbeddingsRequest):
+        if error := await simulate():
+            return error
+        if request.model not in EMBEDDING_MODELS:
+            return model_not_found(request.model)
+        dimensions = EMBEDDING_MODELS[request.model].dimensions
+        return {"embedding": standin_embedding(request.prompt, dimensions)}
+
+    @app.post("/api/embed")
+    async def embed(request: EmbedRequest):
+        if error := await simulate():
+            return error
+        if request.model not in EMBEDDING_MODELS:
+            return model_not_found(request.model)
+        dimensions = EMBEDDING_MODELS[request.model].dimensions
+        inputs = [request.input] if isinstance(request.input, str) else request.input
+        return {
+            "model": request.model,
+            "embeddings": [standin_embedding(doc, dimensions) for doc in inputs],
+        }
+
+    @app.post("/api/generate")
+    async def generate(request: GenerateRequest):
+        if error := await simulate():
+            return error
+        digest = hashlib.sha256(f"{request.model}\n{request.prompt}".encode()).hexdigest()
+        response = {
+            "model": request.model,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "response": f"stand-in response {digest[:12]}",
+            "done": True,
+        }
+        if not request.stream:
+            return response
+
+        async def chunks():
+            yield json.dumps({**response, "done": False}) + "\n"
+            yield json.dumps({**response, "response": ""}) + "\n"
+
+        return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve a stand-in for draLLaM.")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    app = create_app(args.latency_ms / 1000, args.error_rate, args.seed)
+    uvicorn.run(app, host=args.host, port=args.port)
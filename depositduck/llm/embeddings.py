@@ -4,19 +4,376 @@ Utilities to generate embeddings for use in vector similarity queries.
 (c) 2024 Alberto Morón Hernández
 """
 
+import asyncio
+import math
+import random
+import time
+from typing import Any, Awaitable, Callable
+
 import httpx
+from pydantic import BaseModel
 
+from depositduck.dependables import get_logger
+from depositduck.llm.cache import QueryEmbeddingCache
+from depositduck.llm.resilience import (
+    DrallamGuard,
+    Outcome,
+    TokenBucket,
+    get_drallam_guard,
+)
+from depositduck.models.llm import EmbeddingModel
 from depositduck.settings import Settings
 
+LOG = get_logger()
+
+# called with the input positions of a completed batch and its embeddings, in order
+OnBatchEmbedded = Callable[[list[int], list[list[float]]], Awaitable[None]]
+
+
+class EmbeddingError(Exception):
+    pass
+
+
+class _NotRetryable(Exception):
+    """
+    draLLaM rejected the request itself, eg. for an unknown model. It is healthy, so
+    this neither counts against the circuit breaker nor is worth retrying.
+    """
+
+
+class EmbeddingBatchReport(BaseModel):
+    batch_index: int
+    size: int
+    latency_ms: float
+    error: str | None = None
+
+
+class EmbeddingsResult(BaseModel):
+    # embeddings keyed by the position of their document in the input
+    embeddings: dict[int, list[float]] = {}
+    batches: list[EmbeddingBatchReport] = []
+    failed_indices: list[int] = []
+
+
+def truncate_embedding(embedding: list[float], dimensions: int) -> list[float]:
+    """
+    Keep the leading `dimensions` of a Matryoshka `embedding`, rescaled to unit length.
+    https://huggingface.co/nomic-ai/nomic-embed-text-v1.5#adjusting-dimensionality
+    """
+    prefix = embedding[:dimensions]
+    norm = math.sqrt(sum(value * value for value in prefix))
+    if not norm:
+        return prefix
+    return [value / norm for value in prefix]
+
+
+def drallam_model_tag(settings: Settings, model: EmbeddingModel | None) -> str:
+    return (model or settings.embedding_model).tag
+
+
+async def _post(
+    drallam_client: httpx.AsyncClient, path: str, data: dict[str, Any]
+) -> dict[str, Any]:
+    headers = {"content-type": "application/json"}
+    response = await drallam_client.post(path, json=data, headers=headers)
+    if response.is_client_error and response.status_code != 429:
+        raise _NotRetryable(f"draLLaM responded {response.status_code}: {response.text}")
+    response.raise_for_status()
+    return response.json()
+
+
+async def _hedged_post(
+    guard: DrallamGuard,
+    drallam_client: httpx.AsyncClient,
+    path: str,
+    data: dict[str, Any],
+) -> dict[str, Any]:
+    """
+    If no response arrives within the p95 latency of recent requests send the same
+    request again, and use whichever response arrives first.
+    """
+    tasks = [asyncio.create_task(_post(drallam_client, path, data))]
+    try:
+        delay = guard.hedge_delay()
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            guard.hedged_count += 1
+            tasks.append(asyncio.create_task(_post(drallam_client, path, data)))
+
+        pending = set(tasks)
+        errors: list[BaseException] = []
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if (error := task.exception()) is None:
+                    return task.result()
+                errors.append(error)
+        # every request failed, raise the first error
+        raise errors[0]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def request_embeddings(
+    settings: Settings,
+    drallam_client: httpx.AsyncClient,
+    path: str,
+    data: dict[str, Any],
+) -> dict[str, Any]:
+    """
+    POST to draLLaM, retrying failed attempts after a jittered backoff until
+    `drallam_embeddings_deadline` seconds have passed. Requests are refused while the
+    client's circuit breaker is open. See `depositduck.llm.resilience`.
+
+    Raises:
+        EmbeddingError: if no attempt succeeded in time or the request was refused
+    """
+    guard = get_drallam_guard(settings, drallam_client)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.drallam_embeddings_deadline
+    attempts = settings.drallam_embeddings_retries + 1
+    error: Exception | None = None
+
+    for attempt in range(attempts):
+        if not guard.breaker.allow():
+            guard.observe(Outcome.REJECTED, 0.0)
+            raise EmbeddingError("draLLaM is unavailable, its circuit breaker is open")
+        if attempt:
+            guard.retried_count += 1
+
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout_at(deadline):
+                response_data = await _hedged_post(guard, drallam_client, path, data)
+        except asyncio.CancelledError:
+            guard.breaker.abandon()
+            raise
+        except TimeoutError:
+            guard.observe(Outcome.TIMEOUT, (time.perf_counter() - start) * 1000)
+            guard.breaker.record_failure()
+            raise EmbeddingError(
+                f"no response from draLLaM within {settings.drallam_embeddings_deadline}s"
+            )
+        except _NotRetryable as e:
+            guard.observe(Outcome.ERROR, (time.perf_counter() - start) * 1000)
+            guard.breaker.record_success()
+            raise EmbeddingError(str(e)) from e
+        except (httpx.HTTPError, ValueError) as e:
+            guard.observe(Outcome.ERROR, (time.perf_counter() - start) * 1000)
+            guard.breaker.record_failure()
+            error = e
+        else:
+            guard.observe(Outcome.OK, (time.perf_counter() - start) * 1000)
+            guard.breaker.record_success()
+            return response_data
+
+        if attempt + 1 < attempts:
+            # full jitter: spread retries so that callers do not retry in lockstep
+            backoff = settings.drallam_embeddings_retry_backoff * 2**attempt
+            delay = min(random.uniform(0, backoff), max(deadline - loop.time(), 0))
+            await asyncio.sleep(delay)
+
+    raise EmbeddingError(
+        f"draLLaM request failed after {attempts} attempts: "
+        f"{str(error) or error.__class__.__name__}"
+    )
+
 
 async def embed_document(
-    settings: Settings, drallam_client: httpx.AsyncClient, doc: str
+    settings: Settings,
+    drallam_client: httpx.AsyncClient,
+    doc: str,
+    model: EmbeddingModel | None = None,
 ) -> list[float]:
+    """
+    Raises:
+        EmbeddingError: if `doc` is empty or could not be embedded
+    """
     if not doc:
-        return []
+        raise EmbeddingError("cannot embed an empty document")
 
-    data = {"model": settings.drallam_embeddings_model, "prompt": doc}
-    headers = {"content-type": "application/json"}
-    response = await drallam_client.post("/api/embeddings", json=data, headers=headers)
-    response_data: dict = response.json()
-    return response_data.get("embedding", [])
+    data = {"model": drallam_model_tag(settings, model), "prompt": doc}
+    response_data = await request_embeddings(
+        settings, drallam_client, "/api/embeddings", data
+    )
+    embedding: list[float] = response_data.get("embedding") or []
+    if not embedding:
+        raise EmbeddingError("draLLaM response did not include an embedding")
+    return embedding
+
+
+async def embed_query(
+    settings: Settings,
+    drallam_client: httpx.AsyncClient,
+    cache: QueryEmbeddingCache | None,
+    query: str,
+    model: EmbeddingModel | None = None,
+) -> list[float]:
+    """
+    Embed a user query, reusing the embedding of an equivalent earlier query if cached.
+    `model` defaults to `Settings.embedding_model`, as for the functions below.
+
+    Raises:
+        EmbeddingError: if the query could not be embedded
+    """
+    llm_name = drallam_model_tag(settings, model)
+    if cache is not None:
+        cached_embedding = await cache.get(llm_name, query)
+        if cached_embedding is not None:
+            return cached_embedding
+
+    embedding = await embed_document(settings, drallam_client, query, model)
+    if cache is not None:
+        await cache.set(llm_name, query, embedding)
+    return embedding
+
+
+async def embed_queries(
+    settings: Settings,
+    drallam_client: httpx.AsyncClient,
+    cache: QueryEmbeddingCache | None,
+    queries: list[str],
+    model: EmbeddingModel | None = None,
+) -> list[list[float]]:
+    """
+    Embed several user queries together, in the same order. Cached embeddings are
+    reused and each distinct uncached query is sent to draLLaM once, see
+    `embed_documents`.
+
+    Raises:
+        EmbeddingError: if any query could not be embedded
+    """
+    llm_name = drallam_model_tag(settings, model)
+    embeddings: dict[str, list[float]] = {}
+    if cache is not None:
+        for query in dict.fromkeys(queries):
+            cached_embedding = await cache.get(llm_name, query)
+            if cached_embedding is not None:
+                embeddings[query] = cached_embedding
+
+    missing = [query for query in dict.fromkeys(queries) if query not in embeddings]
+    result = await embed_documents(settings, drallam_client, missing, model=model)
+    if result.failed_indices:
+        raise EmbeddingError(
+            f"could not embed {len(result.failed_indices)} of {len(missing)} queries"
+        )
+    for i, embedding in result.embeddings.items():
+        embeddings[missing[i]] = embedding
+        if cache is not None:
+            await cache.set(llm_name, missing[i], embedding)
+    return [embeddings[query] for query in queries]
+
+
+async def embed_document_batch(
+    settings: Settings,
+    drallam_client: httpx.AsyncClient,
+    docs: list[str],
+    model: EmbeddingModel | None = None,
+) -> list[list[float]]:
+    """
+    Embed several documents in a single call to the multi-input `/api/embed` endpoint
+    (available from ollama 0.3.0).
+
+    Raises:
+        EmbeddingError: if the request failed, see `request_embeddings`, or the
+            response does not carry one embedding per document
+    """
+    data = {"model": drallam_model_tag(settings, model), "input": docs}
+    response_data = await request_embeddings(settings, drallam_client, "/api/embed", data)
+    embeddings: list[list[float]] = response_data.get("embeddings", [])
+    if len(embeddings) != len(docs):
+        raise EmbeddingError(
+            f"expected {len(docs)} embeddings from draLLaM, got {len(embeddings)}"
+        )
+    return embeddings
+
+
+async def _embed_batch(
+    settings: Settings,
+    drallam_client: httpx.AsyncClient,
+    docs: list[str],
+    model: EmbeddingModel | None,
+) -> list[list[float]]:
+    if settings.drallam_embeddings_batch_input:
+        return await embed_document_batch(settings, drallam_client, docs, model)
+
+    return [await embed_document(settings, drallam_client, doc, model) for doc in docs]
+
+
+async def embed_documents(
+    settings: Settings,
+    drallam_client: httpx.AsyncClient,
+    docs: list[str],
+    on_batch: OnBatchEmbedded | None = None,
+    model: EmbeddingModel | None = None,
+    rate_limit: TokenBucket | None = None,
+) -> EmbeddingsResult:
+    """
+    Embed many documents, splitting them into batches that are sent to draLLaM
+    concurrently. At most `drallam_embeddings_concurrency` batches are in flight at once.
+
+    Multi-input requests are only made if `drallam_embeddings_batch_input` is set,
+    otherwise every batch holds a single document.
+
+    A failed batch does not abort the others: its documents are listed in
+    `failed_indices` and the embeddings of every other batch are still returned.
+    Pass `on_batch` to act on (eg. persist) each batch as soon as it completes. A batch
+    whose `on_batch` raises is failed in the same way. Pass `rate_limit` to hold each
+    batch until its documents fit within the rate.
+    """
+    result = EmbeddingsResult()
+    if not docs:
+        return result
+
+    batch_size = 1
+    if settings.drallam_embeddings_batch_input:
+        batch_size = settings.drallam_embeddings_batch_size
+    batches = [
+        list(range(start, min(start + batch_size, len(docs))))
+        for start in range(0, len(docs), batch_size)
+    ]
+    semaphore = asyncio.Semaphore(settings.drallam_embeddings_concurrency)
+
+    async def run_batch(batch_index: int, indices: list[int]) -> None:
+        async with semaphore:
+            if rate_limit:
+                await rate_limit.acquire(len(indices))
+            start = time.perf_counter()
+            error = None
+            try:
+                embeddings = await _embed_batch(
+                    settings, drallam_client, [docs[i] for i in indices], model
+                )
+            except EmbeddingError as e:
+                error = str(e) or e.__class__.__name__
+                result.failed_indices.extend(indices)
+            latency_ms = (time.perf_counter() - start) * 1000
+
+            if error is None and on_batch:
+                try:
+                    await on_batch(indices, embeddings)
+                except Exception as e:
+                    # eg. the batch could not be saved: the other batches carry on
+                    error = f"on_batch: {type(e).__name__}: {e}"
+                    result.failed_indices.extend(indices)
+            if error is None:
+                result.embeddings.update(zip(indices, embeddings))
+
+        report = EmbeddingBatchReport(
+            batch_index=batch_index, size=len(indices), latency_ms=latency_ms, error=error
+        )
+        result.batches.append(report)
+        message = f"embedding batch {batch_index} [size={len(indices)}]"
+        if error:
+            LOG.warn(f"{message} failed in {latency_ms:.1f}ms: {error}")
+        else:
+            LOG.debug(f"{message} took {latency_ms:.1f}ms")
+
+    await asyncio.gather(*(run_batch(i, indices) for i, indices in enumerate(batches)))
+
+    result.batches.sort(key=lambda b: b.batch_index)
+    result.failed_indices.sort()
+    return result
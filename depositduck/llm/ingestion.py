@@ -0,0 +1,510 @@
+"""
+Ingest source material for Retrieval-Augmented Generation.
+
+Text is consumed as a stream of chunks and its Snippets are written to the database as
+they are produced, so chunking never holds more than a paragraph of the document. The
+content itself is spooled to disk and written once it has all been received, rather
+than appended as it arrives, which would rewrite the whole growing value every time.
+It is then appended in pieces of `ingestion_flush_characters`, so memory stays bounded
+whatever the size of the document.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+import asyncio
+import codecs
+import tempfile
+import time
+from collections import defaultdict
+from itertools import batched
+from typing import IO, AsyncIterable, AsyncIterator, Awaitable, Callable, NamedTuple
+from uuid import UUID, uuid4
+
+import httpx
+from pydantic import BaseModel
+from sqlalchemy import delete, update
+from sqlalchemy import insert as sa_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from depositduck.llm.bulk import write_rows
+from depositduck.llm.chunking import get_chunker
+from depositduck.llm.dedup import (
+    collapse_near_duplicates,
+    find_snippets_with_embedding_status,
+    reuse_cached_embeddings,
+)
+from depositduck.llm.embeddings import EmbeddingError, embed_documents
+from depositduck.llm.registry import embedding_row, embedding_table
+from depositduck.llm.resilience import TokenBucket
+from depositduck.models.dto.llm import EmbeddingsCreated
+from depositduck.models.llm import EmbeddingModel, SourceTextBase, hash_content
+from depositduck.models.sql.llm import Snippet, SourceText
+from depositduck.settings import Settings
+
+# called with the number of items processed so far and the total, if known
+OnProgress = Callable[[int, int | None], Awaitable[None]]
+
+
+class SourceTextNotFoundError(LookupError):
+    pass
+
+
+class NoSnippetsError(ValueError):
+    """
+    Raised when asked to embed a SourceText that has not been split into Snippets.
+    """
+
+
+class SnippetToEmbed(NamedTuple):
+    id: UUID
+    source_text_id: UUID
+    content: str
+    content_hash: str
+
+
+class IngestionResult(BaseModel):
+    source_text_id: UUID
+    snippet_count: int
+    character_count: int
+
+
+async def decode_stream(byte_chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """
+    Decode UTF-8 text that may have multi-byte characters split across chunks.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    async for byte_chunk in byte_chunks:
+        text = decoder.decode(byte_chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+async def _save_snippets(
+    settings: Settings, session: AsyncSession, source_text_id: UUID, chunks: list[str]
+) -> int:
+    rows = [
+        {
+            "source_text_id": source_text_id,
+            "content": chunk,
+            "content_hash": hash_content(chunk),
+        }
+        for chunk in chunks
+    ]
+    inserted = await write_rows(settings, session, Snippet.__table__, rows)  # type: ignore[attr-defined]
+    return len(inserted)
+
+
+async def _spool_content(
+    text_chunks: AsyncIterable[str], spool: IO[str]
+) -> AsyncIterator[str]:
+    """Pass `text_chunks` through, keeping a copy in `spool`."""
+    async for text in text_chunks:
+        spool.write(text)
+        yield text
+
+
+def _content_spool(settings: Settings) -> IO[str]:
+    """
+    Where the content of a streamed SourceText is kept until it has all been received:
+    in memory up to `ingestion_flush_characters`, then on disk.
+    """
+    return tempfile.SpooledTemporaryFile(  # type: ignore[return-value]
+        max_size=settings.ingestion_flush_characters, mode="w+", encoding="utf-8"
+    )
+
+
+async def _create_source_text(
+    db_session_factory: async_sessionmaker, source_text_meta: SourceTextBase
+) -> UUID:
+    session: AsyncSession
+    async with db_session_factory.begin() as session:
+        result = await session.execute(
+            sa_insert(SourceText)
+            .values(
+                **source_text_meta.model_dump(mode="json", exclude={"content"}),
+                content="",
+            )
+            .returning(SourceText.id)  # type: ignore[call-overload]
+        )
+        return result.scalar_one()
+
+
+async def _save_content(
+    settings: Settings, session: AsyncSession, source_text_id: UUID, spool: IO[str]
+) -> int:
+    """
+    Append the content in `spool` to the SourceText `ingestion_flush_characters` at a
+    time, so neither this process nor the database driver holds all of it at once.
+
+    Returns how many characters were saved.
+    """
+    character_count = 0
+    spool.seek(0)
+    while piece := spool.read(settings.ingestion_flush_characters):
+        await session.execute(
+            update(SourceText)
+            .where(SourceText.id == source_text_id)  # type: ignore[arg-type]
+            .values(content=SourceText.content + piece)
+        )
+        character_count += len(piece)
+    return character_count
+
+
+async def _delete_source_text(session: AsyncSession, source_text_id: UUID) -> None:
+    await session.execute(
+        delete(Snippet).where(Snippet.source_text_id == source_text_id)  # type: ignore[arg-type]
+    )
+    await session.execute(
+        delete(SourceText).where(SourceText.id == source_text_id)  # type: ignore[arg-type]
+    )
+
+
+async def ingest_source_text_stream(
+    settings: Settings,
+    db_session_factory: async_sessionmaker,
+    source_text_meta: SourceTextBase,
+    byte_chunks: AsyncIterable[bytes],
+) -> IngestionResult:
+    """
+    Save a SourceText whose content is streamed in `byte_chunks`, along with the
+    Snippets it is split into by its chunker. `source_text_meta.content` is ignored.
+
+    Snippets are inserted `ingestion_snippet_batch_size` at a time, each batch in a
+    transaction of its own, and the content is saved in bounded pieces once it has all
+    been received. If the upload fails the SourceText and its Snippets are deleted
+    again, so it leaves nothing behind.
+    """
+    pending_chunks: list[str] = []
+    snippet_count = 0
+    source_text_id = await _create_source_text(db_session_factory, source_text_meta)
+
+    session: AsyncSession
+    try:
+        with _content_spool(settings) as spool:
+            chunker = get_chunker(settings, source_text_meta.chunker)
+            text_chunks = _spool_content(decode_stream(byte_chunks), spool)
+            async for chunk in chunker.achunk(text_chunks):
+                pending_chunks.append(chunk)
+                if len(pending_chunks) >= settings.ingestion_snippet_batch_size:
+                    async with db_session_factory.begin() as session:
+                        snippet_count += await _save_snippets(
+                            settings, session, source_text_id, pending_chunks
+                        )
+                    pending_chunks = []
+            async with db_session_factory.begin() as session:
+                snippet_count += await _save_snippets(
+                    settings, session, source_text_id, pending_chunks
+                )
+                character_count = await _save_content(
+                    settings, session, source_text_id, spool
+                )
+    except BaseException:
+        # including the upload being cancelled, eg. because the client went away
+        async with db_session_factory.begin() as session:
+            await _delete_source_text(session, source_text_id)
+        raise
+
+    return IngestionResult(
+        source_text_id=source_text_id,
+        snippet_count=snippet_count,
+        character_count=character_count,
+    )
+
+
+async def _get_source_text(
+    db_session_factory: async_sessionmaker, source_text_id: UUID
+) -> SourceText:
+    session: AsyncSession
+    async with db_session_factory.begin() as session:
+        source_text = await session.get(SourceText, source_text_id)
+    if source_text is None:
+        raise SourceTextNotFoundError(f"no SourceText with [id={source_text_id}]")
+    return source_text
+
+
+async def snippets_from_source_text(
+    settings: Settings,
+    db_session_factory: async_sessionmaker,
+    source_text_id: UUID,
+    on_progress: OnProgress | None = None,
+) -> int:
+    """
+    Split a SourceText already in the database using its chunker and save the chunks
+    as Snippets. Chunks already saved for the SourceText are skipped, so this is safe
+    to repeat.
+
+    Returns how many Snippets were saved.
+    """
+    source_text = await _get_source_text(db_session_factory, source_text_id)
+    chunks = get_chunker(settings, source_text.chunker).chunk([source_text.content])
+
+    created_count = 0
+    session: AsyncSession
+    async with db_session_factory.begin() as session:
+        for batch in batched(chunks, settings.ingestion_snippet_batch_size):
+            created_count += await _save_snippets(
+                settings, session, source_text.id, list(batch)
+            )
+            if on_progress:
+                await on_progress(created_count, None)
+    return created_count
+
+
+async def embed_snippets(
+    settings: Settings,
+    db_session_factory: async_sessionmaker,
+    drallam_client: httpx.AsyncClient,
+    snippets: list[SnippetToEmbed],
+    model: EmbeddingModel,
+    on_saved: Callable[[int], Awaitable[None]] | None = None,
+    rate_limit: TokenBucket | None = None,
+) -> EmbeddingsCreated:
+    """
+    Embed Snippets that have no embedding from `model` yet. Snippets whose content has
+    already been embedded, for this or any other SourceText, reuse the existing
+    embedding and identical Snippets are only embedded once. Near-duplicates of an
+    embedded Snippet, or of another in `snippets`, are not embedded at all.
+    Embeddings are requested concurrently in batches and each batch is saved as soon
+    as it completes. `on_saved` is called with the number of Snippets covered by each
+    write. Requests are paced by `rate_limit`, if given; reused embeddings are not.
+    """
+    reused_ids: set[UUID] = set()
+    if snippets:
+        async with db_session_factory.begin() as session:
+            reused_ids = await reuse_cached_embeddings(
+                session, [s.id for s in snippets], model
+            )
+        if reused_ids and on_saved:
+            await on_saved(len(reused_ids))
+
+    duplicate_ids: set[UUID] = set()
+    remaining = {
+        s.id: (s.source_text_id, s.content) for s in snippets if s.id not in reused_ids
+    }
+    if remaining and settings.ingestion_near_duplicate_distance:
+        async with db_session_factory.begin() as session:
+            duplicates = await collapse_near_duplicates(
+                session, remaining, model, settings.ingestion_near_duplicate_distance
+            )
+        duplicate_ids = set(duplicates)
+        if duplicate_ids and on_saved:
+            await on_saved(len(duplicate_ids))
+
+    snippets_by_hash: dict[str, list[SnippetToEmbed]] = defaultdict(list)
+    for snippet in snippets:
+        if snippet.id not in reused_ids and snippet.id not in duplicate_ids:
+            snippets_by_hash[snippet.content_hash].append(snippet)
+    snippet_groups = list(snippets_by_hash.values())
+
+    async def save_batch(indices: list[int], embeddings: list[list[float]]) -> None:
+        rows = [
+            embedding_row(model, snippet.id, embedding)
+            for i, embedding in zip(indices, embeddings)
+            for snippet in snippet_groups[i]
+        ]
+        async with db_session_factory.begin() as session:
+            await write_rows(
+                settings,
+                session,
+                embedding_table(model).__table__,  # type: ignore[union-attr]
+                rows,
+            )
+        if on_saved:
+            await on_saved(len(rows))
+
+    result = await embed_documents(
+        settings,
+        drallam_client,
+        [group[0].content for group in snippet_groups],
+        on_batch=save_batch,
+        model=model,
+        rate_limit=rate_limit,
+    )
+    created_count = sum(len(snippet_groups[i]) for i in result.embeddings)
+    failed_count = sum(len(snippet_groups[i]) for i in result.failed_indices)
+    return EmbeddingsCreated(
+        created_count=created_count + len(reused_ids),
+        reused_count=len(reused_ids),
+        failed_count=failed_count,
+        near_duplicate_count=len(duplicate_ids),
+    )
+
+
+async def embed_source_text(
+    settings: Settings,
+    db_session_factory: async_sessionmaker,
+    drallam_client: httpx.AsyncClient,
+    source_text_id: UUID,
+    on_progress: OnProgress | None = None,
+    model: EmbeddingModel | None = None,
+) -> EmbeddingsCreated:
+    """
+    Generate embeddings for each Snippet of a SourceText that does not have one yet
+    from `model`, by default `Settings.embedding_model`.
+    Snippets whose content has already been embedded, for this or any other
+    SourceText, reuse the existing embedding. Embeddings are requested concurrently in
+    batches and each batch is saved as soon as it completes, so a failed request does
+    not discard the others and a repeat only embeds what is still missing.
+
+    Raises `EmbeddingError` if no Snippets could be embedded.
+    """
+    await _get_source_text(db_session_factory, source_text_id)
+    model = model or settings.embedding_model
+
+    session: AsyncSession
+    async with db_session_factory.begin() as session:
+        snippets_status = await find_snippets_with_embedding_status(
+            session, source_text_id, model
+        )
+    if not snippets_status:
+        raise NoSnippetsError(
+            f"could not find any snippets associated with SourceText[id={source_text_id}]"
+        )
+    missing = [
+        SnippetToEmbed(
+            snippet.id, snippet.source_text_id, snippet.content, snippet.content_hash
+        )
+        for snippet, is_embedded in snippets_status
+        if not is_embedded
+    ]
+
+    done_count = len(snippets_status) - len(missing)
+    if on_progress:
+        await on_progress(done_count, len(snippets_status))
+
+    async def on_saved(count: int) -> None:
+        nonlocal done_count
+        done_count += count
+        if on_progress:
+            await on_progress(done_count, len(snippets_status))
+
+    created = await embed_snippets(
+        settings, db_session_factory, drallam_client, missing, model, on_saved
+    )
+    if created.failed_count and created.created_count == created.reused_count:
+        raise EmbeddingError(
+            f"could not generate embeddings for any snippets associated with "
+            f"SourceText[id={source_text_id}]"
+        )
+    return created
+
+
+class PipelinedIngestionResult(IngestionResult):
+    embeddings: EmbeddingsCreated
+    # from the start of ingestion until the first embeddings were committed
+    first_searchable_ms: float | None = None
+
+
+async def ingest_and_embed_stream(
+    settings: Settings,
+    db_session_factory: async_sessionmaker,
+    drallam_client: httpx.AsyncClient,
+    source_text_meta: SourceTextBase,
+    byte_chunks: AsyncIterable[bytes],
+    model: EmbeddingModel | None = None,
+) -> PipelinedIngestionResult:
+    """
+    Save a SourceText streamed in `byte_chunks`, split it into Snippets and embed them
+    in a single pass. `source_text_meta.content` is ignored.
+
+    Chunks are saved as Snippets in batches of `ingestion_pipeline_batch_size` as they
+    are produced, and each batch is handed to one of `ingestion_pipeline_embedders`
+    consumers that embed and save it, while the rest of the document is still being
+    received and chunked. The first Snippets are therefore searchable long before the
+    last one is chunked. Chunking waits whenever every consumer is busy and a batch is
+    already queued, so memory use does not grow with the size of the document.
+
+    Unlike `ingest_source_text_stream` every batch is committed as it completes, so an
+    interrupted ingestion leaves a partial SourceText behind, without content as that
+    is saved once it has all been received. `embed_source_text` embeds any of its
+    Snippets that are still missing.
+    """
+    embedding_model = model or settings.embedding_model
+    start = time.perf_counter()
+    character_count = 0
+    snippet_count = 0
+    embedded = EmbeddingsCreated(created_count=0)
+    first_searchable_ms: float | None = None
+    source_text_id = await _create_source_text(db_session_factory, source_text_meta)
+    spool = _content_spool(settings)
+
+    queue: asyncio.Queue[list[SnippetToEmbed] | None] = asyncio.Queue(maxsize=1)
+
+    async def save_snippets(chunks: list[str]) -> None:
+        nonlocal snippet_count
+        snippets = [
+            SnippetToEmbed(uuid4(), source_text_id, chunk, hash_content(chunk))
+            for chunk in chunks
+        ]
+        rows = [snippet._asdict() for snippet in snippets]
+        async with db_session_factory.begin() as session:
+            inserted_ids = set(
+                await write_rows(settings, session, Snippet.__table__, rows)  # type: ignore[attr-defined]
+            )
+        snippet_count += len(inserted_ids)
+        # a chunk repeating an earlier one was saved & queued with the earlier batch
+        inserted = [snippet for snippet in snippets if snippet.id in inserted_ids]
+        if inserted:
+            await queue.put(inserted)
+
+    async def produce() -> None:
+        nonlocal character_count
+        chunker = get_chunker(settings, source_text_meta.chunker)
+        pending_chunks: list[str] = []
+        text_chunks = _spool_content(decode_stream(byte_chunks), spool)
+        async for chunk in chunker.achunk(text_chunks):
+            pending_chunks.append(chunk)
+            if len(pending_chunks) >= settings.ingestion_pipeline_batch_size:
+                await save_snippets(pending_chunks)
+                pending_chunks = []
+        if pending_chunks:
+            await save_snippets(pending_chunks)
+        async with db_session_factory.begin() as session:
+            character_count = await _save_content(
+                settings, session, source_text_id, spool
+            )
+        for _ in range(settings.ingestion_pipeline_embedders):
+            await queue.put(None)
+
+    async def on_saved(count: int) -> None:
+        nonlocal first_searchable_ms
+        if first_searchable_ms is None:
+            first_searchable_ms = (time.perf_counter() - start) * 1000
+
+    async def consume() -> None:
+        while (snippets := await queue.get()) is not None:
+            created = await embed_snippets(
+                settings,
+                db_session_factory,
+                drallam_client,
+                snippets,
+                embedding_model,
+                on_saved,
+            )
+            embedded.created_count += created.created_count
+            embedded.reused_count += created.reused_count
+            embedded.failed_count += created.failed_count
+            embedded.near_duplicate_count += created.near_duplicate_count
+
+    tasks = [asyncio.create_task(produce())] + [
+        asyncio.create_task(consume())
+        for _ in range(settings.ingestion_pipeline_embedders)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # if any stage failed the others must not be left waiting on the queue
+        for task in tasks:
+            task.cancel()
+        spool.close()
+
+    return PipelinedIngestionResult(
+        source_text_id=source_text_id,
+        snippet_count=snippet_count,
+        character_count=character_count,
+        embeddings=embedded,
+        first_searchable_ms=first_searchable_ms,
+    )
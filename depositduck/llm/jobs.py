@@ -0,0 +1,252 @@
+"""
+Durable queue of background jobs, stored in the `llm__job` table.
+
+Any number of worker processes claim jobs concurrently: `SELECT ... FOR UPDATE SKIP
+LOCKED` hands each queued job to exactly one of them without blocking the others.
+Failed jobs are retried with exponential backoff until `max_attempts` is reached.
+A job is only queued once while unfinished: a unique index on its kind and
+`dedupe_key`, a hash of its payload, covers queued and running jobs. Kinds listed in
+`DEDUPE_FIELDS` hash only those fields, eg. one backfill per model whatever its options.
+Running jobs send a heartbeat so those abandoned by a worker that died are claimed
+again once their heartbeat goes stale.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+import json
+import random
+from datetime import timedelta
+
+from sqlalchemy import and_, or_, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import func
+
+from depositduck.models.llm import JobKind, JobStatus, hash_content
+from depositduck.models.sql.llm import Job
+from depositduck.settings import Settings
+
+UNFINISHED = (JobStatus.QUEUED, JobStatus.RUNNING)
+# payload fields that identify a job of these kinds, instead of the whole payload
+DEDUPE_FIELDS: dict[JobKind, tuple[str, ...]] = {
+    # backfills of a model share its checkpoint, so must not run side by side
+    JobKind.EMBEDDINGS_BACKFILL: ("llm_name",),
+}
+
+
+class JobPayloadError(ValueError):
+    """
+    Raised by a job handler when the payload of its job is malformed.
+    """
+
+
+class JobInterruptedError(Exception):
+    """
+    Raised by a job handler that stopped before finishing, eg. because its worker is
+    stopping, for the job to be queued again. With `payload`, to run with that instead.
+    """
+
+    def __init__(self, message: str, payload: dict | None = None) -> None:
+        super().__init__(message)
+        self.payload = payload
+
+
+def dedupe_key(payload: dict) -> str:
+    return hash_content(json.dumps(payload, sort_keys=True))
+
+
+def retry_delay(settings: Settings, attempts: int) -> float:
+    """
+    Seconds to wait before retrying a job that has failed `attempts` times.
+    Doubles with each attempt, up to `job_retry_backoff_max`, with jitter so jobs
+    that failed together are not all retried at the same moment.
+    """
+    delay = settings.job_retry_backoff * 2 ** max(attempts - 1, 0)
+    delay = min(delay, settings.job_retry_backoff_max)
+    return random.uniform(delay / 2, delay)  # nosec B311
+
+
+async def enqueue_job(
+    session: AsyncSession, settings: Settings, kind: JobKind, payload: dict
+) -> Job:
+    """
+    Queue a job, unless an identical job is already queued or running in which case
+    that one is returned instead.
+    """
+    fields = DEDUPE_FIELDS.get(kind)
+    key = dedupe_key({f: payload.get(f) for f in fields} if fields else payload)
+    while True:
+        result = await session.execute(
+            insert(Job)
+            .values(
+                kind=kind,
+                payload=payload,
+                dedupe_key=key,
+                max_attempts=settings.job_max_attempts,
+            )
+            .on_conflict_do_nothing(
+                index_elements=["kind", "dedupe_key"],
+                index_where=text("status IN ('queued', 'running')"),
+            )
+            .returning(Job)
+        )
+        if (job := result.scalar_one_or_none()) is not None:
+            return job
+        result = await session.execute(
+            select(Job).where(
+                Job.kind == kind,  # type: ignore[arg-type]
+                Job.dedupe_key == key,  # type: ignore[arg-type]
+                Job.status.in_(UNFINISHED),  # type: ignore[attr-defined]
+            )
+        )
+        if (job := result.scalar_one_or_none()) is not None:
+            return job
+        # the identical job finished in between, so queue another
+
+
+async def claim_job(
+    session: AsyncSession, settings: Settings, worker_id: str
+) -> Job | None:
+    """
+    Mark the next job that is due, or whose worker has stopped responding, as running
+    on `worker_id`. Returns `None` if there is nothing to do.
+    """
+    stale_before = func.now() - timedelta(seconds=settings.job_stale_after)
+    claimable = (
+        select(Job.id)
+        .where(
+            or_(
+                and_(Job.status == JobStatus.QUEUED, Job.run_after <= func.now()),  # type: ignore[arg-type]
+                and_(
+                    Job.status == JobStatus.RUNNING,  # type: ignore[arg-type]
+                    Job.heartbeat_at < stale_before,  # type: ignore[arg-type,operator]
+                    Job.attempts < Job.max_attempts,  # type: ignore[arg-type]
+                ),
+            )
+        )
+        .order_by(Job.run_after)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    result = await session.execute(
+        update(Job)
+        .where(Job.id == claimable)  # type: ignore[arg-type]
+        .values(
+            status=JobStatus.RUNNING,
+            attempts=Job.attempts + 1,
+            worker_id=worker_id,
+            started_at=func.now(),
+            heartbeat_at=func.now(),
+        )
+        .returning(Job)
+        .execution_options(synchronize_session=False)
+    )
+    return result.scalar_one_or_none()
+
+
+async def fail_abandoned_jobs(session: AsyncSession, settings: Settings) -> int:
+    """
+    Give up on running jobs with a stale heartbeat that have no attempts left.
+    """
+    stale_before = func.now() - timedelta(seconds=settings.job_stale_after)
+    result = await session.execute(
+        update(Job)
+        .where(
+            Job.status == JobStatus.RUNNING,  # type: ignore[arg-type]
+            Job.heartbeat_at < stale_before,  # type: ignore[arg-type,operator]
+            Job.attempts >= Job.max_attempts,  # type: ignore[arg-type]
+        )
+        .values(
+            status=JobStatus.FAILED,
+            finished_at=func.now(),
+            last_error="worker stopped responding",
+        )
+    )
+    return result.rowcount
+
+
+def _is_running_on(job: Job, worker_id: str):
+    # a worker that lost its job to another after a stale heartbeat must not update it
+    return and_(
+        Job.id == job.id,  # type: ignore[arg-type]
+        Job.status == JobStatus.RUNNING,  # type: ignore[arg-type]
+        Job.worker_id == worker_id,  # type: ignore[arg-type]
+    )
+
+
+async def heartbeat(
+    session: AsyncSession,
+    job: Job,
+    worker_id: str,
+    progress_done: int | None = None,
+    progress_total: int | None = None,
+) -> None:
+    values: dict = dict(heartbeat_at=func.now())
+    if progress_done is not None:
+        values.update(progress_done=progress_done, progress_total=progress_total)
+    await session.execute(
+        update(Job).where(_is_running_on(job, worker_id)).values(**values)
+    )
+
+
+async def complete_job(
+    session: AsyncSession, job: Job, worker_id: str, result: dict
+) -> None:
+    await session.execute(
+        update(Job)
+        .where(_is_running_on(job, worker_id))
+        .values(
+            status=JobStatus.SUCCEEDED,
+            result=result,
+            finished_at=func.now(),
+            last_error=None,
+        )
+    )
+
+
+async def requeue_job(
+    session: AsyncSession, job: Job, worker_id: str, payload: dict | None = None
+) -> None:
+    """
+    Queue an interrupted job to run again straight away, with `payload` if given. The
+    interrupted run does not count as an attempt.
+    """
+    values: dict = dict(
+        status=JobStatus.QUEUED,
+        attempts=Job.attempts - 1,
+        run_after=func.now(),
+        worker_id=None,
+    )
+    if payload is not None:
+        values.update(payload=payload)
+    await session.execute(
+        update(Job).where(_is_running_on(job, worker_id)).values(**values)
+    )
+
+
+async def fail_job(
+    session: AsyncSession,
+    settings: Settings,
+    job: Job,
+    worker_id: str,
+    error: str,
+    retry: bool = True,
+) -> JobStatus:
+    """
+    Record a failed attempt. The job is queued to run again after a backoff delay,
+    unless `retry` is false or it has no attempts left.
+    Returns the job's new status.
+    """
+    if retry and job.attempts < job.max_attempts:
+        delay = timedelta(seconds=retry_delay(settings, job.attempts))
+        status = JobStatus.QUEUED
+        values = dict(status=status, run_after=func.now() + delay, worker_id=None)
+    else:
+        status = JobStatus.FAILED
+        values = dict(status=status, finished_at=func.now())
+    values.update(last_error=error)
+    await session.execute(
+        update(Job).where(_is_running_on(job, worker_id)).values(**values)
+    )
+    return status
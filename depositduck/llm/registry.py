@@ -0,0 +1,74 @@
+"""
+Where the embeddings of each registered model are stored, so that several models can
+embed the same Snippets side by side.
+
+nomic-embed-text keeps its own `llm__embedding_nomic` table, whose indexes are tuned by
+the `VECTOR_*` settings. Embeddings from every other model in `EMBEDDING_MODELS` share
+`llm__embedding`: its vectors are dimensionless and each model's are indexed by a
+partial index over `vector::vector(<dimensions>)`, so registering a model needs a new
+index but no new table.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Any
+from uuid import UUID
+
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import ColumnElement, FromClause, cast, literal, select
+
+from depositduck.llm.embeddings import truncate_embedding
+from depositduck.models.llm import NOMIC, NOMIC_COARSE_DIMENSIONS, EmbeddingModel
+from depositduck.models.sql.llm import Embedding, EmbeddingNomic
+
+
+def embedding_table(model: EmbeddingModel) -> type[EmbeddingNomic] | type[Embedding]:
+    return EmbeddingNomic if model == NOMIC else Embedding
+
+
+def embeddings_of(model: EmbeddingModel) -> FromClause:
+    """
+    `(id, snippet_id, vector)` of every embedding generated by `model`. Other models'
+    vectors are cast to their dimensions so that queries match their partial index.
+    The model's tag is rendered into the SQL rather than bound as a parameter, as the
+    planner can't use a partial index for a generic plan of a prepared statement whose
+    predicate is a parameter.
+    """
+    if model == NOMIC:
+        return EmbeddingNomic.__table__  # type: ignore[attr-defined]
+    vector = cast(Embedding.vector, Vector(model.dimensions))
+    return (
+        select(Embedding.id, Embedding.snippet_id, vector.label("vector"))
+        .where(Embedding.llm_name == literal(model.tag, literal_execute=True))  # type: ignore[arg-type]
+        .subquery("embeddings")
+    )
+
+
+def embedding_row(
+    model: EmbeddingModel, snippet_id: UUID, vector: list[float]
+) -> dict[str, Any]:
+    """
+    Values to insert into `embedding_table(model)` for a new embedding.
+    """
+    if model == NOMIC:
+        return {
+            "snippet_id": snippet_id,
+            "vector": vector,
+            "vector_coarse": truncate_embedding(vector, NOMIC_COARSE_DIMENSIONS),
+        }
+    return {"snippet_id": snippet_id, "llm_name": model.tag, "vector": vector}
+
+
+def copied_embedding_columns(
+    model: EmbeddingModel, embeddings: FromClause
+) -> dict[str, ColumnElement]:
+    """
+    Columns to insert into `embedding_table(model)` when copying an existing embedding
+    selected from `embeddings_of(model)`, other than `snippet_id`.
+    """
+    if model == NOMIC:
+        return {
+            "vector": embeddings.c.vector,
+            "vector_coarse": embeddings.c.vector_coarse,
+        }
+    return {"llm_name": literal(model.tag), "vector": embeddings.c.vector}
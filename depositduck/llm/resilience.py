@@ -0,0 +1,228 @@
+"""
+Keep requests to draLLaM from stalling callers when it is slow or unavailable.
+
+Each pooled draLLaM client has a `DrallamGuard` tracking the latency of its requests
+and whether they succeed. The guard provides:
+- a circuit breaker: after `drallam_circuit_failure_threshold` consecutive failures
+  requests are refused outright for `drallam_circuit_reset_after` seconds, then a
+  single probe request decides whether to resume.
+- the p95 latency of recent successful requests, used as the delay before sending a
+  hedged (duplicate) request, see `depositduck.llm.embeddings`.
+- latency histograms for each request outcome, reported by `/llm/stats`.
+
+Work that must leave draLLaM to others, eg. a backfill, paces its requests with a
+`TokenBucket`.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+import asyncio
+import statistics
+import time
+from bisect import bisect_left
+from collections import deque
+from enum import Enum
+from weakref import WeakKeyDictionary
+
+import httpx
+from pydantic import BaseModel
+
+from depositduck.settings import Settings
+
+# upper bounds of the latency histogram buckets, a final bucket holds anything slower
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# successful requests whose latency is used to estimate the p95
+LATENCY_WINDOW = 200
+# requests are not hedged until this many latencies are known
+HEDGE_MIN_SAMPLES = 20
+
+
+class Outcome(str, Enum):
+    OK = "ok"
+    # draLLaM responded with an error or could not be reached
+    ERROR = "error"
+    TIMEOUT = "timeout"
+    # refused without a request because the circuit breaker is open
+    REJECTED = "rejected"
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    # a probe request is allowed through to check whether draLLaM has recovered
+    HALF_OPEN = "half_open"
+
+
+class LatencyHistogramStats(BaseModel):
+    # cumulative count of requests at or below each bucket's upper bound in ms
+    buckets: dict[str, int]
+    count: int
+    sum_ms: float
+
+
+class LatencyHistogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.sum_ms = 0.0
+
+    def observe(self, latency_ms: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS_MS, latency_ms)] += 1
+        self.sum_ms += latency_ms
+
+    def stats(self) -> LatencyHistogramStats:
+        buckets, cumulative = {}, 0
+        for bound, count in zip([*map(str, LATENCY_BUCKETS_MS), "+Inf"], self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return LatencyHistogramStats(
+            buckets=buckets, count=cumulative, sum_ms=round(self.sum_ms, 3)
+        )
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_after: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.state = CircuitState.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        """
+        Whether a request may be sent now. Only one probe is let through at a time
+        once the circuit has been open for `reset_after` seconds.
+        """
+        if self.state == CircuitState.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_after:
+                return False
+            self.state = CircuitState.HALF_OPEN
+        if self.state == CircuitState.HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+
+    def record_success(self) -> None:
+        self.state = CircuitState.CLOSED
+        self.consecutive_failures = 0
+        self.probing = False
+
+    def abandon(self) -> None:
+        """
+        A request was cancelled before its outcome was known, let another probe through.
+        """
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if (
+            self.state == CircuitState.HALF_OPEN
+            or self.consecutive_failures >= self.failure_threshold
+        ):
+            self.state = CircuitState.OPEN
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+
+class TokenBucket:
+    """
+    Paces work to `rate` units a second. Each unit waits for a token, and tokens
+    accrue at `rate` a second up to one second's worth, starting from none so that
+    the rate holds from the first request.
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self._tokens = 0.0
+        self._updated_at = time.monotonic()
+        # waiters are served in turn, so a large request is not starved by small ones
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, units: int = 1) -> None:
+        """
+        Wait until `units` may proceed. More units than the bucket holds wait for a
+        full bucket and leave it in debt, which later units wait to pay off.
+        """
+        wanted = min(float(units), self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                elapsed = now - self._updated_at
+                self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+                self._updated_at = now
+                if self._tokens >= wanted:
+                    self._tokens -= units
+                    return
+                await asyncio.sleep((wanted - self._tokens) / self.rate)
+
+
+class DrallamRequestStats(BaseModel):
+    circuit_state: CircuitState
+    consecutive_failures: int
+    retried_count: int
+    hedged_count: int
+    # of recent successful requests, None until enough are known
+    p95_ms: float | None = None
+    latency_ms: dict[Outcome, LatencyHistogramStats]
+
+
+class DrallamGuard:
+    def __init__(self, settings: Settings) -> None:
+        self.settings = settings
+        self.breaker = CircuitBreaker(
+            settings.drallam_circuit_failure_threshold,
+            settings.drallam_circuit_reset_after,
+        )
+        self.histograms = {outcome: LatencyHistogram() for outcome in Outcome}
+        self.recent_ms: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.retried_count = 0
+        self.hedged_count = 0
+
+    def observe(self, outcome: Outcome, latency_ms: float) -> None:
+        self.histograms[outcome].observe(latency_ms)
+        if outcome == Outcome.OK:
+            self.recent_ms.append(latency_ms)
+
+    def p95_ms(self) -> float | None:
+        if len(self.recent_ms) < HEDGE_MIN_SAMPLES:
+            return None
+        return statistics.quantiles(self.recent_ms, n=20)[-1]
+
+    def hedge_delay(self) -> float | None:
+        """
+        Seconds to wait for a response before sending a hedged request, if enabled.
+        """
+        if not self.settings.drallam_embeddings_hedge:
+            return None
+        p95_ms = self.p95_ms()
+        return p95_ms / 1000 if p95_ms is not None else None
+
+    def stats(self) -> DrallamRequestStats:
+        p95_ms = self.p95_ms()
+        return DrallamRequestStats(
+            circuit_state=self.breaker.state,
+            consecutive_failures=self.breaker.consecutive_failures,
+            retried_count=self.retried_count,
+            hedged_count=self.hedged_count,
+            p95_ms=round(p95_ms, 3) if p95_ms is not None else None,
+            latency_ms={
+                outcome: histogram.stats()
+                for outcome, histogram in self.histograms.items()
+            },
+        )
+
+
+_GUARDS: WeakKeyDictionary[httpx.AsyncClient, DrallamGuard] = WeakKeyDictionary()
+
+
+def get_drallam_guard(settings: Settings, client: httpx.AsyncClient) -> DrallamGuard:
+    """
+    The guard shared by every request made through `client`, which in the app is the
+    pooled client created by its lifespan, so state lasts as long as the pool.
+    """
+    guard = _GUARDS.get(client)
+    if guard is None:
+        guard = _GUARDS[client] = DrallamGuard(settings)
+    return guard
@@ -2,28 +2,93 @@
 (c) 2024 Alberto Morón Hernández
 """
 
-import re
-from typing import Any, Iterable, Type, cast
+from datetime import datetime
+from typing import Any, Type
 from uuid import UUID
 
 import httpx
-from fastapi import APIRouter, Depends, HTTPException, Query, status
-from sqlalchemy import insert, select
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from pydantic import BaseModel
+from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError, MultipleResultsFound, NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
-from sqlalchemy.orm import selectinload
 from typing_extensions import Annotated
 
-from depositduck.dependables import db_session_factory, get_drallam_client, get_settings
-from depositduck.llm.embeddings import embed_document
-from depositduck.models.common import EntityById, TwoOhOneCreatedCount
-from depositduck.models.llm import NOMIC, EmbeddingBase, SnippetBase
-from depositduck.models.sql.llm import EmbeddingNomic, Snippet, SourceText
+from depositduck.dependables import (
+    db_session_factory,
+    get_drallam_client,
+    get_logger,
+    get_settings,
+)
+from depositduck.llm.cache import (
+    CacheStats,
+    QueryEmbeddingCache,
+    SearchResultCache,
+    search_result_key,
+)
+from depositduck.llm.dependables import (
+    get_query_embedding_cache,
+    get_search_result_cache,
+)
+from depositduck.llm.diversity import diversify
+from depositduck.llm.drallam import DrallamPoolStats, get_pool_stats
+from depositduck.llm.embeddings import (
+    EmbeddingError,
+    drallam_model_tag,
+    embed_queries,
+    embed_query,
+)
+from depositduck.llm.ingestion import (
+    ingest_and_embed_stream,
+    ingest_source_text_stream,
+)
+from depositduck.llm.jobs import enqueue_job
+from depositduck.llm.registry import embeddings_of
+from depositduck.llm.resilience import DrallamRequestStats, get_drallam_guard
+from depositduck.llm.search import (
+    batch_hybrid_search,
+    choose_filter_strategy,
+    fuse_results,
+    get_corpus_generation,
+    hybrid_search,
+    set_search_params,
+)
+from depositduck.models.common import EntityById
+from depositduck.models.dto.llm import (
+    BatchSearchQuery,
+    BatchSearchResults,
+    EmbeddingModelRead,
+    JobRead,
+    QuerySnippets,
+    RelevantSnippet,
+    SnippetFilters,
+    SourceTextIngested,
+    SourceTextUploaded,
+)
+from depositduck.models.llm import (
+    EMBEDDING_MODELS,
+    NOMIC,
+    ChunkerName,
+    EmbeddingModel,
+    JobKind,
+    SourceTextBase,
+    get_embedding_model,
+)
+from depositduck.models.sql.llm import Job, SourceText
 from depositduck.settings import Settings
 
+LOG = get_logger()
+
 llm_router = APIRouter()
 
 
+class LLMStats(BaseModel):
+    drallam_pool: DrallamPoolStats
+    drallam_requests: DrallamRequestStats
+    query_embedding_cache: CacheStats | None = None
+    search_result_cache: CacheStats | None = None
+
+
 async def find_by_id(db_session: AsyncSession, T: Type[Any], id: UUID) -> SourceText:
     try:
         result = await db_session.execute(select(T).filter_by(id=id))
@@ -45,154 +110,558 @@ async def find_by_id(db_session: AsyncSession, T: Type[Any], id: UUID) -> Source
 
 
 @llm_router.post(
-    "/snippets/fromSourceText",
-    summary="Generate Snippets from a SourceText",
+    "/sourceTexts/upload",
+    summary="Stream a text document into a new SourceText and its Snippets",
     status_code=status.HTTP_201_CREATED,
-    response_model=TwoOhOneCreatedCount,
+    response_model=SourceTextUploaded,
 )
-async def snippets_from_sourcetext(
-    source_text_by_id: EntityById,
+async def upload_source_text(
+    request: Request,
+    settings: Annotated[Settings, Depends(get_settings)],
     db_session_factory: Annotated[async_sessionmaker, Depends(db_session_factory)],
+    name: str = Query(..., title="name", description="name of the SourceText"),
+    description: str = Query("", title="description", description=""),
+    filename: str | None = Query(None, title="filename", description=""),
+    url: str | None = Query(None, title="url", description=""),
+    chunker: ChunkerName | None = Query(
+        None, title="chunker", description="how to split the SourceText into Snippets"
+    ),
+    tags: list[str] = Query([], title="tags", description="labels to filter search by"),
 ):
     """
-    Given a SourceText in the database, split it and save as Snippet records.
+    Save the UTF-8 text in the request body as a SourceText and split it into Snippets
+    as it arrives. The body may be sent with chunked transfer encoding and is never
+    held in memory in its entirety, eg. `curl -T document.txt <url>?name=Example`
 
     _Arguments:_
-    - **id (UUID)**: the id of a SourceText record in the database
+    - **name (str)**: name of the SourceText
+    - **description (Optional[str])**
+    - **filename (Optional[str])**
+    - **url (Optional[str])**
+    - **chunker (Optional[ChunkerName])**: defaults to the `CHUNKER` setting
+    - **tags (Optional[list[str]])**: labels to restrict relevance search by, repeated
+      as `tags=tds&tags=guidance`
 
     _Returns:_
-    - a count of how many Snippet records were saved to the database
+    - **id (UUID)**: the id of the new SourceText
+    - **created_count (int)**: a count of how many Snippet records were saved
     """
-    session: AsyncSession
+    source_text_meta = SourceTextBase(
+        name=name,
+        description=description,
+        filename=filename,
+        url=url,
+        content="",
+        chunker=chunker,
+        tags=tags,
+    )
     try:
-        async with db_session_factory.begin() as session:
-            source_text: SourceText = await find_by_id(
-                session, SourceText, source_text_by_id.id
-            )
-    except HTTPException:
-        raise
+        result = await ingest_source_text_stream(
+            settings, db_session_factory, source_text_meta, request.stream()
+        )
+    except IntegrityError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e._message))
+
+    return SourceTextUploaded(
+        id=result.source_text_id, created_count=result.snippet_count
+    )
+
+
+@llm_router.post(
+    "/sourceTexts/uploadAndEmbed",
+    summary="Stream a text document into a new SourceText, its Snippets & embeddings",
+    status_code=status.HTTP_201_CREATED,
+    response_model=SourceTextIngested,
+)
+async def upload_and_embed_source_text(
+    request: Request,
+    settings: Annotated[Settings, Depends(get_settings)],
+    db_session_factory: Annotated[async_sessionmaker, Depends(db_session_factory)],
+    drallam_client: Annotated[httpx.AsyncClient, Depends(get_drallam_client)],
+    name: str = Query(..., title="name", description="name of the SourceText"),
+    description: str = Query("", title="description", description=""),
+    filename: str | None = Query(None, title="filename", description=""),
+    url: str | None = Query(None, title="url", description=""),
+    chunker: ChunkerName | None = Query(
+        None, title="chunker", description="how to split the SourceText into Snippets"
+    ),
+    tags: list[str] = Query([], title="tags", description="labels to filter search by"),
+    model: str | None = Query(
+        None, title="model", description="tag of the embedding model to use"
+    ),
+):
+    """
+    Like `/sourceTexts/upload`, but also embeds Snippets while the document is still
+    arriving. Snippets & embeddings are committed in batches, so the first Snippets
+    are searchable before the upload completes.
 
-    # split on two or more consecutive newlines, removing empty strings
-    paragraphs = [p for p in re.split(r"\n{2,}", source_text.content) if p]
+    _Arguments:_ as `/sourceTexts/upload`, plus
+    - **model (Optional[str])**: defaults to the `DRALLAM_EMBEDDINGS_MODEL` setting
 
+    _Returns:_
+    - **id (UUID)**: the id of the new SourceText
+    - **created_count (int)**: a count of how many Snippet records were saved
+    - **embeddings (EmbeddingsCreated)**: counts of embeddings created, reused & failed
+    - **first_searchable_ms (Optional[float])**: time until the first were saved
+    """
+    embedding_model = resolve_embedding_model(settings, model)
+    source_text_meta = SourceTextBase(
+        name=name,
+        description=description,
+        filename=filename,
+        url=url,
+        content="",
+        chunker=chunker,
+        tags=tags,
+    )
     try:
-        async with db_session_factory.begin() as session:
-            await session.execute(
-                insert(Snippet),
-                [
-                    SnippetBase(
-                        content=paragraph.strip(), source_text_id=source_text.id
-                    ).model_dump()
-                    for paragraph in paragraphs
-                ],
-            )
+        result = await ingest_and_embed_stream(
+            settings,
+            db_session_factory,
+            drallam_client,
+            source_text_meta,
+            request.stream(),
+            embedding_model,
+        )
     except IntegrityError as e:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e._message))
 
-    return TwoOhOneCreatedCount(created_count=len(paragraphs))
+    return SourceTextIngested(
+        id=result.source_text_id,
+        created_count=result.snippet_count,
+        embeddings=result.embeddings,
+        first_searchable_ms=result.first_searchable_ms,
+    )
+
+
+def resolve_embedding_model(settings: Settings, tag: str | None) -> EmbeddingModel:
+    if tag is None:
+        return settings.embedding_model
+    try:
+        return get_embedding_model(tag)
+    except LookupError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
+
+
+def text_search_fallback(settings: Settings, error: EmbeddingError) -> None:
+    """
+    Search by text alone when the query could not be embedded, eg. while draLLaM is
+    unavailable. Raises a 503 if full-text search is disabled.
+    """
+    if not settings.search_text_weight:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(error)
+        )
+    LOG.warn(f"searching by text only, could not embed query: {error}")
+
+
+async def queue_source_text_job(
+    settings: Settings,
+    db_session_factory: async_sessionmaker,
+    kind: JobKind,
+    source_text_id: UUID,
+    payload: dict | None = None,
+) -> JobRead:
+    session: AsyncSession
+    async with db_session_factory.begin() as session:
+        await find_by_id(session, SourceText, source_text_id)
+        job = await enqueue_job(
+            session,
+            settings,
+            kind,
+            {"source_text_id": str(source_text_id), **(payload or {})},
+        )
+    return JobRead.model_validate(job)
+
+
+@llm_router.post(
+    "/snippets/fromSourceText",
+    summary="Queue a job to generate Snippets from a SourceText",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=JobRead,
+)
+async def snippets_from_sourcetext(
+    source_text_by_id: EntityById,
+    settings: Annotated[Settings, Depends(get_settings)],
+    db_session_factory: Annotated[async_sessionmaker, Depends(db_session_factory)],
+):
+    """
+    Given a SourceText in the database, queue a job to split it using its chunker and
+    save the chunks as Snippet records. Safe to repeat: chunks already saved for the
+    SourceText are skipped, and an identical job that is still queued or running is
+    returned instead of queueing another.
+
+    _Arguments:_
+    - **id (UUID)**: the id of a SourceText record in the database
+
+    _Returns:_
+    - the queued job, whose progress can be followed at `/jobs/{id}`. Once complete
+    its `result` has a count of how many Snippet records were saved to the database
+    """
+    return await queue_source_text_job(
+        settings,
+        db_session_factory,
+        JobKind.SNIPPETS_FROM_SOURCE_TEXT,
+        source_text_by_id.id,
+    )
 
 
 @llm_router.post(
     "/embeddings/fromSourceText",
-    summary="Generate embeddings for all Snippets associated with a SourceText",
-    status_code=status.HTTP_201_CREATED,
-    response_model=TwoOhOneCreatedCount,
+    summary="Queue a job to generate embeddings for the Snippets of a SourceText",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=JobRead,
 )
 async def embeddings_from_snippets(
     source_text_by_id: EntityById,
     settings: Annotated[Settings, Depends(get_settings)],
     db_session_factory: Annotated[async_sessionmaker, Depends(db_session_factory)],
-    drallam_client: Annotated[httpx.AsyncClient, Depends(get_drallam_client)],
+    model: str | None = Query(None, description="tag of a registered embedding model"),
 ):
     """
-    Given a SourceText that has been split into Snippets, generate embeddings for each
-    Snippet.
+    Given a SourceText that has been split into Snippets, queue a job to generate
+    embeddings for each Snippet that does not have one yet. Snippets whose content
+    has already been embedded, for this or any other SourceText, reuse the existing
+    embedding. The job is retried if some embeddings could not be generated.
 
     _Arguments:_
     - **id (UUID)**: the id of a SourceText record in the database
+    - **model (Optional[str])**: embedding model to use, if not the default
 
     _Returns:_
-    - **created_count (int)**: a count of how many Snippet records were saved to the
-    database
+    - the queued job, whose progress can be followed at `/jobs/{id}`. Once complete
+    its `result` has:
+      - **created_count (int)**: a count of how many embeddings were saved
+      - **reused_count (int)**: how many of those were copied from identical Snippets
+      - **failed_count (int)**: a count of Snippets that could not be embedded
     """
-    session: AsyncSession
-    try:
-        async with db_session_factory.begin() as session:
-            source_text: SourceText = await find_by_id(
-                session, SourceText, source_text_by_id.id
-            )
-    except HTTPException:
-        raise
+    return await queue_source_text_job(
+        settings,
+        db_session_factory,
+        JobKind.EMBEDDINGS_FROM_SOURCE_TEXT,
+        source_text_by_id.id,
+        {"llm_name": resolve_embedding_model(settings, model).tag},
+    )
 
+
+@llm_router.post(
+    "/embeddings/backfill",
+    summary="Queue a job to embed every Snippet missing an embedding from a model",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=JobRead,
+)
+async def embeddings_backfill(
+    settings: Annotated[Settings, Depends(get_settings)],
+    db_session_factory: Annotated[async_sessionmaker, Depends(db_session_factory)],
+    model: str = Query(..., description="tag of a registered embedding model"),
+    restart: bool = Query(False, description="start a new pass from the first Snippet"),
+):
+    """
+    Embed the whole corpus with a model, eg. one newly registered to compare against
+    the current model, which keeps serving searches meanwhile. The job walks every
+    Snippet missing an embedding from the model with `depositduck.llm.backfill`,
+    resuming from its checkpoint, so a backfill can be repeated to catch up.
+
+    _Arguments:_
+    - **model (str)**: tag of a registered embedding model, see `/embeddingModels`
+    - **restart (bool)**: ignore the checkpoint and start from the first Snippet
+
+    _Returns:_
+    - the queued job, whose progress can be followed at `/jobs/{id}`. Once complete
+    its `result` has counts of the embeddings created. A backfill of the model that is
+    already queued or running is returned instead, even if asked to `restart`
+    """
+    payload: dict = {"llm_name": resolve_embedding_model(settings, model).tag}
+    if restart:
+        payload["restart"] = True
+    session: AsyncSession
     async with db_session_factory.begin() as session:
-        snippets_query = await session.execute(
-            select(Snippet).filter_by(source_text_id=source_text.id)
-        )
-    snippets = [s[0] for s in cast(Iterable[tuple[Snippet]], snippets_query.all())]
-    if not snippets:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=(
-                f"could not find any snippets associated with SourceText"
-                f"[id={source_text_by_id.id}]"
-            ),
-        )
-    snippets_contents = [s.content for s in cast(Iterable[Snippet], snippets)]
+        job = await enqueue_job(session, settings, JobKind.EMBEDDINGS_BACKFILL, payload)
+    return JobRead.model_validate(job)
 
-    embeddings = [
-        await embed_document(settings, drallam_client, doc) for doc in snippets_contents
-    ]
 
+@llm_router.get(
+    "/embeddingModels",
+    summary="List the embedding models that can be used side by side",
+    response_model=list[EmbeddingModelRead],
+)
+async def list_embedding_models(
+    settings: Annotated[Settings, Depends(get_settings)],
+    db_session_factory: Annotated[async_sessionmaker, Depends(db_session_factory)],
+) -> list[EmbeddingModelRead]:
+    """
+    _Returns:_
+    - **list[EmbeddingModelRead]**: every registered model, whether it is the default
+      and how many Snippets it has embedded
+    """
+    models = []
+    session: AsyncSession
     async with db_session_factory.begin() as session:
-        await session.execute(
-            insert(EmbeddingNomic),
-            [
-                EmbeddingBase(
-                    snippet_id=snippet.id, llm_name=NOMIC.name, vector=embedding
-                ).model_dump()
-                for snippet, embedding in zip(snippets, embeddings)
-            ],
-        )
+        for model in EMBEDDING_MODELS.values():
+            embeddings = embeddings_of(model)
+            embedded_count = await session.scalar(
+                select(func.count()).select_from(embeddings)
+            )
+            models.append(
+                EmbeddingModelRead(
+                    tag=model.tag,
+                    dimensions=model.dimensions,
+                    distance=(
+                        settings.vector_distance if model == NOMIC else model.distance
+                    ),
+                    is_default=model == settings.embedding_model,
+                    embedded_count=embedded_count or 0,
+                )
+            )
+    return models
+
 
-    return TwoOhOneCreatedCount(created_count=len(embeddings))
+@llm_router.get(
+    "/jobs/{job_id}",
+    summary="Report on the status and progress of a background job",
+    response_model=JobRead,
+)
+async def get_job(
+    job_id: UUID,
+    db_session_factory: Annotated[async_sessionmaker, Depends(db_session_factory)],
+):
+    session: AsyncSession
+    async with db_session_factory.begin() as session:
+        job = await find_by_id(session, Job, job_id)
+    return JobRead.model_validate(job)
 
 
 @llm_router.get(
     "/snippets/relevantToQuery",
     summary="Return Snippets relevant to a user query",
-    response_model=list[str],
+    response_model=list[RelevantSnippet],
 )
 async def find_snippets_relevant_to_query(
     settings: Annotated[Settings, Depends(get_settings)],
     db_session_factory: Annotated[async_sessionmaker, Depends(db_session_factory)],
     drallam_client: Annotated[httpx.AsyncClient, Depends(get_drallam_client)],
+    query_embedding_cache: Annotated[
+        QueryEmbeddingCache | None, Depends(get_query_embedding_cache)
+    ],
+    search_result_cache: Annotated[
+        SearchResultCache | None, Depends(get_search_result_cache)
+    ],
     query: str = Query(..., title="query", description=""),
     max_snippets: int = Query(5, title="max", description=""),
-) -> list[str]:
+    rerank_candidates: int | None = Query(None, ge=1, le=2000),
+    model: str | None = Query(None, description="tag of a registered embedding model"),
+    source_text_id: list[UUID] | None = Query(None, description="search these only"),
+    tag: list[str] | None = Query(None, description="SourceTexts with any of these"),
+    created_after: datetime | None = Query(None),
+    created_before: datetime | None = Query(None),
+    current_only: bool = Query(False, description="exclude deleted SourceTexts"),
+    mmr_lambda: float | None = Query(
+        None, ge=0.0, le=1.0, description="re-rank for diversity, 1 is pure relevance"
+    ),
+    mmr_pool: int | None = Query(None, ge=1, le=200),
+) -> list[RelevantSnippet]:
     """
     Given a user query, return relevant records from the corpus of Snippets.
-    Performs a vector similarity search.
+    Fuses the results of vector similarity and full-text searches by reciprocal rank,
+    weighted by the `SEARCH_VECTOR_WEIGHT` & `SEARCH_TEXT_WEIGHT` settings.
+    Results are cached until Snippets or embeddings next change.
 
     _Arguments:_
     - **query (str)**: user query to find relevant Snippets for
     - **max_snippets (Optional[int])**: maximum relevant Snippets to return - maximum 10
+    - **rerank_candidates (Optional[int])**: with `VECTOR_QUANTISATION` enabled, how many
+      candidates from the quantised index to re-rank. More improves recall but is slower
+    - **model (Optional[str])**: embedding model to search with, if not the default.
+      Only Snippets it has embedded are found by vector search
+    - **source_text_id, tag, created_after, created_before, current_only**: only
+      search Snippets of SourceTexts matching all of these. `source_text_id` & `tag`
+      may be repeated
+    - **mmr_lambda (Optional[float])**: re-rank a larger pool of results by maximal
+      marginal relevance, trading relevance (1) for variety (0)
+    - **mmr_pool (Optional[int])**: results to re-rank, defaults to `SEARCH_MMR_POOL`
 
     _Returns:_
-    - **list[str]**: Snippets in order of decreasing relevance, up to a count of
-      max_snippets
+    - **list[RelevantSnippet]**: Snippet content, ids & scores in order of decreasing
+      relevance, up to a count of max_snippets
     """
     default_max_snippets = 10
     if max_snippets > default_max_snippets:
         max_snippets = default_max_snippets
 
-    query_embedding = await embed_document(settings, drallam_client, query)
+    embedding_model = resolve_embedding_model(settings, model)
+    filters = SnippetFilters(
+        source_text_ids=source_text_id,
+        tags=tag,
+        created_after=created_after,
+        created_before=created_before,
+        current_only=current_only,
+    )
+    cache_key, generation = None, 0
+    session: AsyncSession
+    if search_result_cache is not None:
+        cache_key = search_result_key(
+            settings,
+            drallam_model_tag(settings, embedding_model),
+            query,
+            max_snippets,
+            rerank_candidates,
+            filters.model_dump(mode="json", exclude_defaults=True),
+            mmr_lambda,
+            mmr_pool,
+        )
+        # read before searching, so results cached under it are never older than it
+        async with db_session_factory.begin() as session:
+            generation = await get_corpus_generation(session)
+        cached_snippets = await search_result_cache.get(cache_key, generation)
+        if cached_snippets is not None:
+            return cached_snippets
+
+    query_embedding = None
+    if settings.search_vector_weight:
+        try:
+            query_embedding = await embed_query(
+                settings, drallam_client, query_embedding_cache, query, embedding_model
+            )
+        except EmbeddingError as e:
+            text_search_fallback(settings, e)
+            # don't cache results that would have been different with vector search
+            cache_key = None
+
+    search_limit = max_snippets
+    if mmr_lambda is not None:
+        search_limit = max(mmr_pool or settings.search_mmr_pool, max_snippets)
+    async with db_session_factory.begin() as session:
+        filter_strategy = await choose_filter_strategy(session, settings, filters)
+        await set_search_params(session, settings, filter_strategy)
+        result = await session.execute(
+            hybrid_search(
+                settings,
+                query,
+                query_embedding,
+                search_limit,
+                rerank_candidates,
+                embedding_model,
+                filters,
+                filter_strategy,
+            )
+        )
+        snippets = [RelevantSnippet.model_validate(row._mapping) for row in result.all()]
+        if mmr_lambda is not None:
+            snippets = await diversify(
+                session, snippets, max_snippets, mmr_lambda, embedding_model
+            )
+    if search_result_cache is not None and cache_key is not None:
+        await search_result_cache.set(cache_key, generation, snippets)
+    return snippets
+
+
+@llm_router.post(
+    "/snippets/relevantToQueries",
+    summary="Return Snippets relevant to each of several user queries",
+    response_model=BatchSearchResults,
+)
+async def find_snippets_relevant_to_queries(
+    settings: Annotated[Settings, Depends(get_settings)],
+    db_session_factory: Annotated[async_sessionmaker, Depends(db_session_factory)],
+    drallam_client: Annotated[httpx.AsyncClient, Depends(get_drallam_client)],
+    query_embedding_cache: Annotated[
+        QueryEmbeddingCache | None, Depends(get_query_embedding_cache)
+    ],
+    batch: BatchSearchQuery,
+) -> BatchSearchResults:
+    """
+    Search for several user queries at once, eg. reformulations of the same question.
+    Queries are embedded together and searched in a single database query.
+
+    _Arguments:_
+    - **batch (BatchSearchQuery)**: queries to find relevant Snippets for, up to 10,
+      optionally restricted by `filters` as in `/snippets/relevantToQuery`
+
+    _Returns:_
+    - **BatchSearchResults**: Snippets relevant to each query, in order of decreasing
+      relevance. If `fuse` is set, also the results of every query merged into one
+      ranking by reciprocal rank.
+    """
+    embedding_model = resolve_embedding_model(settings, batch.model)
+    query_embeddings = None
+    if settings.search_vector_weight:
+        try:
+            query_embeddings = await embed_queries(
+                settings,
+                drallam_client,
+                query_embedding_cache,
+                batch.queries,
+                embedding_model,
+            )
+        except EmbeddingError as e:
+            text_search_fallback(settings, e)
 
     session: AsyncSession
     async with db_session_factory.begin() as session:
-        neighbours = await session.scalars(
-            select(EmbeddingNomic)
-            .order_by(EmbeddingNomic.vector.l2_distance(query_embedding))  # type: ignore[attr-defined]
-            .limit(max_snippets)
-            .options(selectinload(EmbeddingNomic.snippet))  # type: ignore[arg-type]
+        filter_strategy = await choose_filter_strategy(session, settings, batch.filters)
+        await set_search_params(session, settings, filter_strategy)
+        result = await session.execute(
+            batch_hybrid_search(
+                settings,
+                batch.queries,
+                query_embeddings,
+                batch.max_snippets,
+                batch.rerank_candidates,
+                embedding_model,
+                batch.filters,
+                filter_strategy,
+            )
+        )
+
+    snippets_by_query: list[list[RelevantSnippet]] = [[] for _ in batch.queries]
+    for row in result.all():
+        snippets_by_query[row.query_index].append(
+            RelevantSnippet.model_validate(row._mapping)
         )
-    return [n.snippet.content for n in neighbours]
+    return BatchSearchResults(
+        results=[
+            QuerySnippets(query=query, snippets=snippets)
+            for query, snippets in zip(batch.queries, snippets_by_query)
+        ],
+        fused=(
+            fuse_results(settings, snippets_by_query, batch.max_snippets)
+            if batch.fuse
+            else None
+        ),
+    )
+
+
+@llm_router.get(
+    "/stats",
+    summary="Report on resources used by the llm app",
+    response_model=LLMStats,
+)
+async def stats(
+    settings: Annotated[Settings, Depends(get_settings)],
+    drallam_client: Annotated[httpx.AsyncClient, Depends(get_drallam_client)],
+    query_embedding_cache: Annotated[
+        QueryEmbeddingCache | None, Depends(get_query_embedding_cache)
+    ],
+    search_result_cache: Annotated[
+        SearchResultCache | None, Depends(get_search_result_cache)
+    ],
+) -> LLMStats:
+    """
+    _Returns:_
+    - **drallam_pool**: utilisation of the connection pool shared by requests to draLLaM
+    - **drallam_requests**: circuit breaker state, retries, hedged requests & latency
+      histograms by outcome of embedding requests in this process
+    - **query_embedding_cache**: hits, misses & evictions in this process, if enabled
+    - **search_result_cache**: as above, evictions include results of older corpus
+      generations
+    """
+    return LLMStats(
+        drallam_pool=get_pool_stats(settings, drallam_client),
+        drallam_requests=get_drallam_guard(settings, drallam_client).stats(),
+        query_embedding_cache=query_embedding_cache.stats
+        if query_embedding_cache
+        else None,
+        search_result_cache=search_result_cache.stats if search_result_cache else None,
+    )
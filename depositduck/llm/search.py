@@ -0,0 +1,388 @@
+"""
+Relevance search over Snippets, combining vector similarity and full-text search.
+
+Vector queries order by the distance matching the operator class of the approximate
+nearest-neighbour index on `llm__embedding_nomic` (see `Settings.vector_distance`),
+otherwise Postgres falls back to an exact sequential scan. With
+`Settings.vector_quantisation` the index is built over a compact copy of the vectors
+and its nearest candidates are re-ranked by exact distance.
+
+Searches can be restricted to the Snippets of some SourceTexts (`SnippetFilters`).
+When few Snippets match, the query is compared to each of them exactly. Otherwise the
+approximate index is scanned iteratively, skipping non-matching rows, until enough
+matches are found, see `choose_filter_strategy`.
+
+Full-text search catches exact terms that embeddings blur, eg. "TDS" or "s.213".
+Results from both are merged by reciprocal-rank fusion (RRF): each Snippet scores
+`weight / (k + rank)` for every retriever that found it, so no score normalisation
+is needed between cosine distances and text ranks.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from uuid import UUID
+
+from pgvector.sqlalchemy import BIT, HALFVEC, Vector
+from sqlalchemy import (
+    ColumnElement,
+    CompoundSelect,
+    Float,
+    FromClause,
+    Select,
+    cast,
+    desc,
+    func,
+    literal,
+    null,
+    select,
+    union_all,
+)
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from depositduck.llm.embeddings import truncate_embedding
+from depositduck.llm.registry import embeddings_of
+from depositduck.models.dto.llm import RelevantSnippet, SnippetFilters
+from depositduck.models.llm import (
+    NOMIC,
+    NOMIC_COARSE_DIMENSIONS,
+    TEXT_SEARCH_CONFIG,
+    EmbeddingModel,
+    FilterStrategy,
+    VectorDistance,
+    VectorIndexType,
+    VectorQuantisation,
+)
+from depositduck.models.sql.llm import (
+    CorpusGeneration,
+    EmbeddingNomic,
+    Snippet,
+    SourceText,
+)
+from depositduck.settings import Settings
+
+
+def distance_to(
+    settings: Settings,
+    column: ColumnElement,
+    query_vector: list[float],
+    distance: VectorDistance | None = None,
+) -> ColumnElement:
+    """
+    Expression for the distance between `column` and `query_vector`, smaller is closer.
+    Measured by `Settings.vector_distance` unless another `distance` is given.
+    """
+    match distance or settings.vector_distance:
+        case VectorDistance.L2:
+            return column.l2_distance(query_vector)  # type: ignore[attr-defined]
+        case VectorDistance.COSINE:
+            return column.cosine_distance(query_vector)  # type: ignore[attr-defined]
+        case VectorDistance.INNER_PRODUCT:
+            # pgvector's `<#>` returns the negative inner product so it sorts ascending
+            return column.max_inner_product(query_vector)  # type: ignore[attr-defined]
+
+
+def quantised_distance_to(settings: Settings, query_vector: list[float]) -> ColumnElement:
+    """
+    Distance between the quantised forms of `EmbeddingNomic.vector` and `query_vector`,
+    written to match the index created for `Settings.vector_quantisation`.
+    """
+    column = EmbeddingNomic.vector
+    dimensions = NOMIC.dimensions
+    match settings.vector_quantisation:
+        case VectorQuantisation.HALFVEC:
+            return distance_to(settings, cast(column, HALFVEC(dimensions)), query_vector)
+        case VectorQuantisation.BINARY:
+            bits = BIT(dimensions)
+            query = cast(query_vector, Vector(dimensions))
+            return cast(func.binary_quantize(column), bits).hamming_distance(  # type: ignore[attr-defined]
+                cast(func.binary_quantize(query), bits)
+            )
+        case VectorQuantisation.MATRYOSHKA:
+            return distance_to(
+                settings,
+                EmbeddingNomic.vector_coarse,  # type: ignore[arg-type]
+                truncate_embedding(query_vector, NOMIC_COARSE_DIMENSIONS),
+            )
+    raise ValueError(f"embeddings are not quantised: '{settings.vector_quantisation}'")
+
+
+async def set_search_params(
+    session: AsyncSession,
+    settings: Settings,
+    filter_strategy: FilterStrategy | None = None,
+) -> None:
+    """
+    Tune the approximate index for queries in the current transaction only.
+    """
+    if settings.vector_index_type == VectorIndexType.HNSW:
+        params: dict[str, int | str] = {"hnsw.ef_search": settings.vector_hnsw_ef_search}
+    else:
+        params = {"ivfflat.probes": settings.vector_ivfflat_probes}
+    if filter_strategy == FilterStrategy.ITERATIVE_SCAN:
+        # keep scanning past the first candidates until enough pass the filters.
+        # Candidates are re-ranked by exact distance, so relaxed order is enough.
+        params[f"{settings.vector_index_type.value}.iterative_scan"] = "relaxed_order"
+    for name, value in params.items():
+        # `is_local=true` scopes the setting to the transaction, like `SET LOCAL`
+        await session.execute(select(func.set_config(name, str(value), True)))
+
+
+def filtered_source_text_ids(filters: SnippetFilters) -> Select:
+    conditions: list[ColumnElement] = []
+    if filters.source_text_ids is not None:
+        conditions.append(SourceText.id.in_(filters.source_text_ids))  # type: ignore[attr-defined]
+    if filters.tags is not None:
+        conditions.append(SourceText.tags.overlap(filters.tags))  # type: ignore[attr-defined]
+    if filters.created_after is not None:
+        conditions.append(SourceText.created_at >= filters.created_after)  # type: ignore[arg-type]
+    if filters.created_before is not None:
+        conditions.append(SourceText.created_at < filters.created_before)  # type: ignore[arg-type]
+    if filters.current_only:
+        conditions.append(SourceText.deleted_at.is_(None))  # type: ignore[union-attr]
+    return select(SourceText.id).where(*conditions)  # type: ignore[call-overload]
+
+
+def filtered_snippet_ids(filters: SnippetFilters) -> Select:
+    return select(Snippet.id).where(  # type: ignore[call-overload]
+        Snippet.source_text_id.in_(filtered_source_text_ids(filters))  # type: ignore[attr-defined]
+    )
+
+
+async def choose_filter_strategy(
+    session: AsyncSession, settings: Settings, filters: SnippetFilters | None
+) -> FilterStrategy | None:
+    """
+    Count the Snippets matching `filters`, up to `Settings.search_prefilter_max_snippets`.
+    Comparing the query to that few exactly is quicker, and always finds the nearest,
+    whereas the approximate index would discard most of what it scans.
+    None if nothing is filtered.
+    """
+    if filters is None or not filters.is_set:
+        return None
+    limit = settings.search_prefilter_max_snippets
+    matching = filtered_snippet_ids(filters).limit(limit + 1).subquery("matching")
+    result = await session.execute(select(func.count()).select_from(matching))
+    count = result.scalar_one()
+    return FilterStrategy.PREFILTER if count <= limit else FilterStrategy.ITERATIVE_SCAN
+
+
+async def get_corpus_generation(session: AsyncSession) -> int:
+    """
+    Counts transactions that have changed Snippets or embeddings, see
+    `depositduck.llm.cache.SearchResultCache`.
+    """
+    result = await session.execute(select(CorpusGeneration.generation))
+    return result.scalar_one()
+
+
+def vector_candidates(
+    settings: Settings,
+    query_vector: list[float],
+    rerank_candidates: int | None = None,
+    model: EmbeddingModel | None = None,
+    filters: SnippetFilters | None = None,
+    filter_strategy: FilterStrategy | None = None,
+) -> Select:
+    """
+    Ids of the Snippets with embeddings from `model` nearest to `query_vector`, ranked
+    from 1, and their distance to it. `model` defaults to `Settings.embedding_model`
+    and must be the model that embedded the query.
+    With quantisation, `rerank_candidates` overrides `Settings.vector_rerank_candidates`
+    to trade latency for recall. Quantisation only applies to nomic-embed-text.
+    Only Snippets matching `filters` are returned, found by `filter_strategy`, which
+    defaults to an iterative scan of the approximate index.
+    """
+    model = model or settings.embedding_model
+    distance_measure = model.distance if model != NOMIC else None
+    embeddings = embeddings_of(model)
+    matching = None
+    if filters is not None and filters.is_set:
+        matching = embeddings.c.snippet_id.in_(filtered_snippet_ids(filters))
+        if filter_strategy == FilterStrategy.PREFILTER:
+            # a materialised CTE can't be scanned by the approximate index, so each
+            # matching embedding is compared to the query exactly
+            embeddings = (
+                select(embeddings.c.snippet_id, embeddings.c.vector)
+                .where(matching)
+                .cte("prefiltered", nesting=True)
+                .prefix_with("MATERIALIZED")
+            )
+            distance = distance_to(
+                settings, embeddings.c.vector, query_vector, distance_measure
+            )
+            return _ranked_nearest(settings, embeddings, distance)
+
+    if model == NOMIC and settings.vector_quantisation != VectorQuantisation.NONE:
+        quantised_distance = quantised_distance_to(settings, query_vector)
+        # vectors in the shortlist are compared to the query but never returned
+        shortlist = select(EmbeddingNomic.snippet_id, EmbeddingNomic.vector)
+        if matching is not None:
+            shortlist = shortlist.where(matching)
+        embeddings = (
+            shortlist.order_by(quantised_distance)
+            .limit(rerank_candidates or settings.vector_rerank_candidates)
+            .subquery("shortlist")
+        )
+        matching = None
+    distance = distance_to(settings, embeddings.c.vector, query_vector, distance_measure)
+    return _ranked_nearest(settings, embeddings, distance, matching)
+
+
+def _ranked_nearest(
+    settings: Settings,
+    embeddings: FromClause,
+    distance: ColumnElement,
+    matching: ColumnElement | None = None,
+) -> Select:
+    statement = select(embeddings.c.snippet_id, distance.label("distance"))
+    if matching is not None:
+        statement = statement.where(matching)
+    nearest = (
+        statement.order_by(distance).limit(settings.search_candidates).subquery("nearest")
+    )
+    rank = func.row_number().over(order_by=nearest.c.distance)
+    return select(nearest.c.snippet_id, rank.label("rank"), nearest.c.distance)
+
+
+def text_candidates(
+    settings: Settings, query: str, filters: SnippetFilters | None = None
+) -> Select:
+    """
+    Ids of the Snippets that best match `query` as a web search, ranked from 1.
+    Accepts quoted phrases, `or` and `-` to exclude terms.
+    """
+    tsquery = func.websearch_to_tsquery(cast(TEXT_SEARCH_CONFIG, REGCONFIG), query)
+    text_rank = func.ts_rank_cd(Snippet.content_tsv, tsquery)
+    snippet_id = Snippet.id.label("snippet_id")  # type: ignore[attr-defined]
+    statement = select(snippet_id, text_rank.label("text_rank")).where(
+        Snippet.content_tsv.bool_op("@@")(tsquery)  # type: ignore[union-attr]
+    )
+    if filters is not None and filters.is_set:
+        statement = statement.where(
+            Snippet.source_text_id.in_(filtered_source_text_ids(filters))  # type: ignore[attr-defined]
+        )
+    matches = (
+        statement.order_by(text_rank.desc())
+        .limit(settings.search_candidates)
+        .subquery("matches")
+    )
+    rank = func.row_number().over(order_by=matches.c.text_rank.desc())
+    return select(matches.c.snippet_id, rank.label("rank"))
+
+
+def hybrid_search(
+    settings: Settings,
+    query: str,
+    query_vector: list[float] | None,
+    limit: int,
+    rerank_candidates: int | None = None,
+    model: EmbeddingModel | None = None,
+    filters: SnippetFilters | None = None,
+    filter_strategy: FilterStrategy | None = None,
+) -> Select:
+    """
+    A single statement selecting `(snippet_id, source_text_id, content, score, distance)`
+    for the `limit` Snippets most relevant to `query`, highest score first.
+    `distance` is `NULL` for Snippets found only by full-text search.
+    Vector search is skipped if `query_vector` is `None` or its weight is zero.
+    Embedding vectors are only compared inside Postgres, never returned.
+    See `vector_candidates` for `rerank_candidates`, `model`, `filters` and
+    `filter_strategy`.
+    """
+
+    def rrf(candidates: Select, weight: float, name: str) -> Select:
+        hits = candidates.subquery(name)
+        rrf_score = literal(weight, Float) / cast(
+            settings.search_rrf_k + hits.c.rank, Float
+        )
+        distance = hits.c.get("distance", null().cast(Float))
+        return select(
+            hits.c.snippet_id, rrf_score.label("rrf_score"), distance.label("distance")
+        )
+
+    ranked: list[Select] = []
+    if query_vector is not None and settings.search_vector_weight:
+        candidates = vector_candidates(
+            settings,
+            query_vector,
+            rerank_candidates,
+            model,
+            filters,
+            filter_strategy,
+        )
+        ranked.append(rrf(candidates, settings.search_vector_weight, "vector_hits"))
+    if settings.search_text_weight:
+        candidates = text_candidates(settings, query, filters)
+        ranked.append(rrf(candidates, settings.search_text_weight, "text_hits"))
+    if not ranked:
+        raise ValueError("hybrid search needs a query vector or a text search weight")
+
+    fused = union_all(*ranked).subquery("fused")
+    score = func.sum(fused.c.rrf_score).label("score")
+    distance = func.min(fused.c.distance).label("distance")
+    return (
+        select(
+            Snippet.id.label("snippet_id"),  # type: ignore[union-attr]
+            Snippet.source_text_id,
+            Snippet.content,
+            score,
+            distance,
+        )
+        .join(fused, fused.c.snippet_id == Snippet.id)
+        .group_by(Snippet.id)
+        .order_by(score.desc(), Snippet.id)
+        .limit(limit)
+    )
+
+
+def batch_hybrid_search(
+    settings: Settings,
+    queries: list[str],
+    query_vectors: list[list[float]] | None,
+    limit: int,
+    rerank_candidates: int | None = None,
+    model: EmbeddingModel | None = None,
+    filters: SnippetFilters | None = None,
+    filter_strategy: FilterStrategy | None = None,
+) -> CompoundSelect:
+    """
+    `hybrid_search` for each of `queries` in a single statement, selecting the same
+    columns preceded by `query_index`, the position of the query that found each row.
+    `query_vectors` must be `None` or hold one vector per query.
+    """
+    searches = []
+    for index, query in enumerate(queries):
+        query_vector = query_vectors[index] if query_vectors is not None else None
+        hits = hybrid_search(
+            settings,
+            query,
+            query_vector,
+            limit,
+            rerank_candidates,
+            model,
+            filters,
+            filter_strategy,
+        ).subquery(f"query_{index}")
+        searches.append(select(literal(index).label("query_index"), *hits.c))
+    return union_all(*searches).order_by("query_index", desc("score"), "snippet_id")
+
+
+def fuse_results(
+    settings: Settings, results: list[list[RelevantSnippet]], limit: int
+) -> list[RelevantSnippet]:
+    """
+    Merge the ranked results of several searches by reciprocal rank, like the
+    retrievers in `hybrid_search`. Each Snippet keeps its smallest distance.
+    """
+    fused: dict[UUID, RelevantSnippet] = {}
+    for snippets in results:
+        for rank, snippet in enumerate(snippets, start=1):
+            seen = fused.setdefault(
+                snippet.snippet_id, snippet.model_copy(update={"score": 0.0})
+            )
+            seen.score += 1 / (settings.search_rrf_k + rank)
+            distances = [d for d in (seen.distance, snippet.distance) if d is not None]
+            seen.distance = min(distances, default=None)
+    ranked = sorted(fused.values(), key=lambda s: (-s.score, s.snippet_id))
+    return ranked[:limit]
@@ -0,0 +1,302 @@
+"""
+Background worker that runs jobs from the queue in `depositduck.llm.jobs`.
+
+Usage: `python -m depositduck.llm.worker [--concurrency N]`
+Ingestion throughput scales by running more worker processes, on any host that can
+reach the database and draLLaM. SIGINT or SIGTERM stop the worker once the jobs it
+is running have finished.
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import socket
+from contextlib import suppress
+from typing import Any, Callable, Coroutine
+from uuid import UUID
+
+import httpx
+from pydantic import BaseModel, ConfigDict
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from depositduck.dependables import db_session_factory as get_db_session_factory
+from depositduck.dependables import get_logger, get_settings
+from depositduck.llm.backfill import run_backfill
+from depositduck.llm.drallam import build_drallam_client
+from depositduck.llm.embeddings import EmbeddingError
+from depositduck.llm.ingestion import (
+    NoSnippetsError,
+    OnProgress,
+    SourceTextNotFoundError,
+    embed_source_text,
+    snippets_from_source_text,
+)
+from depositduck.llm.jobs import (
+    JobInterruptedError,
+    JobPayloadError,
+    claim_job,
+    complete_job,
+    fail_abandoned_jobs,
+    fail_job,
+    heartbeat,
+    requeue_job,
+)
+from depositduck.models.common import TwoOhOneCreatedCount
+from depositduck.models.llm import (
+    EmbeddingModel,
+    JobKind,
+    UnknownEmbeddingModelError,
+    get_embedding_model,
+)
+from depositduck.models.sql.llm import Job
+from depositduck.settings import Settings
+
+LOG = get_logger()
+
+
+class JobContext(BaseModel):
+    settings: Settings
+    db_session_factory: async_sessionmaker
+    drallam_client: httpx.AsyncClient
+    job: Job
+    report_progress: OnProgress
+    # set when the worker is stopping, for long-running jobs to wind down early
+    stopping: asyncio.Event | None = None
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+
+# a handler returns the job's result, which is stored as JSON
+JobHandler = Callable[[JobContext], Coroutine[Any, Any, dict]]
+
+
+def job_source_text_id(ctx: JobContext) -> UUID:
+    try:
+        return UUID(ctx.job.payload["source_text_id"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise JobPayloadError(f"no valid source_text_id in {ctx.job.payload}") from e
+
+
+async def run_snippets_from_source_text(ctx: JobContext) -> dict:
+    created_count = await snippets_from_source_text(
+        ctx.settings,
+        ctx.db_session_factory,
+        job_source_text_id(ctx),
+        on_progress=ctx.report_progress,
+    )
+    return TwoOhOneCreatedCount(created_count=created_count).model_dump()
+
+
+def job_embedding_model(ctx: JobContext) -> EmbeddingModel:
+    llm_name = ctx.job.payload.get("llm_name", ctx.settings.drallam_embeddings_model)
+    return get_embedding_model(llm_name)
+
+
+async def run_embeddings_from_source_text(ctx: JobContext) -> dict:
+    result = await embed_source_text(
+        ctx.settings,
+        ctx.db_session_factory,
+        ctx.drallam_client,
+        job_source_text_id(ctx),
+        on_progress=ctx.report_progress,
+        model=job_embedding_model(ctx),
+    )
+    if result.failed_count:
+        # embeddings that succeeded are saved, a retry only requests the others
+        raise EmbeddingError(f"{result.failed_count} snippets could not be embedded")
+    return result.model_dump()
+
+
+async def run_embeddings_backfill(ctx: JobContext) -> dict:
+    """
+    Embed every Snippet missing an embedding from a model, eg. to try out a newly
+    registered one while the current model keeps serving searches. When the worker is
+    stopping the backfill stops after the current page and the job is queued again, to
+    resume from the checkpoint.
+    """
+    total, completed = await run_backfill(
+        ctx.settings,
+        ctx.db_session_factory,
+        ctx.drallam_client,
+        job_embedding_model(ctx),
+        # a retry resumes from the checkpoint saved by the attempt that restarted
+        restart=bool(ctx.job.payload.get("restart", False)) and ctx.job.attempts == 1,
+        stopping=ctx.stopping,
+        on_progress=ctx.report_progress,
+    )
+    if not completed:
+        # resume from the checkpoint, rather than restarting again
+        payload = {**ctx.job.payload, "restart": False}
+        raise JobInterruptedError(
+            f"backfill stopped after embedding {total.created_count} Snippets", payload
+        )
+    return total.model_dump()
+
+
+JOB_HANDLERS: dict[JobKind, JobHandler] = {
+    JobKind.SNIPPETS_FROM_SOURCE_TEXT: run_snippets_from_source_text,
+    JobKind.EMBEDDINGS_FROM_SOURCE_TEXT: run_embeddings_from_source_text,
+    JobKind.EMBEDDINGS_BACKFILL: run_embeddings_backfill,
+}
+
+# errors that retrying a job cannot fix
+NON_RETRYABLE_ERRORS: tuple[type[Exception], ...] = (
+    JobPayloadError,
+    NoSnippetsError,
+    SourceTextNotFoundError,
+    UnknownEmbeddingModelError,
+)
+
+
+class Worker:
+    def __init__(
+        self,
+        settings: Settings,
+        db_session_factory: async_sessionmaker,
+        drallam_client: httpx.AsyncClient,
+        worker_id: str | None = None,
+    ) -> None:
+        self.settings = settings
+        self.db_session_factory = db_session_factory
+        self.drallam_client = drallam_client
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = asyncio.Event()
+
+    def stop(self) -> None:
+        LOG.info(f"worker {self.worker_id} stopping after running jobs finish")
+        self.stopping.set()
+
+    async def _heartbeat(self, job: Job, runner_id: str) -> None:
+        while True:
+            await asyncio.sleep(self.settings.job_heartbeat_interval)
+            session: AsyncSession
+            async with self.db_session_factory.begin() as session:
+                await heartbeat(session, job, runner_id)
+
+    async def _report_progress(
+        self, job: Job, runner_id: str, done: int, total: int | None
+    ) -> None:
+        session: AsyncSession
+        async with self.db_session_factory.begin() as session:
+            await heartbeat(session, job, runner_id, done, total)
+
+    async def run_once(self, runner_id: str | None = None) -> bool:
+        """
+        Claim and run a single job as `runner_id`, which identifies one of the jobs
+        this worker runs concurrently. Returns whether there was a job to run.
+        """
+        runner_id = runner_id or self.worker_id
+        session: AsyncSession
+        async with self.db_session_factory.begin() as session:
+            await fail_abandoned_jobs(session, self.settings)
+            job = await claim_job(session, self.settings, runner_id)
+        if job is None:
+            return False
+
+        LOG.info(f"running job {job.kind} [id={job.id}] attempt {job.attempts}")
+
+        async def report_progress(done: int, total: int | None) -> None:
+            await self._report_progress(job, runner_id, done, total)
+
+        ctx = JobContext(
+            settings=self.settings,
+            db_session_factory=self.db_session_factory,
+            drallam_client=self.drallam_client,
+            job=job,
+            report_progress=report_progress,
+            stopping=self.stopping,
+        )
+        job_task = asyncio.create_task(JOB_HANDLERS[JobKind(job.kind)](ctx))
+        heartbeat_task = asyncio.create_task(self._heartbeat(job, runner_id))
+        heartbeat_errors: list[BaseException] = []
+
+        def on_heartbeat_done(task: asyncio.Task) -> None:
+            # without a heartbeat the job would be claimed again by another worker
+            if not task.cancelled() and (e := task.exception()) is not None:
+                LOG.error(f"job {job.kind} [id={job.id}] lost its heartbeat: {e}")
+                heartbeat_errors.append(e)
+                job_task.cancel()
+
+        heartbeat_task.add_done_callback(on_heartbeat_done)
+        try:
+            result = await job_task
+        except asyncio.CancelledError:
+            if not heartbeat_errors:
+                raise
+            await self._fail_job(job, runner_id, heartbeat_errors[0], retry=True)
+        except JobInterruptedError as e:
+            async with self.db_session_factory.begin() as session:
+                await requeue_job(session, job, runner_id, e.payload)
+            LOG.info(f"job {job.kind} [id={job.id}] interrupted, queued again: {e}")
+        except Exception as e:
+            retry = not isinstance(e, NON_RETRYABLE_ERRORS)
+            await self._fail_job(job, runner_id, e, retry=retry)
+        else:
+            async with self.db_session_factory.begin() as session:
+                await complete_job(session, job, runner_id, result)
+            LOG.info(f"job {job.kind} [id={job.id}] succeeded")
+        finally:
+            heartbeat_task.cancel()
+        return True
+
+    async def _fail_job(
+        self, job: Job, runner_id: str, error: BaseException, retry: bool
+    ) -> None:
+        session: AsyncSession
+        async with self.db_session_factory.begin() as session:
+            status = await fail_job(
+                session,
+                self.settings,
+                job,
+                runner_id,
+                error=f"{type(error).__name__}: {error}",
+                retry=retry,
+            )
+        LOG.warn(f"job {job.kind} [id={job.id}] failed, now {status}: {error}")
+
+    async def _run_jobs(self, runner_id: str) -> None:
+        while not self.stopping.is_set():
+            try:
+                ran_job = await self.run_once(runner_id)
+            except Exception as e:
+                # eg. the database is unavailable, wait and try again
+                LOG.error(f"worker {runner_id} could not claim a job: {e}")
+                ran_job = False
+            if not ran_job:
+                with suppress(TimeoutError):
+                    await asyncio.wait_for(
+                        self.stopping.wait(), self.settings.job_poll_interval
+                    )
+
+    async def run(self, concurrency: int) -> None:
+        LOG.info(f"worker {self.worker_id} running up to {concurrency} jobs at once")
+        # each concurrent runner has an id of its own, so that one cannot update a job
+        # another has claimed after it went stale
+        await asyncio.gather(
+            *(self._run_jobs(f"{self.worker_id}/{n}") for n in range(concurrency))
+        )
+
+
+async def main(concurrency: int) -> None:
+    settings = get_settings()
+    db_session_factory = await get_db_session_factory()
+    async with build_drallam_client(settings) as drallam_client:
+        worker = Worker(settings, db_session_factory, drallam_client)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, worker.stop)
+        await worker.run(concurrency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run background jobs.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=get_settings().job_worker_concurrency,
+        help="jobs to run at once, defaults to the JOB_WORKER_CONCURRENCY setting",
+    )
+    asyncio.run(main(parser.parse_args().concurrency))
@@ -9,6 +9,9 @@ Usage: point a compatible ASGI server (eg. uvicorn) to `webapp` in this module.
 (c) 2024 Alberto Morón Hernández
 """
 
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
 from fastapi import FastAPI
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
@@ -28,6 +31,7 @@ from depositduck.dashboard.routes import (
 )
 from depositduck.dependables import get_settings
 from depositduck.kitchensink.routes import kitchensink_router
+from depositduck.llm.drallam import build_drallam_client
 from depositduck.llm.routes import llm_router
 from depositduck.settings import Settings
 
@@ -37,6 +41,21 @@ if settings.debug:
     VERSION = f"WIP (on {VERSION})"
 
 
+def get_lifespan(settings: Settings):
+    """
+    Resources shared by every request for the lifetime of the application.
+    Yielded state is available to routes, including those in mounted apps, via
+    `request.state`.
+    """
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI) -> AsyncIterator[dict]:
+        async with build_drallam_client(settings) as drallam_client:
+            yield {"drallam_client": drallam_client}
+
+    return lifespan
+
+
 def get_apiapp(settings: Settings) -> FastAPI:
     apiapp = FastAPI(
         title=f"⚙️ {settings.app_name} apiapp",
@@ -72,6 +91,7 @@ def get_webapp(settings: Settings) -> FastAPI:
         openapi_tags=WEBAPP_ROUTE_TAGS,
         openapi_url="/openapi.json" if settings.debug else None,
         default_response_class=HTMLResponse,
+        lifespan=get_lifespan(settings),
     )
     webapp.include_router(auth_frontend_router)
     webapp.include_router(auth_operations_router)
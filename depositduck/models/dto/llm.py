@@ -5,8 +5,115 @@ the core <X>Base Pydantic objects which define the fields for each model.
 (c) 2024 Alberto Morón Hernández
 """
 
-from depositduck.models.llm import SourceTextBase
+from datetime import datetime
+from uuid import UUID
+
+from pydantic import BaseModel, ConfigDict, Field
+
+from depositduck.models.common import TwoOhOneCreatedCount
+from depositduck.models.llm import JobKind, JobStatus, SourceTextBase, VectorDistance
 
 
 class SourceTextCreate(SourceTextBase):
     pass
+
+
+class EmbeddingsCreated(TwoOhOneCreatedCount):
+    # embeddings copied from Snippets with identical content instead of generated
+    reused_count: int = 0
+    # Snippets whose embedding request failed and which can be retried
+    failed_count: int = 0
+    # Snippets not embedded because they nearly duplicate an embedded Snippet
+    near_duplicate_count: int = 0
+
+
+class SourceTextUploaded(TwoOhOneCreatedCount):
+    # `created_count` is the number of Snippets saved for the new SourceText
+    id: UUID
+
+
+class SourceTextIngested(SourceTextUploaded):
+    embeddings: EmbeddingsCreated
+    # milliseconds until the first embeddings were saved, ie. searchable
+    first_searchable_ms: float | None = None
+
+
+class RelevantSnippet(BaseModel):
+    snippet_id: UUID
+    source_text_id: UUID
+    content: str
+    # fused reciprocal-rank score, higher is more relevant
+    score: float
+    # distance of the Snippet's embedding to the query, None if only matched by text
+    distance: float | None = None
+
+
+class SnippetFilters(BaseModel):
+    """
+    Restrict relevance search to the Snippets of matching SourceTexts.
+    Every field that is set must match.
+    """
+
+    source_text_ids: list[UUID] | None = None
+    # SourceTexts with any of these tags
+    tags: list[str] | None = None
+    created_after: datetime | None = None
+    created_before: datetime | None = None
+    # exclude deleted SourceTexts, eg. earlier versions of a document
+    current_only: bool = False
+
+    @property
+    def is_set(self) -> bool:
+        return bool(self.model_dump(exclude_defaults=True))
+
+
+class BatchSearchQuery(BaseModel):
+    # eg. reformulations of the same user question
+    queries: list[str] = Field(min_length=1, max_length=10)
+    max_snippets: int = Field(5, ge=1, le=10)
+    rerank_candidates: int | None = Field(None, ge=1, le=2000)
+    # tag of a registered embedding model, if not `Settings.drallam_embeddings_model`
+    model: str | None = None
+    # also return the results of every query fused into a single ranking
+    fuse: bool = False
+    filters: SnippetFilters | None = None
+
+
+class QuerySnippets(BaseModel):
+    query: str
+    snippets: list[RelevantSnippet]
+
+
+class BatchSearchResults(BaseModel):
+    # in the same order as `BatchSearchQuery.queries`
+    results: list[QuerySnippets]
+    fused: list[RelevantSnippet] | None = None
+
+
+class EmbeddingModelRead(BaseModel):
+    tag: str
+    dimensions: int
+    distance: VectorDistance
+    # the model used unless a request asks for another
+    is_default: bool
+    # Snippets with an embedding from this model, eg. to follow a backfill
+    embedded_count: int
+
+
+class JobRead(BaseModel):
+    id: UUID
+    kind: JobKind
+    status: JobStatus
+    attempts: int
+    max_attempts: int
+    # eg. Snippets embedded so far out of `progress_total`, which may be unknown
+    progress_done: int
+    progress_total: int | None
+    # set once the job has succeeded, eg. an `EmbeddingsCreated` object
+    result: dict | None
+    last_error: str | None
+    created_at: datetime
+    started_at: datetime | None
+    finished_at: datetime | None
+
+    model_config = ConfigDict(from_attributes=True)
@@ -4,9 +4,24 @@ Base models for LLM functionality.
 (c) 2024 Alberto Morón Hernández
 """
 
+import hashlib
+import re
+from enum import Enum
 from uuid import UUID
 
-from pydantic import BaseModel, PositiveInt
+from pydantic import BaseModel, PositiveInt, model_validator
+
+
+class ChunkerName(str, Enum):
+    """
+    Strategies for splitting a SourceText into Snippets.
+    See `depositduck.llm.chunking`.
+    """
+
+    # one Snippet per paragraph, however short or long
+    PARAGRAPH = "paragraph"
+    # whole sentences packed up to a target size in tokens, overlapping
+    TOKEN = "token"
 
 
 class SourceTextBase(BaseModel):
@@ -19,6 +34,17 @@ class SourceTextBase(BaseModel):
     url: str | None = None
     description: str
     content: str
+    # how to split into Snippets, if not the default set by `Settings.chunker`
+    chunker: ChunkerName | None = None
+    # labels to restrict relevance search by, eg. "tds" or "guidance"
+    tags: list[str] = []
+
+
+def hash_content(content: str) -> str:
+    """
+    Identical to Postgres' `encode(sha256(convert_to(content, 'UTF8')), 'hex')`.
+    """
+    return hashlib.sha256(content.encode()).hexdigest()
 
 
 class SnippetBase(BaseModel):
@@ -29,6 +55,14 @@ class SnippetBase(BaseModel):
 
     content: str
     source_text_id: UUID
+    # identifies identical text across SourceTexts so it is only embedded once
+    content_hash: str | None = None
+
+    @model_validator(mode="after")
+    def set_content_hash(self) -> "SnippetBase":
+        if self.content_hash is None:
+            self.content_hash = hash_content(self.content)
+        return self
 
 
 class LLMBase(BaseModel):
@@ -42,7 +76,171 @@ class LLMBase(BaseModel):
     dimensions: PositiveInt
 
 
-NOMIC = LLMBase(name="nomic-embed-text", version="v1.5", dimensions=768)
+# Postgres text search configuration used to index and query Snippets' content
+TEXT_SEARCH_CONFIG = "english"
+
+
+class VectorDistance(str, Enum):
+    """
+    Distance used to compare embeddings. nomic vectors are normalised so cosine and
+    inner product rank neighbours identically, with inner product being cheaper.
+    """
+
+    L2 = "l2"
+    COSINE = "cosine"
+    INNER_PRODUCT = "inner_product"
+
+
+class VectorIndexType(str, Enum):
+    """
+    pgvector approximate nearest-neighbour index methods.
+    https://github.com/pgvector/pgvector#indexing
+    """
+
+    HNSW = "hnsw"
+    IVFFLAT = "ivfflat"
+
+
+# operator class an index must be built with to serve queries using each distance
+VECTOR_OPCLASSES = {
+    VectorDistance.L2: "vector_l2_ops",
+    VectorDistance.COSINE: "vector_cosine_ops",
+    VectorDistance.INNER_PRODUCT: "vector_ip_ops",
+}
+
+
+class VectorQuantisation(str, Enum):
+    """
+    Compact form of embeddings held in a smaller approximate index. Searches scan it
+    first, then re-rank the nearest candidates by their full-precision vectors.
+    https://github.com/pgvector/pgvector#half-precision-indexing
+    """
+
+    NONE = "none"
+    # 16-bit floats, half the size of the full index
+    HALFVEC = "halfvec"
+    # one bit per dimension compared by Hamming distance, 32x smaller
+    BINARY = "binary"
+    # leading `NOMIC_COARSE_DIMENSIONS` of each vector, re-normalised
+    MATRYOSHKA = "matryoshka"
+
+
+HALFVEC_OPCLASSES = {
+    VectorDistance.L2: "halfvec_l2_ops",
+    VectorDistance.COSINE: "halfvec_cosine_ops",
+    VectorDistance.INNER_PRODUCT: "halfvec_ip_ops",
+}
+
+
+class EmbeddingModel(LLMBase):
+    """
+    An embedding model served by draLLaM. Embeddings from nomic-embed-text are stored
+    in their own table, tuned by the `VECTOR_*` settings. Every other registered model
+    shares `llm__embedding`, see `depositduck.llm.registry`.
+    """
+
+    # how to compare this model's embeddings, nomic uses `Settings.vector_distance`
+    distance: VectorDistance = VectorDistance.COSINE
+
+    @property
+    def tag(self) -> str:
+        return f"{self.name}:{self.version}"
+
+
+NOMIC = EmbeddingModel(name="nomic-embed-text", version="v1.5", dimensions=768)
+# nomic-embed-text v1.5 is trained so that the leading dimensions of its embeddings are
+# embeddings in their own right (Matryoshka representation learning). A truncated copy
+# is stored alongside each vector for cheaper coarse searches.
+NOMIC_COARSE_DIMENSIONS = 256
+MXBAI_EMBED_LARGE = EmbeddingModel(
+    name="mxbai-embed-large", version="v1", dimensions=1024
+)
+ALL_MINILM = EmbeddingModel(name="all-minilm", version="l6-v2", dimensions=384)
+
+# embedding models that can be used side by side, keyed by ollama tag. Registering a
+# model also needs a migration to index its embeddings, see `embedding_index_name`.
+EMBEDDING_MODELS: dict[str, EmbeddingModel] = {
+    model.tag: model for model in (NOMIC, MXBAI_EMBED_LARGE, ALL_MINILM)
+}
+
+
+class UnknownEmbeddingModelError(LookupError):
+    pass
+
+
+def get_embedding_model(tag: str) -> EmbeddingModel:
+    try:
+        return EMBEDDING_MODELS[tag]
+    except KeyError:
+        message = f"embedding model '{tag}' is not registered"
+        raise UnknownEmbeddingModelError(message) from None
+
+
+def embedding_index_name(model: EmbeddingModel) -> str:
+    """
+    Name of the partial index on `llm__embedding` over the embeddings of `model`.
+    """
+    return "ix_llm__embedding_" + re.sub(r"\W+", "_", model.tag)
+
+
+# SimHash signatures of Snippets are indexed in this many bands, see `llm.dedup`
+SIMHASH_BANDS = 4
+
+
+class CacheBackend(str, Enum):
+    NONE = "none"
+    # per-process, lost on restart
+    MEMORY = "memory"
+    # shared by all processes through a database table
+    POSTGRES = "postgres"
+
+
+class FilterStrategy(str, Enum):
+    """
+    How a vector search restricted to some Snippets finds their nearest neighbours.
+    https://github.com/pgvector/pgvector#iterative-index-scans
+    """
+
+    # compare the query to every matching Snippet exactly, without the ANN index
+    PREFILTER = "prefilter"
+    # scan the ANN index, filtering as it goes, until enough matches are found
+    ITERATIVE_SCAN = "iterative_scan"
+
+
+class BulkWriteMethod(str, Enum):
+    # executemany INSERT, binding each value as a parameter
+    INSERT = "insert"
+    # binary COPY through a staging table, see `depositduck.llm.bulk`
+    COPY = "copy"
+
+
+class JobKind(str, Enum):
+    """
+    Work that can be queued for a background worker. See `depositduck.llm.worker`.
+    """
+
+    SNIPPETS_FROM_SOURCE_TEXT = "snippets_from_source_text"
+    EMBEDDINGS_FROM_SOURCE_TEXT = "embeddings_from_source_text"
+    # queues embeddings for every SourceText, eg. with a newly registered model
+    EMBEDDINGS_BACKFILL = "embeddings_backfill"
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class JobBase(BaseModel):
+    """
+    A unit of background work stored in the database until a worker completes it.
+    """
+
+    kind: JobKind
+    # arguments for the job, eg. `{"source_text_id": "..."}`
+    payload: dict
+    max_attempts: PositiveInt
 
 
 class EmbeddingBase(BaseModel):
@@ -8,6 +8,7 @@ from sqlalchemy.ext.asyncio import async_engine_from_config
 from sqlmodel import SQLModel
 
 from depositduck.dependables import get_db_connection_string
+from depositduck.models.llm import EMBEDDING_MODELS, NOMIC, embedding_index_name
 
 # ensure alembic can detect table models
 from depositduck.models.sql import tables  # noqa: F401
@@ -29,6 +30,20 @@ config.set_main_option("sqlalchemy.url", get_db_connection_string())
 # target_metadata = mymodel.Base.metadata
 target_metadata = SQLModel.metadata
 
+# indexes whose definition depends on settings and which are managed exclusively by
+# migrations, to be ignored when autogenerating a migration
+VECTOR_INDEX_NAMES = {
+    "ix_llm__embedding_nomic_vector",
+    "ix_llm__embedding_nomic_vector_quantised",
+    "ix_llm__embedding_nomic_vector_coarse",
+    *(embedding_index_name(m) for m in EMBEDDING_MODELS.values() if m != NOMIC),
+}
+
+
+def include_object(object, name, type_, reflected, compare_to) -> bool:
+    return not (type_ == "index" and name in VECTOR_INDEX_NAMES)
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -51,6 +66,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -60,7 +76,11 @@ def run_migrations_offline() -> None:
 
 
 def do_run_migrations(connection: Connection) -> None:
-    context.configure(connection=connection, target_metadata=target_metadata)
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        include_object=include_object,
+    )
 
     with context.begin_transaction():
         context.run_migrations()
@@ -0,0 +1,58 @@
+"""llm__embedding_nomic approximate nearest-neighbour index
+
+The index method (HNSW or IVFFlat) and operator class are read from settings.
+`VECTOR_DISTANCE` must not change afterwards unless this index is rebuilt to match.
+IVFFlat picks its list centroids from existing rows, so create it once the table is
+populated.
+
+Revision ID: 3f8a2c1d9e47
+Revises: 6c4ff352cac0
+Create Date: 2026-10-17 09:00:12.481230
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+from depositduck.dependables import get_settings
+from depositduck.models.llm import VECTOR_OPCLASSES, VectorIndexType
+
+# revision identifiers, used by Alembic.
+revision: str = "3f8a2c1d9e47"
+down_revision: Union[str, None] = "6c4ff352cac0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEX_NAME = "ix_llm__embedding_nomic_vector"
+
+
+def upgrade() -> None:
+    settings = get_settings()
+    if settings.vector_index_type == VectorIndexType.HNSW:
+        index_params = {
+            "m": settings.vector_hnsw_m,
+            "ef_construction": settings.vector_hnsw_ef_construction,
+        }
+    else:
+        index_params = {"lists": settings.vector_ivfflat_lists}
+
+    # build without locking out writes to the table, which can't run in a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            INDEX_NAME,
+            "llm__embedding_nomic",
+            ["vector"],
+            postgresql_using=settings.vector_index_type.value,
+            postgresql_with=index_params,
+            postgresql_ops={"vector": VECTOR_OPCLASSES[settings.vector_distance]},
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            INDEX_NAME, table_name="llm__embedding_nomic", postgresql_concurrently=True
+        )
@@ -0,0 +1,57 @@
+"""llm__query_embedding_cache
+
+Revision ID: 9b1e6d0c4a25
+Revises: 3f8a2c1d9e47
+Create Date: 2026-10-17 09:30:41.905117
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+import pgvector
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9b1e6d0c4a25"
+down_revision: Union[str, None] = "3f8a2c1d9e47"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "llm__query_embedding_cache",
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.Column("key", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("llm_name", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("vector", pgvector.sqlalchemy.Vector(), nullable=False),
+        sa.Column(
+            "last_used_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("key"),
+    )
+    op.create_index(
+        op.f("ix_llm__query_embedding_cache_last_used_at"),
+        "llm__query_embedding_cache",
+        ["last_used_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        op.f("ix_llm__query_embedding_cache_last_used_at"),
+        table_name="llm__query_embedding_cache",
+    )
+    op.drop_table("llm__query_embedding_cache")
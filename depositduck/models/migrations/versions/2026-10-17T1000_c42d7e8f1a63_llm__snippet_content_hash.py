@@ -0,0 +1,62 @@
+"""llm__snippet content_hash & one embedding per snippet
+
+Revision ID: c42d7e8f1a63
+Revises: 9b1e6d0c4a25
+Create Date: 2026-10-17 10:00:27.118342
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c42d7e8f1a63"
+down_revision: Union[str, None] = "9b1e6d0c4a25"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "llm__snippet",
+        sa.Column("content_hash", sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+    )
+    # must match `depositduck.models.llm.hash_content`
+    op.execute(
+        sa.text(
+            "UPDATE llm__snippet "
+            "SET content_hash = encode(sha256(convert_to(content, 'UTF8')), 'hex')"
+        )
+    )
+    op.alter_column("llm__snippet", "content_hash", nullable=False)
+    op.create_index(
+        op.f("ix_llm__snippet_content_hash"),
+        "llm__snippet",
+        ["content_hash"],
+        unique=False,
+    )
+
+    # keep only the earliest embedding of snippets embedded more than once
+    op.execute(
+        sa.text(
+            "DELETE FROM llm__embedding_nomic AS e "
+            "USING llm__embedding_nomic AS earlier "
+            "WHERE e.snippet_id = earlier.snippet_id "
+            "AND (e.created_at, e.id) > (earlier.created_at, earlier.id)"
+        )
+    )
+    op.create_unique_constraint(
+        "uq_embedding_nomic_snippet", "llm__embedding_nomic", ["snippet_id"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint(
+        "uq_embedding_nomic_snippet", "llm__embedding_nomic", type_="unique"
+    )
+    op.drop_index(op.f("ix_llm__snippet_content_hash"), table_name="llm__snippet")
+    op.drop_column("llm__snippet", "content_hash")
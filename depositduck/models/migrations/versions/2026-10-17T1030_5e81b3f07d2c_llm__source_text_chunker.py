@@ -0,0 +1,30 @@
+"""llm__source_text chunker
+
+Revision ID: 5e81b3f07d2c
+Revises: c42d7e8f1a63
+Create Date: 2026-10-17 10:30:12.640518
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5e81b3f07d2c"
+down_revision: Union[str, None] = "c42d7e8f1a63"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("llm__source_text", sa.Column("chunker", sa.String(), nullable=True))
+    # existing SourceTexts were split into one Snippet per paragraph, keep them that
+    # way so that regenerating their Snippets does not produce a second, overlapping set
+    op.execute(sa.text("UPDATE llm__source_text SET chunker = 'paragraph'"))
+
+
+def downgrade() -> None:
+    op.drop_column("llm__source_text", "chunker")
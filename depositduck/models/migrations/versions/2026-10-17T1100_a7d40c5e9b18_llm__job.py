@@ -0,0 +1,81 @@
+"""llm__job
+
+Revision ID: a7d40c5e9b18
+Revises: 5e81b3f07d2c
+Create Date: 2026-10-17 11:00:08.372954
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+from alembic import op
+from sqlalchemy.dialects.postgresql import JSONB, UUID
+
+# revision identifiers, used by Alembic.
+revision: str = "a7d40c5e9b18"
+down_revision: Union[str, None] = "5e81b3f07d2c"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "llm__job",
+        sa.Column(
+            "id",
+            UUID(),
+            server_default=sa.text("gen_random_uuid()"),
+            nullable=False,
+        ),
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.Column("deleted_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("kind", sa.String(), nullable=False),
+        sa.Column("payload", JSONB(), nullable=False),
+        sa.Column("dedupe_key", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("max_attempts", sa.Integer(), nullable=False),
+        sa.Column("status", sa.String(), server_default="queued", nullable=False),
+        sa.Column("attempts", sa.Integer(), server_default="0", nullable=False),
+        sa.Column(
+            "run_after",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.Column("worker_id", sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+        sa.Column("started_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("heartbeat_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("finished_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("progress_done", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("progress_total", sa.Integer(), nullable=True),
+        sa.Column("result", JSONB(), nullable=True),
+        sa.Column("last_error", sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_llm__job_claimable",
+        "llm__job",
+        ["run_after"],
+        unique=False,
+        postgresql_where=sa.text("status IN ('queued', 'running')"),
+    )
+    op.create_index(
+        "uq_llm__job_unfinished_dedupe_key",
+        "llm__job",
+        ["kind", "dedupe_key"],
+        unique=True,
+        postgresql_where=sa.text("status IN ('queued', 'running')"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("uq_llm__job_unfinished_dedupe_key", table_name="llm__job")
+    op.drop_index("ix_llm__job_claimable", table_name="llm__job")
+    op.drop_table("llm__job")
@@ -0,0 +1,47 @@
+"""llm__snippet content_tsv for full-text search
+
+Revision ID: d18f6a2b7c90
+Revises: a7d40c5e9b18
+Create Date: 2026-10-17 11:30:51.204736
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+from depositduck.models.llm import TEXT_SEARCH_CONFIG
+
+# revision identifiers, used by Alembic.
+revision: str = "d18f6a2b7c90"
+down_revision: Union[str, None] = "a7d40c5e9b18"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # generated columns are computed for existing rows when added
+    op.add_column(
+        "llm__snippet",
+        sa.Column(
+            "content_tsv",
+            TSVECTOR(),
+            sa.Computed(f"to_tsvector('{TEXT_SEARCH_CONFIG}', content)", persisted=True),
+            nullable=True,
+        ),
+    )
+    op.create_index(
+        "ix_llm__snippet_content_tsv",
+        "llm__snippet",
+        ["content_tsv"],
+        unique=False,
+        postgresql_using="gin",
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_llm__snippet_content_tsv", table_name="llm__snippet")
+    op.drop_column("llm__snippet", "content_tsv")
@@ -0,0 +1,69 @@
+"""llm__embedding_nomic approximate nearest-neighbour index over quantised vectors
+
+An expression index on `vector::halfvec(768)` or `binary_quantize(vector)::bit(768)`,
+according to `VECTOR_QUANTISATION`. Does nothing if quantisation is not enabled.
+Requires pgvector >= 0.7.0. Like the full-precision index, the method and operator
+class are read from settings and queries only use the index if these don't change.
+
+Revision ID: 6b3f9a1e2d54
+Revises: d18f6a2b7c90
+Create Date: 2026-10-17 12:00:37.915042
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+from depositduck.dependables import get_settings
+from depositduck.models.llm import (
+    HALFVEC_OPCLASSES,
+    NOMIC,
+    VectorIndexType,
+    VectorQuantisation,
+)
+
+# revision identifiers, used by Alembic.
+revision: str = "6b3f9a1e2d54"
+down_revision: Union[str, None] = "d18f6a2b7c90"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEX_NAME = "ix_llm__embedding_nomic_vector_quantised"
+
+
+def upgrade() -> None:
+    settings = get_settings()
+    dimensions = NOMIC.dimensions
+    match settings.vector_quantisation:
+        case VectorQuantisation.NONE | VectorQuantisation.MATRYOSHKA:
+            # Matryoshka vectors are indexed once their column exists, in 0c5d7e3a9f12
+            return
+        case VectorQuantisation.HALFVEC:
+            expression = f"(vector::halfvec({dimensions}))"
+            opclass = HALFVEC_OPCLASSES[settings.vector_distance]
+        case VectorQuantisation.BINARY:
+            expression = f"(binary_quantize(vector)::bit({dimensions}))"
+            opclass = "bit_hamming_ops"
+
+    if settings.vector_index_type == VectorIndexType.HNSW:
+        index_params = (
+            f"m = {settings.vector_hnsw_m}, "
+            f"ef_construction = {settings.vector_hnsw_ef_construction}"
+        )
+    else:
+        index_params = f"lists = {settings.vector_ivfflat_lists}"
+
+    # build without locking out writes to the table, which can't run in a transaction
+    with op.get_context().autocommit_block():
+        op.execute(
+            f"CREATE INDEX CONCURRENTLY {INDEX_NAME} ON llm__embedding_nomic "
+            f"USING {settings.vector_index_type.value} ({expression} {opclass}) "
+            f"WITH ({index_params})"
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}")
@@ -0,0 +1,77 @@
+"""llm__embedding_nomic vector_coarse, truncated Matryoshka embeddings
+
+Existing rows are filled in from `vector` the same way as `truncate_embedding`, which
+requires pgvector >= 0.7.0. An approximate index is only built on the new column when
+`VECTOR_QUANTISATION` is `matryoshka`.
+
+Revision ID: 0c5d7e3a9f12
+Revises: 6b3f9a1e2d54
+Create Date: 2026-10-17 12:30:08.662190
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from pgvector.sqlalchemy import Vector
+
+from depositduck.dependables import get_settings
+from depositduck.models.llm import (
+    NOMIC_COARSE_DIMENSIONS,
+    VECTOR_OPCLASSES,
+    VectorIndexType,
+    VectorQuantisation,
+)
+
+# revision identifiers, used by Alembic.
+revision: str = "0c5d7e3a9f12"
+down_revision: Union[str, None] = "6b3f9a1e2d54"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# not the name of 6b3f9a1e2d54's index, so downgrading never drops that one
+INDEX_NAME = "ix_llm__embedding_nomic_vector_coarse"
+
+
+def upgrade() -> None:
+    op.add_column(
+        "llm__embedding_nomic",
+        sa.Column("vector_coarse", Vector(NOMIC_COARSE_DIMENSIONS), nullable=True),
+    )
+    op.execute(
+        "UPDATE llm__embedding_nomic SET vector_coarse = "
+        f"l2_normalize(subvector(vector, 1, {NOMIC_COARSE_DIMENSIONS}))"
+        f"::vector({NOMIC_COARSE_DIMENSIONS})"
+    )
+    op.alter_column("llm__embedding_nomic", "vector_coarse", nullable=False)
+
+    settings = get_settings()
+    if settings.vector_quantisation != VectorQuantisation.MATRYOSHKA:
+        return
+    if settings.vector_index_type == VectorIndexType.HNSW:
+        index_params = {
+            "m": settings.vector_hnsw_m,
+            "ef_construction": settings.vector_hnsw_ef_construction,
+        }
+    else:
+        index_params = {"lists": settings.vector_ivfflat_lists}
+
+    # build without locking out writes to the table, which can't run in a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            INDEX_NAME,
+            "llm__embedding_nomic",
+            ["vector_coarse"],
+            postgresql_using=settings.vector_index_type.value,
+            postgresql_with=index_params,
+            postgresql_ops={"vector_coarse": VECTOR_OPCLASSES[settings.vector_distance]},
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}")
+    op.drop_column("llm__embedding_nomic", "vector_coarse")
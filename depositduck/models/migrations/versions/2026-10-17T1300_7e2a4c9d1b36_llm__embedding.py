@@ -0,0 +1,79 @@
+"""llm__embedding for models other than nomic-embed-text
+
+Creates a partial HNSW index over the embeddings of each model registered in
+`EMBEDDING_MODELS` at the time, cast to its dimensions. Unlike IVFFlat, HNSW indexes
+can be built before a model's embeddings are backfilled. Registering another model
+later needs a migration to create its index in the same way.
+
+Revision ID: 7e2a4c9d1b36
+Revises: 0c5d7e3a9f12
+Create Date: 2026-10-17 13:00:44.190836
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+from alembic import op
+from pgvector.sqlalchemy import Vector
+from sqlalchemy.dialects.postgresql import UUID
+
+from depositduck.dependables import get_settings
+from depositduck.models.llm import (
+    EMBEDDING_MODELS,
+    NOMIC,
+    VECTOR_OPCLASSES,
+    embedding_index_name,
+)
+
+# revision identifiers, used by Alembic.
+revision: str = "7e2a4c9d1b36"
+down_revision: Union[str, None] = "0c5d7e3a9f12"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "llm__embedding",
+        sa.Column(
+            "id",
+            UUID(),
+            server_default=sa.text("gen_random_uuid()"),
+            nullable=False,
+        ),
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.Column("deleted_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("snippet_id", UUID(), nullable=False),
+        sa.Column("llm_name", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("vector", Vector(), nullable=False),
+        sa.ForeignKeyConstraint(["snippet_id"], ["llm__snippet.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "snippet_id", "llm_name", name="uq_embedding_snippet_llm_name"
+        ),
+    )
+
+    settings = get_settings()
+    for model in EMBEDDING_MODELS.values():
+        if model == NOMIC:
+            continue
+        op.execute(
+            f"CREATE INDEX {embedding_index_name(model)} ON llm__embedding "
+            f"USING hnsw ((vector::vector({model.dimensions})) "
+            f"{VECTOR_OPCLASSES[model.distance]}) "
+            f"WITH (m = {settings.vector_hnsw_m}, "
+            f"ef_construction = {settings.vector_hnsw_ef_construction}) "
+            f"WHERE llm_name = '{model.tag}'"
+        )
+
+
+def downgrade() -> None:
+    op.drop_table("llm__embedding")
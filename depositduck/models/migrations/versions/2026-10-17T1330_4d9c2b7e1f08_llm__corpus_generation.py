@@ -0,0 +1,108 @@
+"""llm__corpus_generation & llm__search_result_cache
+
+`llm__corpus_generation` holds a single counter, bumped by triggers in every transaction
+that writes to the tables relevance search reads. Cached search results are keyed by
+the generation they were computed at, so a write invalidates them all atomically.
+
+The triggers are deferred to commit time and bump the counter at most once per
+transaction. Its row is therefore only locked for the instant before each commit,
+rather than for the whole of a long transaction such as a streamed upload.
+
+Revision ID: 4d9c2b7e1f08
+Revises: 7e2a4c9d1b36
+Create Date: 2026-10-17 13:30:12.507349
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+from alembic import op
+from sqlalchemy.dialects.postgresql import JSONB
+
+# revision identifiers, used by Alembic.
+revision: str = "4d9c2b7e1f08"
+down_revision: Union[str, None] = "7e2a4c9d1b36"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+CORPUS_TABLES = ("llm__snippet", "llm__embedding_nomic", "llm__embedding")
+
+
+def upgrade() -> None:
+    op.create_table(
+        "llm__corpus_generation",
+        sa.Column("id", sa.SmallInteger(), server_default="1", nullable=False),
+        sa.Column("generation", sa.BigInteger(), server_default="0", nullable=False),
+        sa.CheckConstraint("id = 1", name="ck_corpus_generation_single_row"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.execute("INSERT INTO llm__corpus_generation DEFAULT VALUES")
+    op.execute(
+        """
+        CREATE FUNCTION llm__bump_corpus_generation() RETURNS trigger AS $$
+        BEGIN
+            IF current_setting('depositduck.corpus_bumped', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            PERFORM set_config('depositduck.corpus_bumped', 'on', true);
+            UPDATE llm__corpus_generation SET generation = generation + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    for table in CORPUS_TABLES:
+        op.execute(
+            f"CREATE CONSTRAINT TRIGGER {table}_bump_corpus_generation "
+            f"AFTER INSERT OR UPDATE OR DELETE ON {table} "
+            f"DEFERRABLE INITIALLY DEFERRED FOR EACH ROW "
+            f"EXECUTE FUNCTION llm__bump_corpus_generation()"
+        )
+        # TRUNCATE only fires statement-level triggers, which cannot be deferred
+        op.execute(
+            f"CREATE TRIGGER {table}_truncate_bump_corpus_generation "
+            f"AFTER TRUNCATE ON {table} "
+            f"FOR EACH STATEMENT EXECUTE FUNCTION llm__bump_corpus_generation()"
+        )
+
+    op.create_table(
+        "llm__search_result_cache",
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.Column("key", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("generation", sa.BigInteger(), nullable=False),
+        sa.Column("results", JSONB(), nullable=False),
+        sa.Column(
+            "last_used_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("key"),
+    )
+    op.create_index(
+        op.f("ix_llm__search_result_cache_last_used_at"),
+        "llm__search_result_cache",
+        ["last_used_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        op.f("ix_llm__search_result_cache_last_used_at"),
+        table_name="llm__search_result_cache",
+    )
+    op.drop_table("llm__search_result_cache")
+    for table in CORPUS_TABLES:
+        op.execute(f"DROP TRIGGER {table}_truncate_bump_corpus_generation ON {table}")
+        op.execute(f"DROP TRIGGER {table}_bump_corpus_generation ON {table}")
+    op.execute("DROP FUNCTION llm__bump_corpus_generation()")
+    op.drop_table("llm__corpus_generation")
@@ -0,0 +1,78 @@
+"""llm__source_text tags & indexes for filtered relevance search
+
+Relevance search can be restricted by SourceText id, tags & creation date, and to
+SourceTexts that have not been deleted. Each filter is served by an index so that
+counting matching Snippets, to choose how to search them, stays cheap.
+
+As the filters read `llm__source_text`, writing to it, eg. retagging or soft-deleting a
+SourceText, now bumps the corpus generation like writes to the other tables relevance
+search reads, see 4d9c2b7e1f08.
+
+Revision ID: b3e8f61a2c57
+Revises: 4d9c2b7e1f08
+Create Date: 2026-10-17 14:00:41.118230
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b3e8f61a2c57"
+down_revision: Union[str, None] = "4d9c2b7e1f08"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "llm__source_text",
+        sa.Column("tags", sa.ARRAY(sa.String()), server_default="{}", nullable=False),
+    )
+    op.create_index(
+        "ix_llm__source_text_tags",
+        "llm__source_text",
+        ["tags"],
+        unique=False,
+        postgresql_using="gin",
+    )
+    op.create_index(
+        "ix_llm__source_text_current_created_at",
+        "llm__source_text",
+        ["created_at"],
+        unique=False,
+        postgresql_where=sa.text("deleted_at IS NULL"),
+    )
+    # `uq_source_text_content` also leads with source_text_id but is far wider
+    op.create_index(
+        op.f("ix_llm__snippet_source_text_id"),
+        "llm__snippet",
+        ["source_text_id"],
+        unique=False,
+    )
+    op.execute(
+        "CREATE CONSTRAINT TRIGGER llm__source_text_bump_corpus_generation "
+        "AFTER INSERT OR UPDATE OR DELETE ON llm__source_text "
+        "DEFERRABLE INITIALLY DEFERRED FOR EACH ROW "
+        "EXECUTE FUNCTION llm__bump_corpus_generation()"
+    )
+    op.execute(
+        "CREATE TRIGGER llm__source_text_truncate_bump_corpus_generation "
+        "AFTER TRUNCATE ON llm__source_text "
+        "FOR EACH STATEMENT EXECUTE FUNCTION llm__bump_corpus_generation()"
+    )
+
+
+def downgrade() -> None:
+    op.execute(
+        "DROP TRIGGER llm__source_text_truncate_bump_corpus_generation "
+        "ON llm__source_text"
+    )
+    op.execute("DROP TRIGGER llm__source_text_bump_corpus_generation ON llm__source_text")
+    op.drop_index(op.f("ix_llm__snippet_source_text_id"), table_name="llm__snippet")
+    op.drop_index("ix_llm__source_text_current_created_at", table_name="llm__source_text")
+    op.drop_index("ix_llm__source_text_tags", table_name="llm__source_text")
+    op.drop_column("llm__source_text", "tags")
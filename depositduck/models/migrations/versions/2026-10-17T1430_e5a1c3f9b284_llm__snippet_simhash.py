@@ -0,0 +1,65 @@
+"""llm__snippet simhash & near_duplicate_of_id
+
+Snippets record a SimHash signature of their content and, if they are a near-duplicate
+of an earlier Snippet of the same SourceText, which one. Each 16-bit band of the
+signature is indexed per SourceText so that candidate near-duplicates are found without
+scanning every Snippet.
+
+Existing Snippets are given a signature when they are next embedded.
+
+Revision ID: e5a1c3f9b284
+Revises: b3e8f61a2c57
+Create Date: 2026-10-17 14:30:27.640915
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import UUID
+
+# revision identifiers, used by Alembic.
+revision: str = "e5a1c3f9b284"
+down_revision: Union[str, None] = "b3e8f61a2c57"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# must match `depositduck.models.llm.SIMHASH_BANDS`
+SIMHASH_BANDS = 4
+BAND_BITS = 64 // SIMHASH_BANDS
+
+
+def upgrade() -> None:
+    op.add_column("llm__snippet", sa.Column("simhash", sa.BigInteger(), nullable=True))
+    op.add_column(
+        "llm__snippet", sa.Column("near_duplicate_of_id", UUID(), nullable=True)
+    )
+    op.create_foreign_key(
+        "llm__snippet_near_duplicate_of_id_fkey",
+        "llm__snippet",
+        "llm__snippet",
+        ["near_duplicate_of_id"],
+        ["id"],
+    )
+    for band in range(SIMHASH_BANDS):
+        op.create_index(
+            f"ix_llm__snippet_simhash_band_{band}",
+            "llm__snippet",
+            [
+                "source_text_id",
+                sa.text(f"((simhash >> {band * BAND_BITS}) & {(1 << BAND_BITS) - 1})"),
+            ],
+            unique=False,
+        )
+
+
+def downgrade() -> None:
+    for band in range(SIMHASH_BANDS):
+        op.drop_index(f"ix_llm__snippet_simhash_band_{band}", table_name="llm__snippet")
+    op.drop_constraint(
+        "llm__snippet_near_duplicate_of_id_fkey", "llm__snippet", type_="foreignkey"
+    )
+    op.drop_column("llm__snippet", "near_duplicate_of_id")
+    op.drop_column("llm__snippet", "simhash")
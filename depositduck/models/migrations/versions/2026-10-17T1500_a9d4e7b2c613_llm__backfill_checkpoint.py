@@ -0,0 +1,58 @@
+"""llm__backfill_checkpoint
+
+Progress of `depositduck.llm.backfill`, one row per embedding model. Saved after each
+page of Snippets is embedded, so an interrupted backfill resumes from the last page it
+finished instead of from the first Snippet.
+
+Revision ID: a9d4e7b2c613
+Revises: e5a1c3f9b284
+Create Date: 2026-10-17 15:00:08.372164
+
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+from alembic import op
+from sqlalchemy.dialects.postgresql import UUID
+
+# revision identifiers, used by Alembic.
+revision: str = "a9d4e7b2c613"
+down_revision: Union[str, None] = "e5a1c3f9b284"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "llm__backfill_checkpoint",
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.Column("llm_name", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("last_snippet_id", UUID(), nullable=True),
+        sa.Column("visited_count", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("created_count", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("reused_count", sa.Integer(), server_default="0", nullable=False),
+        sa.Column(
+            "near_duplicate_count", sa.Integer(), server_default="0", nullable=False
+        ),
+        sa.Column("failed_count", sa.Integer(), server_default="0", nullable=False),
+        sa.Column(
+            "updated_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.Column("completed_at", sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint("llm_name"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("llm__backfill_checkpoint")
@@ -4,15 +4,24 @@ Database tables to keep track of which LLMs are in use and store embeddings.
 (c) 2024 Alberto Morón Hernández
 """
 
+from datetime import datetime
 from uuid import UUID
 
+import sqlalchemy as sa
 from pgvector.sqlalchemy import Vector
-from sqlalchemy import Column, UniqueConstraint
-from sqlmodel import Field, Relationship
+from sqlalchemy import Column, Computed, Index, UniqueConstraint, func
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TSVECTOR
+from sqlmodel import Field, Relationship, SQLModel
 
-from depositduck.models.common import TableBase
+from depositduck.models.common import CreatedAtMixin, TableBase
 from depositduck.models.llm import (
     NOMIC,
+    NOMIC_COARSE_DIMENSIONS,
+    TEXT_SEARCH_CONFIG,
+    ChunkerName,
+    JobBase,
+    JobKind,
+    JobStatus,
     SnippetBase,
     SourceTextBase,
 )
@@ -21,18 +30,50 @@ from depositduck.models.llm import (
 class SourceText(SourceTextBase, TableBase, table=True):
     __tablename__ = "llm__source_text"
 
+    # stored as text rather than a Postgres enum so chunkers can be added freely
+    chunker: ChunkerName | None = Field(default=None, sa_column=Column(sa.String))
+    tags: list[str] = Field(
+        default_factory=list,
+        sa_column=Column(ARRAY(sa.String), nullable=False, server_default="{}"),
+    )
     snippets: list["Snippet"] = Relationship(back_populates="source_text")
 
+    __table_args__ = (
+        Index("ix_llm__source_text_tags", "tags", postgresql_using="gin"),
+        # SourceTexts that have not been deleted, eg. superseded by a newer version
+        Index(
+            "ix_llm__source_text_current_created_at",
+            "created_at",
+            postgresql_where=sa.text("deleted_at IS NULL"),
+        ),
+    )
+
 
 class Snippet(SnippetBase, TableBase, table=True):
     __tablename__ = "llm__snippet"
 
-    source_text_id: UUID = Field(default=None, foreign_key="llm__source_text.id")
+    source_text_id: UUID = Field(
+        default=None, foreign_key="llm__source_text.id", index=True
+    )
+    content_hash: str = Field(index=True)
+    # SimHash of the content's words, see `depositduck.llm.dedup`
+    simhash: int | None = Field(default=None, sa_type=sa.BigInteger)
+    # an earlier Snippet with nearly the same content, embedded in this one's place
+    near_duplicate_of_id: UUID | None = Field(default=None, foreign_key="llm__snippet.id")
+    # maintained by Postgres for full-text search alongside vector similarity search
+    content_tsv: str | None = Field(
+        default=None,
+        sa_column=Column(
+            TSVECTOR,
+            Computed(f"to_tsvector('{TEXT_SEARCH_CONFIG}', content)", persisted=True),
+        ),
+    )
     source_text: SourceText = Relationship(back_populates="snippets")
     nomic_embedding: "EmbeddingNomic" = Relationship(back_populates="snippet")
 
     __table_args__ = (
         UniqueConstraint("source_text_id", "content", name="uq_source_text_content"),
+        Index("ix_llm__snippet_content_tsv", "content_tsv", postgresql_using="gin"),
     )
 
 
@@ -44,5 +85,165 @@ class EmbeddingNomic(TableBase, table=True):
     vector: list[float] = Field(
         sa_column=Column(Vector(NOMIC.dimensions), nullable=False)
     )
-    # TODO: add an approximate index?
-    # https://github.com/pgvector/pgvector-python/tree/master?tab=readme-ov-file#sqlalchemy
+    # `vector` truncated to its leading dimensions, see `truncate_embedding`
+    vector_coarse: list[float] = Field(
+        sa_column=Column(Vector(NOMIC_COARSE_DIMENSIONS), nullable=False)
+    )
+
+    __table_args__ = (UniqueConstraint("snippet_id", name="uq_embedding_nomic_snippet"),)
+    # approximate nearest-neighbour indexes are created by migrations 3f8a2c1d9e47,
+    # 6b3f9a1e2d54 & 0c5d7e3a9f12 according to settings, so are not declared here.
+    # See `VECTOR_INDEX_NAMES` in the migrations `env` module.
+
+
+class Embedding(TableBase, table=True):
+    """
+    Embeddings generated by registered models other than nomic-embed-text.
+    Vectors are dimensionless so models of any size share the table, each model's are
+    indexed by a partial index cast to its dimensions. See `depositduck.llm.registry`.
+    """
+
+    __tablename__ = "llm__embedding"
+
+    snippet_id: UUID = Field(foreign_key="llm__snippet.id")
+    # `EmbeddingModel.tag` of the model that generated the vector
+    llm_name: str
+    vector: list[float] = Field(sa_column=Column(Vector(), nullable=False))
+
+    __table_args__ = (
+        UniqueConstraint("snippet_id", "llm_name", name="uq_embedding_snippet_llm_name"),
+    )
+
+
+class QueryEmbeddingCacheEntry(CreatedAtMixin, SQLModel, table=True):
+    """
+    Embeddings of user queries shared by every app process.
+    See `depositduck.llm.cache.PostgresQueryEmbeddingCache`.
+    """
+
+    __tablename__ = "llm__query_embedding_cache"
+
+    # hash of the model name and normalised query text
+    key: str = Field(primary_key=True)
+    llm_name: str
+    # dimensionless so it can hold embeddings from any model
+    vector: list[float] = Field(sa_column=Column(Vector(), nullable=False))
+    last_used_at: datetime = Field(  # type: ignore
+        sa_type=sa.DateTime(timezone=True),
+        sa_column_kwargs=dict(server_default=func.now()),
+        index=True,
+    )
+
+
+class CorpusGeneration(SQLModel, table=True):
+    """
+    A single row counting transactions that changed SourceTexts, Snippets or their
+    embeddings. Bumped by triggers on those tables, see the `llm__corpus_generation`
+    and `llm__snippet_filters` migrations.
+    """
+
+    __tablename__ = "llm__corpus_generation"
+
+    id: int = Field(
+        default=1,
+        primary_key=True,
+        sa_type=sa.SmallInteger,
+        sa_column_kwargs=dict(server_default="1"),
+    )
+    generation: int = Field(
+        default=0, sa_type=sa.BigInteger, sa_column_kwargs=dict(server_default="0")
+    )
+
+
+class SearchResultCacheEntry(CreatedAtMixin, SQLModel, table=True):
+    """
+    Relevance search results shared by every app process.
+    See `depositduck.llm.cache.PostgresSearchResultCache`.
+    """
+
+    __tablename__ = "llm__search_result_cache"
+
+    # hash of the query, its embedding model & search parameters
+    key: str = Field(primary_key=True)
+    # corpus generation the results were found at, older generations are never served
+    generation: int = Field(sa_type=sa.BigInteger)
+    results: list[dict] = Field(sa_column=Column(JSONB, nullable=False))
+    last_used_at: datetime = Field(  # type: ignore
+        sa_type=sa.DateTime(timezone=True),
+        sa_column_kwargs=dict(server_default=func.now()),
+        index=True,
+    )
+
+
+class BackfillCheckpoint(CreatedAtMixin, SQLModel, table=True):
+    """
+    Progress of the current pass of `depositduck.llm.backfill` for an embedding model,
+    so that an interrupted backfill resumes where it stopped.
+    """
+
+    __tablename__ = "llm__backfill_checkpoint"
+
+    llm_name: str = Field(primary_key=True)
+    # Snippets are walked in id order, every one up to this id has been visited
+    last_snippet_id: UUID | None = None
+    visited_count: int = Field(default=0, sa_column_kwargs=dict(server_default="0"))
+    created_count: int = Field(default=0, sa_column_kwargs=dict(server_default="0"))
+    reused_count: int = Field(default=0, sa_column_kwargs=dict(server_default="0"))
+    near_duplicate_count: int = Field(
+        default=0, sa_column_kwargs=dict(server_default="0")
+    )
+    failed_count: int = Field(default=0, sa_column_kwargs=dict(server_default="0"))
+    updated_at: datetime = Field(  # type: ignore
+        sa_type=sa.DateTime(timezone=True),
+        sa_column_kwargs=dict(server_default=func.now()),
+    )
+    completed_at: datetime | None = Field(sa_type=sa.DateTime(timezone=True))  # type: ignore
+
+
+class Job(JobBase, TableBase, table=True):
+    """
+    Durable queue of background work. See `depositduck.llm.jobs`.
+    """
+
+    __tablename__ = "llm__job"
+
+    kind: JobKind = Field(sa_column=Column(sa.String, nullable=False))
+    payload: dict = Field(sa_column=Column(JSONB, nullable=False))
+    # identifies jobs of the same kind with the same payload, see `llm.jobs`
+    dedupe_key: str
+    status: JobStatus = Field(
+        default=JobStatus.QUEUED,
+        sa_column=Column(sa.String, nullable=False, server_default=JobStatus.QUEUED),
+    )
+    attempts: int = Field(default=0, sa_column_kwargs=dict(server_default="0"))
+    # not claimed before this time, pushed back after each failed attempt
+    run_after: datetime = Field(  # type: ignore
+        sa_type=sa.DateTime(timezone=True),
+        sa_column_kwargs=dict(server_default=func.now()),
+    )
+    worker_id: str | None = None
+    started_at: datetime | None = Field(sa_type=sa.DateTime(timezone=True))  # type: ignore
+    # touched periodically while running, a stale heartbeat means the worker died
+    heartbeat_at: datetime | None = Field(sa_type=sa.DateTime(timezone=True))  # type: ignore
+    finished_at: datetime | None = Field(sa_type=sa.DateTime(timezone=True))  # type: ignore
+    progress_done: int = Field(default=0, sa_column_kwargs=dict(server_default="0"))
+    progress_total: int | None = None
+    result: dict | None = Field(default=None, sa_column=Column(JSONB))
+    last_error: str | None = None
+
+    __table_args__ = (
+        # only unfinished jobs are ever looked up when claiming work
+        Index(
+            "ix_llm__job_claimable",
+            "run_after",
+            postgresql_where=sa.text("status IN ('queued', 'running')"),
+        ),
+        # at most one unfinished job of each kind with the same payload
+        Index(
+            "uq_llm__job_unfinished_dedupe_key",
+            "kind",
+            "dedupe_key",
+            unique=True,
+            postgresql_where=sa.text("status IN ('queued', 'running')"),
+        ),
+    )
@@ -10,7 +10,13 @@ from depositduck.models.sql.auth import AccessToken, User
 from depositduck.models.sql.deposit import Tenancy
 from depositduck.models.sql.email import Email
 from depositduck.models.sql.llm import (
+    BackfillCheckpoint,
+    CorpusGeneration,
+    Embedding,
     EmbeddingNomic,
+    Job,
+    QueryEmbeddingCacheEntry,
+    SearchResultCacheEntry,
     Snippet,
     SourceText,
 )
@@ -13,9 +13,27 @@ a Settings object can be decorated with @lru_cache.
 (c) 2024 Alberto Morón Hernández
 """
 
-from pydantic import PositiveInt, field_validator
+from pydantic import (
+    NonNegativeFloat,
+    NonNegativeInt,
+    PositiveFloat,
+    PositiveInt,
+    field_validator,
+    model_validator,
+)
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from depositduck.models.llm import (
+    EMBEDDING_MODELS,
+    SIMHASH_BANDS,
+    BulkWriteMethod,
+    CacheBackend,
+    ChunkerName,
+    EmbeddingModel,
+    VectorDistance,
+    VectorIndexType,
+    VectorQuantisation,
+)
 from depositduck.utils import is_valid_fernet_key
 
 
@@ -43,6 +61,118 @@ class Settings(BaseSettings):
 
     drallam_origin: str = "http://0.0.0.0:11434"
     drallam_embeddings_model: str = "nomic-embed-text:v1.5"
+    # maximum number of embedding requests in flight at once
+    drallam_embeddings_concurrency: PositiveInt = 8
+    # send several documents per request to `/api/embed` (requires ollama >= 0.3.0)
+    drallam_embeddings_batch_input: bool = False
+    drallam_embeddings_batch_size: PositiveInt = 32
+    # connection pool shared by all requests to draLLaM, timeouts are in seconds
+    drallam_max_connections: PositiveInt = 20
+    drallam_max_keepalive_connections: PositiveInt = 10
+    drallam_keepalive_expiry: PositiveFloat = 30.0
+    drallam_timeout: PositiveFloat = 30.0
+    drallam_connect_timeout: PositiveFloat = 5.0
+    drallam_pool_timeout: PositiveFloat = 10.0
+    # requires the optional `h2` package, ie. `httpx[http2]`
+    drallam_http2: bool = False
+    # each embedding request, including any retries, must complete within the deadline
+    drallam_embeddings_deadline: PositiveFloat = 20.0
+    drallam_embeddings_retries: NonNegativeInt = 2
+    # retries wait a random time up to this, doubling with each attempt
+    drallam_embeddings_retry_backoff: PositiveFloat = 0.25
+    # repeat a request if no response arrives within the p95 latency of recent requests
+    drallam_embeddings_hedge: bool = False
+    # refuse requests for a while after this many consecutive failures
+    drallam_circuit_failure_threshold: PositiveInt = 5
+    drallam_circuit_reset_after: PositiveFloat = 30.0
+    # answer draLLaM requests in-process, see `depositduck.llm.drallam_standin`.
+    # Latency is the mean in seconds added to each response.
+    drallam_standin: bool = False
+    drallam_standin_latency: NonNegativeFloat = 0.0
+    drallam_standin_error_rate: NonNegativeFloat = 0.0
+
+    # approximate nearest-neighbour index on embeddings, read when running migrations.
+    # `vector_distance` must match the operator class the index was built with.
+    vector_index_type: VectorIndexType = VectorIndexType.HNSW
+    vector_distance: VectorDistance = VectorDistance.COSINE
+    vector_hnsw_m: PositiveInt = 16
+    vector_hnsw_ef_construction: PositiveInt = 64
+    # ~sqrt(rows) is a sensible starting point for an IVFFlat index over 1M+ rows
+    vector_ivfflat_lists: PositiveInt = 1000
+    # applied per query: higher values trade latency for recall
+    vector_hnsw_ef_search: PositiveInt = 40
+    vector_ivfflat_probes: PositiveInt = 10
+    # index a quantised copy of embeddings instead, read when running migrations.
+    # Candidates found through it are re-ranked by exact distance to the query.
+    vector_quantisation: VectorQuantisation = VectorQuantisation.NONE
+    # binary quantisation loses more precision so needs more candidates to re-rank
+    vector_rerank_candidates: PositiveInt = 200
+
+    # relevance search fuses vector & full-text search results by reciprocal rank,
+    # weighting each retriever's contribution. A weight of zero disables a retriever.
+    search_vector_weight: NonNegativeFloat = 1.0
+    search_text_weight: NonNegativeFloat = 1.0
+    # dampens the lead of top-ranked results, 60 is the value proposed for RRF
+    search_rrf_k: PositiveInt = 60
+    # results taken from each retriever before fusing them
+    search_candidates: PositiveInt = 50
+    # filtered searches matching at most this many Snippets compare the query to each
+    # exactly, otherwise the approximate index is scanned iteratively (pgvector 0.8+)
+    search_prefilter_max_snippets: PositiveInt = 10_000
+    # results re-ranked for diversity when a search asks for it, see `llm.diversity`
+    search_mmr_pool: PositiveInt = 50
+
+    # embeddings of user queries, keyed by model and normalised query text
+    query_embedding_cache_backend: CacheBackend = CacheBackend.MEMORY
+    query_embedding_cache_max_entries: PositiveInt = 1024
+    query_embedding_cache_ttl_seconds: PositiveInt = 86400
+    # results of `/llm/snippets/relevantToQuery`, invalidated whenever Snippets or
+    # embeddings are written
+    search_result_cache_backend: CacheBackend = CacheBackend.MEMORY
+    search_result_cache_max_entries: PositiveInt = 1024
+    search_result_cache_ttl_seconds: PositiveInt = 3600
+
+    # streamed SourceText uploads are kept in memory up to this many characters, then
+    # spooled to disk until received, and written to the database this many at a time
+    ingestion_flush_characters: PositiveInt = 1_048_576
+    ingestion_snippet_batch_size: PositiveInt = 500
+    # Snippets whose SimHash differs from that of an embedded Snippet of the same
+    # SourceText in at most this many bits are not embedded, see `depositduck.llm.dedup`.
+    # 0 disables the check.
+    ingestion_near_duplicate_distance: NonNegativeInt = 0
+    # how batches of Snippets & embeddings are written to the database
+    ingestion_bulk_write_method: BulkWriteMethod = BulkWriteMethod.COPY
+    # uploads that are embedded as they arrive save & embed Snippets in smaller batches,
+    # handed to this many consumers, each with `drallam_embeddings_concurrency` requests
+    ingestion_pipeline_batch_size: PositiveInt = 64
+    ingestion_pipeline_embedders: PositiveInt = 2
+
+    # default strategy for splitting SourceTexts into Snippets, sizes are in tokens.
+    # nomic-embed-text truncates input beyond 8192 tokens.
+    chunker: ChunkerName = ChunkerName.TOKEN
+    chunker_target_tokens: PositiveInt = 256
+    chunker_max_tokens: PositiveInt = 512
+    chunker_overlap_tokens: NonNegativeInt = 32
+
+    # background jobs, see `depositduck.llm.worker`. Times are in seconds.
+    # jobs each worker process runs at once
+    job_worker_concurrency: PositiveInt = 4
+    # how long an idle worker waits before looking for new jobs
+    job_poll_interval: PositiveFloat = 1.0
+    job_max_attempts: PositiveInt = 5
+    # delay before retrying a failed job doubles with each attempt, up to the maximum
+    job_retry_backoff: PositiveFloat = 5.0
+    job_retry_backoff_max: PositiveFloat = 600.0
+    job_heartbeat_interval: PositiveFloat = 30.0
+    # a running job whose heartbeat is older than this is assumed abandoned
+    job_stale_after: PositiveFloat = 300.0
+
+    # backfill jobs embed Snippets a page at a time, with fewer requests to draLLaM in
+    # flight than ingestion and each request paced so that at most `backfill_max_rate`
+    # Snippets are sent per second, so live searches keep their share of draLLaM & the DB
+    backfill_page_size: PositiveInt = 500
+    backfill_concurrency: PositiveInt = 2
+    backfill_max_rate: PositiveFloat = 50.0
 
     static_origin: str
     speculum_release: str
@@ -61,4 +191,56 @@ class Settings(BaseSettings):
     def remove_origins_trailing_slash(cls, value: str) -> str:
         return value.rstrip("/")
 
+    @property
+    def embedding_model(self) -> EmbeddingModel:
+        """
+        Model used to embed Snippets and queries unless another one is requested.
+        """
+        return EMBEDDING_MODELS[self.drallam_embeddings_model]
+
+    @model_validator(mode="after")
+    def embeddings_model_is_registered(self) -> "Settings":
+        if self.drallam_embeddings_model not in EMBEDDING_MODELS:
+            raise ValueError(
+                f"DRALLAM_EMBEDDINGS_MODEL must be one of {list(EMBEDDING_MODELS)}"
+            )
+        return self
+
+    @field_validator("drallam_standin_error_rate")
+    @classmethod
+    def error_rate_is_a_proportion(cls, value: float) -> float:
+        if value > 1:
+            raise ValueError("DRALLAM_STANDIN_ERROR_RATE must be between 0 and 1")
+        return value
+
+    @field_validator("ingestion_near_duplicate_distance")
+    @classmethod
+    def near_duplicates_share_a_simhash_band(cls, value: int) -> int:
+        if value >= SIMHASH_BANDS:
+            raise ValueError(
+                f"INGESTION_NEAR_DUPLICATE_DISTANCE must be less than {SIMHASH_BANDS}, "
+                "the number of SimHash bands searched for near-duplicates"
+            )
+        return value
+
+    @model_validator(mode="after")
+    def a_search_retriever_is_enabled(self) -> "Settings":
+        if not (self.search_vector_weight or self.search_text_weight):
+            raise ValueError("SEARCH_VECTOR_WEIGHT and SEARCH_TEXT_WEIGHT are both 0")
+        return self
+
+    @model_validator(mode="after")
+    def rerank_candidates_cover_search_candidates(self) -> "Settings":
+        if self.vector_rerank_candidates < self.search_candidates:
+            raise ValueError("VECTOR_RERANK_CANDIDATES is less than SEARCH_CANDIDATES")
+        return self
+
+    @model_validator(mode="after")
+    def chunk_sizes_are_consistent(self) -> "Settings":
+        if self.chunker_target_tokens > self.chunker_max_tokens:
+            raise ValueError("CHUNKER_TARGET_TOKENS exceeds CHUNKER_MAX_TOKENS")
+        if self.chunker_overlap_tokens >= self.chunker_target_tokens:
+            raise ValueError("CHUNKER_OVERLAP_TOKENS must be less than the target")
+        return self
+
     model_config = SettingsConfigDict(env_nested_delimiter="__", frozen=True)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# Compare how quickly Snippets & nomic embeddings are written by each bulk write method,
+# executemany INSERT or binary COPY, against the database in `.env`.
+#
+# Each run writes `--rows` synthetic Snippets of a new SourceText then one random
+# embedding per Snippet, in batches of `--batch-size` as ingestion does. Everything is
+# rolled back afterwards so the database is left as it was.
+#
+# Prerequisites: run from the repository root with the database running and migrated
+#
+# Usage:
+#  . ./local/read_dotenv.sh .env
+#  python -m local.benchmarks.bulk_write --rows 5000 --batch-size 500 --repeat 3
+#
+# (c) 2024 Alberto Morón Hernández
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from itertools import batched
+from uuid import UUID
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from depositduck.dependables import db_session_factory, get_settings
+from depositduck.llm.bulk import write_rows
+from depositduck.llm.registry import embedding_row
+from depositduck.models.llm import NOMIC, BulkWriteMethod, hash_content
+from depositduck.models.sql.llm import EmbeddingNomic, Snippet, SourceText
+from depositduck.settings import Settings
+
+
+async def write_once(
+    session_factory: async_sessionmaker,
+    settings: Settings,
+    rows: int,
+    batch_size: int,
+) -> tuple[float, float]:
+    """
+    Seconds taken to write the Snippets, then their embeddings.
+    """
+    session: AsyncSession
+    async with session_factory() as session:
+        result = await session.execute(
+            insert(SourceText)
+            .values(name="bulk write benchmark", description="", content="")
+            .returning(SourceText.id)  # type: ignore[arg-type]
+        )
+        source_text_id: UUID = result.scalar_one()
+        chunks = [f"benchmark snippet {i} {random.random()}" for i in range(rows)]
+
+        start = time.perf_counter()
+        for batch in batched(chunks, batch_size):
+            snippet_rows = [
+                {
+                    "source_text_id": source_text_id,
+                    "content": chunk,
+                    "content_hash": hash_content(chunk),
+                }
+                for chunk in batch
+            ]
+            await write_rows(settings, session, Snippet.__table__, snippet_rows)  # type: ignore[attr-defined]
+        snippets_seconds = time.perf_counter() - start
+
+        result = await session.execute(
+            select(Snippet.id).where(Snippet.source_text_id == source_text_id)  # type: ignore[arg-type]
+        )
+        snippet_ids = list(result.scalars().all())
+        vectors = [
+            [random.uniform(-1, 1) for _ in range(NOMIC.dimensions)] for _ in snippet_ids
+        ]
+
+        start = time.perf_counter()
+        for batch in batched(zip(snippet_ids, vectors), batch_size):
+            embedding_rows = [
+                embedding_row(NOMIC, snippet_id, vector) for snippet_id, vector in batch
+            ]
+            await write_rows(settings, session, EmbeddingNomic.__table__, embedding_rows)  # type: ignore[attr-defined]
+        embeddings_seconds = time.perf_counter() - start
+
+        await session.rollback()
+    return snippets_seconds, embeddings_seconds
+
+
+async def main(args: argparse.Namespace) -> int:
+    base_settings = get_settings()
+    session_factory = await db_session_factory()
+
+    for method in BulkWriteMethod:
+        settings = Settings(
+            **{**base_settings.model_dump(), "ingestion_bulk_write_method": method}
+        )
+        timings = [
+            await write_once(session_factory, settings, args.rows, args.batch_size)
+            for _ in range(args.repeat)
+        ]
+        snippets_seconds = statistics.median(t[0] for t in timings)
+        embeddings_seconds = statistics.median(t[1] for t in timings)
+        report = {
+            "method": method.value,
+            "rows": args.rows,
+            "batch_size": args.batch_size,
+            "snippets_per_s": round(args.rows / snippets_seconds),
+            "embeddings_per_s": round(args.rows / embeddings_seconds),
+        }
+        print(json.dumps(report))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark bulk writes of Snippets & embeddings by method."
+    )
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+# Compare the chunkers in `depositduck.llm.chunking` on a plain text document.
+#
+# Reports throughput and the distribution of chunk sizes for each chunker. If a
+# draLLaM origin and a queries file are given, also embeds every chunk and reports
+# recall@k: the share of queries for which a chunk containing the expected answer is
+# among the k chunks closest to the query.
+#
+# The queries file is JSON: `[{"query": "...", "answer": "verbatim text"}, ...]`
+#
+# Prerequisites: run from the repository root, draLLaM for retrieval quality
+#
+# Usage:
+#  python -m local.benchmarks.chunking document.txt
+#  python -m local.benchmarks.chunking document.txt \
+#    --queries queries.json --drallam-origin http://0.0.0.0:11434
+#
+# (c) 2024 Alberto Morón Hernández
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from pathlib import Path
+
+import httpx
+import numpy as np
+
+from depositduck.llm.chunking import (
+    Chunker,
+    ParagraphChunker,
+    TokenChunker,
+    estimate_tokens,
+)
+
+# chunks shorter than this are mostly headings & page furniture, poor search results
+FRAGMENT_TOKENS = 16
+# nomic-embed-text's context window, anything longer is truncated
+CONTEXT_TOKENS = 8192
+
+
+def time_chunking(chunker: Chunker, text: str, repeat: int) -> tuple[list[str], float]:
+    best = float("inf")
+    chunks: list[str] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = list(chunker.chunk([text]))
+        best = min(best, time.perf_counter() - start)
+    return chunks, best
+
+
+def size_report(chunks: list[str]) -> dict:
+    sizes = sorted(estimate_tokens(chunk) for chunk in chunks)
+    return {
+        "chunks": len(sizes),
+        "min_tokens": sizes[0],
+        "median_tokens": statistics.median(sizes),
+        "p95_tokens": sizes[int(0.95 * (len(sizes) - 1))],
+        "max_tokens": sizes[-1],
+        "fragments": sum(size < FRAGMENT_TOKENS for size in sizes),
+        "truncated": sum(size > CONTEXT_TOKENS for size in sizes),
+    }
+
+
+async def embed(
+    client: httpx.AsyncClient, model: str, docs: list[str], concurrency: int
+) -> np.ndarray:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def embed_one(doc: str) -> list[float]:
+        async with semaphore:
+            response = await client.post(
+                "/api/embeddings", json={"model": model, "prompt": doc}
+            )
+            response.raise_for_status()
+            return response.json()["embedding"]
+
+    vectors = np.array(await asyncio.gather(*(embed_one(doc) for doc in docs)))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+async def recall_at_k(
+    client: httpx.AsyncClient,
+    model: str,
+    chunks: list[str],
+    queries: list[dict],
+    k: int,
+    concurrency: int,
+) -> float:
+    chunk_vectors = await embed(client, model, chunks, concurrency)
+    query_vectors = await embed(client, model, [q["query"] for q in queries], concurrency)
+    top_k = np.argsort(-(query_vectors @ chunk_vectors.T), axis=1)[:, :k]
+    hits = sum(
+        any(query["answer"] in chunks[i] for i in top)
+        for query, top in zip(queries, top_k)
+    )
+    return hits / len(queries)
+
+
+async def main(args: argparse.Namespace) -> None:
+    text = Path(args.file_path).read_text()
+    chunkers: dict[str, Chunker] = {
+        "paragraph": ParagraphChunker(),
+        "token": TokenChunker(
+            target_tokens=args.target_tokens,
+            max_tokens=args.max_tokens,
+            overlap_tokens=args.overlap_tokens,
+        ),
+    }
+    queries = json.loads(Path(args.queries).read_text()) if args.queries else []
+
+    megabytes = len(text.encode()) / 1_000_000
+    async with httpx.AsyncClient(
+        base_url=args.drallam_origin or "", timeout=60
+    ) as client:
+        for name, chunker in chunkers.items():
+            chunks, seconds = time_chunking(chunker, text, args.repeat)
+            report = {
+                "chunker": name,
+                "mb_per_second": round(megabytes / seconds, 2),
+                **size_report(chunks),
+            }
+            if queries and args.drallam_origin:
+                report[f"recall_at_{args.k}"] = await recall_at_k(
+                    client, args.model, chunks, queries, args.k, args.concurrency
+                )
+            print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark SourceText chunkers.")
+    parser.add_argument("file_path", type=str, help="Path to a plain text document")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--target-tokens", type=int, default=256)
+    parser.add_argument("--max-tokens", type=int, default=512)
+    parser.add_argument("--overlap-tokens", type=int, default=32)
+    parser.add_argument("--queries", type=str, help="Path to a JSON queries file")
+    parser.add_argument("--drallam-origin", type=str)
+    parser.add_argument("--model", type=str, default="nomic-embed-text:v1.5")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=8)
+    asyncio.run(main(parser.parse_args()))
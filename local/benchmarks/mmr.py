@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+# Measure the latency of re-ranking search results for diversity by MMR.
+#
+# Re-ranks pools of random unit vectors the size of nomic-embed-text's embeddings and
+# reports latency percentiles for each pool size. Exits with status 1 if the p95 latency
+# for the largest pool exceeds the budget. Reading the pool's embeddings from the
+# database is not included, see `search.py` for database latency.
+#
+# Prerequisites: run from the repository root
+#
+# Usage:
+#  python -m local.benchmarks.mmr --budget-ms 5
+#  python -m local.benchmarks.mmr --pools 50 100 200 --limit 10
+#
+# (c) 2024 Alberto Morón Hernández
+
+import argparse
+import json
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from depositduck.llm.diversity import mmr_order
+from depositduck.models.llm import NOMIC
+
+
+def percentile(latencies: list[float], p: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[int(p * (len(latencies) - 1))]
+
+
+def main(args: argparse.Namespace) -> int:
+    rng = np.random.default_rng(seed=0)
+    p95_by_pool = {}
+    for pool in args.pools:
+        latencies = []
+        for _ in range(args.repeat):
+            vectors = rng.standard_normal((pool, NOMIC.dimensions), dtype=np.float32)
+            relevance = np.sort(rng.random(pool))[::-1]
+            start = time.perf_counter()
+            mmr_order(relevance, vectors, args.limit, args.mmr_lambda)
+            latencies.append((time.perf_counter() - start) * 1000)
+        p95_by_pool[pool] = percentile(latencies, 0.95)
+        report = {
+            "pool": pool,
+            "limit": args.limit,
+            "p50_ms": round(statistics.median(latencies), 3),
+            "p95_ms": round(p95_by_pool[pool], 3),
+            "max_ms": round(max(latencies), 3),
+        }
+        print(json.dumps(report))
+
+    within_budget = p95_by_pool[max(args.pools)] <= args.budget_ms
+    print(json.dumps({"budget_ms": args.budget_ms, "within_budget": within_budget}))
+    return 0 if within_budget else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark MMR re-ranking latency.")
+    parser.add_argument("--pools", type=int, nargs="+", default=[25, 50, 100, 200])
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--mmr-lambda", type=float, default=0.5)
+    parser.add_argument("--budget-ms", type=float, default=5.0)
+    parser.add_argument("--repeat", type=int, default=200)
+    sys.exit(main(parser.parse_args()))
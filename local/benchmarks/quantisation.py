@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Measure recall@k and latency of vector search over full-precision and quantised
+# embeddings against the database in `.env`, and report the size of each vector index.
+#
+# Exact nearest neighbours are found with index scans disabled. Each mode's results
+# are compared against them: `none` searches the full-precision index, the others
+# search their quantised index and re-rank `--rerank-candidates` by exact distance.
+# A mode without its index falls back to a sequential scan, so its recall is still
+# meaningful but its latency is not.
+#
+# The queries file is JSON: `["deposit protection TDS", "Housing Act 2004 s.213"]`
+#
+# Prerequisites: run from the repository root with the database & draLLaM running,
+#   and Snippets with embeddings loaded
+#
+# Usage:
+#  . ./local/read_dotenv.sh .env
+#  python -m local.benchmarks.quantisation queries.json -k 10
+#
+# (c) 2024 Alberto Morón Hernández
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from uuid import UUID
+
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from depositduck.dependables import db_session_factory, get_settings
+from depositduck.llm.drallam import build_drallam_client
+from depositduck.llm.embeddings import embed_query
+from depositduck.llm.search import distance_to, set_search_params, vector_candidates
+from depositduck.models.llm import VectorQuantisation
+from depositduck.models.sql.llm import EmbeddingNomic
+from depositduck.settings import Settings
+
+
+async def exact_neighbours(
+    session_factory: async_sessionmaker,
+    settings: Settings,
+    query_vector: list[float],
+    k: int,
+) -> set[UUID]:
+    distance = distance_to(settings, EmbeddingNomic.vector, query_vector)  # type: ignore[arg-type]
+    session: AsyncSession
+    async with session_factory.begin() as session:
+        await session.execute(select(func.set_config("enable_indexscan", "off", True)))
+        result = await session.execute(
+            select(EmbeddingNomic.snippet_id).order_by(distance).limit(k)
+        )
+        return set(result.scalars().all())
+
+
+async def index_sizes(session_factory: async_sessionmaker) -> dict[str, int]:
+    session: AsyncSession
+    async with session_factory.begin() as session:
+        result = await session.execute(
+            text(
+                "SELECT indexrelname, pg_relation_size(indexrelid) "
+                "FROM pg_stat_user_indexes WHERE relname = 'llm__embedding_nomic'"
+            )
+        )
+        return {name: size for name, size in result.all()}
+
+
+async def main(args: argparse.Namespace) -> int:
+    base_settings = get_settings()
+    queries: list[str] = json.loads(Path(args.queries).read_text())
+    async with build_drallam_client(base_settings) as drallam_client:
+        query_vectors = [
+            await embed_query(base_settings, drallam_client, None, query)
+            for query in queries
+        ]
+
+    session_factory = await db_session_factory()
+    ground_truth = [
+        await exact_neighbours(session_factory, base_settings, query_vector, args.k)
+        for query_vector in query_vectors
+    ]
+
+    for quantisation in VectorQuantisation:
+        settings = Settings(
+            **{
+                **base_settings.model_dump(),
+                "vector_quantisation": quantisation,
+                "search_candidates": args.k,
+                "vector_rerank_candidates": max(args.k, args.rerank_candidates),
+            }
+        )
+        recalls, latencies = [], []
+        for query_vector, expected in zip(query_vectors, ground_truth):
+            session: AsyncSession
+            async with session_factory.begin() as session:
+                start = time.perf_counter()
+                await set_search_params(session, settings)
+                result = await session.execute(vector_candidates(settings, query_vector))
+                found = {snippet_id for snippet_id, _, _ in result.all()}
+                latencies.append((time.perf_counter() - start) * 1000)
+            if expected:
+                recalls.append(len(found & expected) / len(expected))
+        report = {
+            "quantisation": quantisation.value,
+            f"recall@{args.k}": round(statistics.mean(recalls), 4) if recalls else None,
+            "p50_ms": round(statistics.median(latencies), 2),
+        }
+        print(json.dumps(report))
+
+    print(json.dumps({"index_bytes": await index_sizes(session_factory)}))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark recall of vector search over quantised embeddings."
+    )
+    parser.add_argument("queries", type=str, help="Path to a JSON list of queries")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--rerank-candidates", type=int, default=200)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+
+# Measure latency, throughput and recall@k of relevance search over synthetic corpora
+# of increasing size in the database in `.env`.
+#
+# Tops up a synthetic SourceText until the model has `--sizes` embeddings in total, then
+# runs a query set through the same statement as `/llm/snippets/relevantToQuery`, once
+# with vector search only and once hybrid. Each result is compared with the exact
+# nearest neighbours, found with index scans disabled. Hybrid recall is lower wherever
+# full-text matches displace vector neighbours.
+#
+# Vectors are drawn around `--clusters` topics, each with its own vocabulary, so queries
+# have close neighbours and matching text. The corpus is kept between runs: later runs
+# reuse it and only add the vectors missing for larger sizes. Embeddings already in the
+# database count towards each size, so use a database of its own.
+#
+# Prints one JSON line per size & mode. `--output` also writes the run, with the search
+# settings and commit it was made at, as a JSON document. Pass a previous one as
+# `--baseline` to report changes in p95 latency and recall.
+#
+# Prerequisites: run from the repository root with the database running and migrated
+#
+# Usage:
+#  . ./local/read_dotenv.sh .env
+#  python -m local.benchmarks.retrieval --sizes 10000 100000 --output run.json
+#  python -m local.benchmarks.retrieval --set vector_ivfflat_probes=20 --baseline run.json
+#  python -m local.benchmarks.retrieval --sizes 1000000 --concurrency 8 --drop
+#
+# (c) 2024 Alberto Morón Hernández
+
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+from uuid import UUID
+
+import numpy as np
+from sqlalchemy import Select, delete, func, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from depositduck.dependables import db_session_factory, get_settings
+from depositduck.llm.bulk import write_rows
+from depositduck.llm.cache import SEARCH_SETTINGS
+from depositduck.llm.registry import embedding_row, embedding_table, embeddings_of
+from depositduck.llm.search import distance_to, hybrid_search, set_search_params
+from depositduck.models.llm import (
+    EMBEDDING_MODELS,
+    NOMIC,
+    EmbeddingModel,
+    get_embedding_model,
+    hash_content,
+)
+from depositduck.models.sql.llm import Snippet, SourceText
+from depositduck.settings import Settings
+
+CORPUS_NAME = "retrieval benchmark"
+TOPIC_WORDS = 20
+
+
+def percentile(latencies: list[float], p: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[int(p * (len(latencies) - 1))]
+
+
+class Corpus:
+    """
+    Deterministic topics for `seed`: a centre vector and a vocabulary each.
+    """
+
+    def __init__(self, model: EmbeddingModel, clusters: int, seed: int) -> None:
+        self.model = model
+        self.seed = seed
+        centres = np.random.default_rng(seed).standard_normal(
+            (clusters, model.dimensions), dtype=np.float32
+        )
+        self.centres = centres / np.linalg.norm(centres, axis=1, keepdims=True)
+
+    def words(self, topic: int) -> list[str]:
+        return [f"topic{topic}term{j}" for j in range(TOPIC_WORDS)]
+
+    def vectors(self, rng: np.random.Generator, count: int, spread: float) -> Any:
+        topics = rng.integers(len(self.centres), size=count)
+        noise = rng.standard_normal((count, self.model.dimensions), dtype=np.float32)
+        vectors = self.centres[topics] + spread * noise / np.sqrt(self.model.dimensions)
+        return topics, vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def snippets(self, start: int, count: int) -> list[tuple[str, list[float]]]:
+        rng = np.random.default_rng([self.seed, 0, start])
+        topics, vectors = self.vectors(rng, count, spread=1.0)
+        return [
+            (
+                f"benchmark snippet {start + i} "
+                + " ".join(rng.choice(self.words(topic), size=8).tolist()),
+                vector.tolist(),
+            )
+            for i, (topic, vector) in enumerate(zip(topics.tolist(), vectors))
+        ]
+
+    def queries(self, count: int) -> list[tuple[str, list[float]]]:
+        rng = np.random.default_rng([self.seed, 1])
+        topics, vectors = self.vectors(rng, count, spread=1.0)
+        return [
+            (" ".join(rng.choice(self.words(topic), size=3).tolist()), vector.tolist())
+            for topic, vector in zip(topics.tolist(), vectors)
+        ]
+
+
+async def corpus_source_text_id(session_factory: async_sessionmaker) -> UUID:
+    session: AsyncSession
+    async with session_factory.begin() as session:
+        result = await session.execute(
+            select(SourceText.id).where(SourceText.name == CORPUS_NAME)  # type: ignore[arg-type]
+        )
+        if (source_text_id := result.scalars().first()) is not None:
+            return source_text_id
+        result = await session.execute(
+            insert(SourceText)
+            .values(name=CORPUS_NAME, description="", content="", tags=["benchmark"])
+            .returning(SourceText.id)  # type: ignore[arg-type]
+        )
+        return result.scalar_one()
+
+
+async def count_rows(session_factory: async_sessionmaker, statement: Select) -> int:
+    session: AsyncSession
+    async with session_factory.begin() as session:
+        result = await session.execute(statement)
+        return result.scalar_one()
+
+
+async def top_up(
+    session_factory: async_sessionmaker,
+    settings: Settings,
+    corpus: Corpus,
+    source_text_id: UUID,
+    size: int,
+    batch_size: int,
+) -> int:
+    """
+    Add synthetic Snippets & embeddings until `corpus.model` has `size` embeddings,
+    committing each batch. Returns how many it has.
+    """
+    model = corpus.model
+    embeddings = embeddings_of(model)
+    vector_count = select(func.count()).select_from(embeddings)
+    snippet_count = select(func.count()).where(Snippet.source_text_id == source_text_id)  # type: ignore[arg-type]
+    current = await count_rows(session_factory, vector_count)
+    start = await count_rows(session_factory, snippet_count)
+    while current < size:
+        count = min(batch_size, size - current)
+        snippets = corpus.snippets(start, count)
+        session: AsyncSession
+        async with session_factory.begin() as session:
+            snippet_rows = [
+                {
+                    "source_text_id": source_text_id,
+                    "content": content,
+                    "content_hash": hash_content(content),
+                }
+                for content, _ in snippets
+            ]
+            snippet_table = Snippet.__table__  # type: ignore[attr-defined]
+            snippet_ids = await write_rows(settings, session, snippet_table, snippet_rows)
+            embedding_rows = [
+                embedding_row(model, snippet_id, vector)
+                for snippet_id, (_, vector) in zip(snippet_ids, snippets)
+            ]
+            await write_rows(
+                settings,
+                session,
+                embedding_table(model).__table__,  # type: ignore[attr-defined]
+                embedding_rows,
+            )
+        start += count
+        current += len(snippet_ids)
+        print(json.dumps({"building": size, "vectors": current}), file=sys.stderr)
+
+    async with session_factory.begin() as session:
+        await session.execute(text(f"ANALYZE {embedding_table(model).__tablename__}"))
+    return current
+
+
+async def exact_neighbours(
+    session_factory: async_sessionmaker,
+    settings: Settings,
+    model: EmbeddingModel,
+    query_vector: list[float],
+    k: int,
+) -> set[UUID]:
+    embeddings = embeddings_of(model)
+    distance_measure = model.distance if model != NOMIC else None
+    distance = distance_to(settings, embeddings.c.vector, query_vector, distance_measure)
+    session: AsyncSession
+    async with session_factory.begin() as session:
+        await session.execute(select(func.set_config("enable_indexscan", "off", True)))
+        result = await session.execute(
+            select(embeddings.c.snippet_id).order_by(distance).limit(k)
+        )
+        return set(result.scalars().all())
+
+
+async def run_queries(
+    session_factory: async_sessionmaker,
+    settings: Settings,
+    model: EmbeddingModel,
+    queries: list[tuple[str, list[float]]],
+    k: int,
+    repeat: int,
+    concurrency: int,
+) -> tuple[list[float], list[set[UUID]], float]:
+    """
+    Per-query latencies in milliseconds, the Snippets found for each query on its last
+    repeat, and the total seconds taken with `concurrency` queries in flight.
+    """
+    pending: asyncio.Queue[tuple[int, tuple[str, list[float]]]] = asyncio.Queue()
+    for _ in range(repeat):
+        for index, query in enumerate(queries):
+            pending.put_nowait((index, query))
+    latencies: list[float] = []
+    found: list[set[UUID]] = [set() for _ in queries]
+
+    async def worker() -> None:
+        while not pending.empty():
+            index, (query, query_vector) = pending.get_nowait()
+            session: AsyncSession
+            async with session_factory.begin() as session:
+                start = time.perf_counter()
+                await set_search_params(session, settings)
+                result = await session.execute(
+                    hybrid_search(settings, query, query_vector, k, model=model)
+                )
+                found[index] = {row.snippet_id for row in result.all()}
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, found, time.perf_counter() - start
+
+
+async def drop_corpus(session_factory: async_sessionmaker, source_text_id: UUID) -> None:
+    snippet_ids = select(Snippet.id).where(Snippet.source_text_id == source_text_id)  # type: ignore[arg-type]
+    session: AsyncSession
+    async with session_factory.begin() as session:
+        for table in {embedding_table(model) for model in EMBEDDING_MODELS.values()}:
+            await session.execute(
+                delete(table).where(table.snippet_id.in_(snippet_ids))  # type: ignore[attr-defined]
+            )
+        await session.execute(delete(Snippet).where(Snippet.id.in_(snippet_ids)))  # type: ignore[union-attr]
+        await session.execute(delete(SourceText).where(SourceText.id == source_text_id))  # type: ignore[arg-type]
+
+
+def git_commit() -> str | None:
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+    )
+    return result.stdout.strip() or None
+
+
+async def pgvector_version(session_factory: async_sessionmaker) -> str | None:
+    session: AsyncSession
+    async with session_factory.begin() as session:
+        result = await session.execute(
+            text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        )
+        return result.scalar_one_or_none()
+
+
+def compare(report: dict[str, Any], baseline: list[dict[str, Any]], k: int) -> None:
+    for previous in baseline:
+        if (previous["size"], previous["mode"]) == (report["size"], report["mode"]):
+            report["p95_ms_change"] = round(report["p95_ms"] - previous["p95_ms"], 2)
+            report[f"recall@{k}_change"] = round(
+                report[f"recall@{k}"] - previous[f"recall@{k}"], 4
+            )
+
+
+async def main(args: argparse.Namespace) -> int:
+    overrides = dict(override.split("=", 1) for override in args.set)
+    base_settings = Settings(**{**get_settings().model_dump(), **overrides})
+    model = get_embedding_model(args.model or base_settings.drallam_embeddings_model)
+    baseline = (
+        json.loads(Path(args.baseline).read_text())["results"] if args.baseline else []
+    )
+
+    session_factory = await db_session_factory()
+    source_text_id = await corpus_source_text_id(session_factory)
+    corpus = Corpus(model, args.clusters, args.seed)
+    queries = corpus.queries(args.queries)
+    modes = {
+        "vector": dict(search_vector_weight=1.0, search_text_weight=0.0),
+        "hybrid": dict(),
+    }
+
+    results = []
+    for size in sorted(args.sizes):
+        vectors = await top_up(
+            session_factory, base_settings, corpus, source_text_id, size, args.batch_size
+        )
+        ground_truth = [
+            await exact_neighbours(session_factory, base_settings, model, vector, args.k)
+            for _, vector in queries
+        ]
+        for mode, mode_overrides in modes.items():
+            settings = Settings(
+                **{
+                    **base_settings.model_dump(),
+                    "search_candidates": max(base_settings.search_candidates, args.k),
+                    **mode_overrides,
+                }
+            )
+            latencies, found, seconds = await run_queries(
+                session_factory,
+                settings,
+                model,
+                queries,
+                args.k,
+                args.repeat,
+                args.concurrency,
+            )
+            recalls = [
+                len(found_ids & expected) / len(expected)
+                for found_ids, expected in zip(found, ground_truth)
+                if expected
+            ]
+            report = {
+                "size": size,
+                "vectors": vectors,
+                "mode": mode,
+                "queries": len(latencies),
+                "concurrency": args.concurrency,
+                "p50_ms": round(statistics.median(latencies), 2),
+                "p95_ms": round(percentile(latencies, 0.95), 2),
+                "p99_ms": round(percentile(latencies, 0.99), 2),
+                "qps": round(len(latencies) / seconds, 1),
+                f"recall@{args.k}": round(statistics.mean(recalls), 4),
+            }
+            compare(report, baseline, args.k)
+            print(json.dumps(report))
+            results.append(report)
+
+    if args.output:
+        run = {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "pgvector": await pgvector_version(session_factory),
+            "model": model.tag,
+            "k": args.k,
+            "clusters": args.clusters,
+            "seed": args.seed,
+            "settings": base_settings.model_dump(mode="json", include=SEARCH_SETTINGS),
+        }
+        Path(args.output).write_text(
+            json.dumps({"run": run, "results": results}, indent=2)
+        )
+    if args.drop:
+        await drop_corpus(session_factory, source_text_id)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark relevance search latency, throughput & recall by size."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--model", type=str, help="Tag of a registered embedding model")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="SETTING=VALUE",
+        help="Override a setting, eg. vector_hnsw_ef_search=100",
+    )
+    parser.add_argument("--output", type=str, help="Path to write the run as JSON")
+    parser.add_argument("--baseline", type=str, help="Path of a previous `--output`")
+    parser.add_argument("--drop", action="store_true", help="Delete the corpus after")
+    sys.exit(asyncio.run(main(parser.parse_args())))
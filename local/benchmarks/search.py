@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# Measure the latency of relevance search against the database in `.env`.
+#
+# Runs each query with vector search only, full-text search only and hybrid search
+# (both, fused by reciprocal rank) and reports latency percentiles for each. Exits
+# with status 1 if the p95 latency of hybrid search exceeds the budget.
+# Query embeddings are generated once up front, so only database time is measured.
+#
+# The queries file is JSON: `["deposit protection TDS", "Housing Act 2004 s.213"]`
+#
+# Prerequisites: run from the repository root with the database & draLLaM running,
+#   and Snippets with embeddings loaded
+#
+# Usage:
+#  . ./local/read_dotenv.sh .env
+#  python -m local.benchmarks.search queries.json --budget-ms 50
+#  python -m local.benchmarks.search queries.json --model mxbai-embed-large:v1
+#
+# (c) 2024 Alberto Morón Hernández
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from depositduck.dependables import db_session_factory, get_settings
+from depositduck.llm.drallam import build_drallam_client
+from depositduck.llm.embeddings import embed_query
+from depositduck.llm.search import hybrid_search, set_search_params
+from depositduck.models.llm import get_embedding_model
+from depositduck.settings import Settings
+
+
+def percentile(latencies: list[float], p: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[int(p * (len(latencies) - 1))]
+
+
+async def main(args: argparse.Namespace) -> int:
+    base_settings = get_settings()
+    model = get_embedding_model(args.model or base_settings.drallam_embeddings_model)
+    queries: list[str] = json.loads(Path(args.queries).read_text())
+    async with build_drallam_client(base_settings) as drallam_client:
+        query_vectors = [
+            await embed_query(base_settings, drallam_client, None, query, model)
+            for query in queries
+        ]
+
+    modes = {
+        "vector": dict(search_vector_weight=1.0, search_text_weight=0.0),
+        "text": dict(search_vector_weight=0.0, search_text_weight=1.0),
+        "hybrid": dict(),
+    }
+    session_factory = await db_session_factory()
+    p95_by_mode = {}
+    for mode, overrides in modes.items():
+        settings = Settings(**{**base_settings.model_dump(), **overrides})
+        latencies = []
+        for _ in range(args.repeat):
+            for query, query_vector in zip(queries, query_vectors):
+                session: AsyncSession
+                async with session_factory.begin() as session:
+                    start = time.perf_counter()
+                    await set_search_params(session, settings)
+                    result = await session.execute(
+                        hybrid_search(
+                            settings, query, query_vector, args.limit, model=model
+                        )
+                    )
+                    result.all()
+                    latencies.append((time.perf_counter() - start) * 1000)
+        p95_by_mode[mode] = percentile(latencies, 0.95)
+        report = {
+            "mode": mode,
+            "model": model.tag,
+            "queries": len(latencies),
+            "p50_ms": round(statistics.median(latencies), 2),
+            "p95_ms": round(p95_by_mode[mode], 2),
+            "max_ms": round(max(latencies), 2),
+        }
+        print(json.dumps(report))
+
+    within_budget = p95_by_mode["hybrid"] <= args.budget_ms
+    print(json.dumps({"budget_ms": args.budget_ms, "within_budget": within_budget}))
+    return 0 if within_budget else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark relevance search latency.")
+    parser.add_argument("queries", type=str, help="Path to a JSON list of queries")
+    parser.add_argument("--budget-ms", type=float, default=50.0)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--limit", type=int, default=5)
+    parser.add_argument("--model", type=str, help="Tag of a registered embedding model")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -1,22 +1,42 @@
 #!/usr/bin/env python
 
-# Call the Tika PDF parser to extract text and post text to the `/llm/SourceText` endpoint
+# Extract text from PDFs and either save it for `raw_sourcetext_to_database.sh` or post
+# it straight to the `/llm/sourceTexts/upload` endpoint.
 #
-# Prerequisites: docker, curl
+# Text is extracted in-process by pypdf by default, one page at a time, so pages are
+# written or uploaded as they are read. Several PDFs are processed in parallel by a
+# pool of `--workers` processes. The Apache Tika backend (`--backend tika`) runs Tika in
+# a container and extracts each document in one go.
+#
+# Prerequisites: the `pdf` extra (`uv sync --extra pdf`) for pypdf, or docker & curl for
+#   Tika. The DepositDuck app running locally to `--upload`.
 #
 # Usage:
-#  python pdf_to_sourcetext.py some-file.pdf
+#  # extract one PDF to `sourcetext.tmp` in this directory
+#  python pdf_to_raw_sourcetext.py some-file.pdf
+#  # extract a folder of PDFs, each to `<out-dir>/<name>.txt`
+#  python pdf_to_raw_sourcetext.py guidance/ --workers 8
+#  # upload each PDF as a SourceText named after the file, embedding it as it arrives
+#  python pdf_to_raw_sourcetext.py guidance/ --upload --embed
 #
 # (c) 2024 Alberto Morón Hernández
 
 import argparse
 import json
+import os
 import subprocess
+import sys
 import time
 import urllib.request
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Callable, Iterator, NamedTuple
+
+import httpx
 
 CURRENT_DIR = Path(__file__).resolve().parent
+APP_ORIGIN = os.environ.get("APP_ORIGIN", "http://0.0.0.0:8000")
+TIKA_PORT = 9998
 
 
 def check_pdf_file(file_path: Path):
@@ -50,7 +70,7 @@ def check_port(url, max_attempts=10) -> bool:
     return False
 
 
-def run_tika(version="2.9.1.0", host_port=9998) -> None:
+def run_tika(version="2.9.1.0", host_port=TIKA_PORT) -> None:
     """
     Apache Tika is a tool to extract text from files.
     Here we use it for its PDF capabilities.
@@ -79,7 +99,7 @@ def run_tika(version="2.9.1.0", host_port=9998) -> None:
         print(result.stderr)
 
 
-def tika_extract_text(file_path: Path, tika_port=9998) -> str | None:
+def tika_extract_text(file_path: Path, tika_port=TIKA_PORT) -> str | None:
     tika_cmd = f"""
     curl \
         --upload-file {str(file_path)} \
@@ -99,30 +119,168 @@ def tika_extract_text(file_path: Path, tika_port=9998) -> str | None:
     return None
 
 
-def write_text_to_file(text: str, path: Path):
-    with open(path, "w") as file:
-        file.write(text)
+def tika_pages(file_path: Path) -> Iterator[str]:
+    """
+    Tika extracts the whole document at once, so it is yielded as a single page.
+    """
+    text = tika_extract_text(file_path)
+    if text:
+        yield text
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description="Check if a file path points to a PDF file."
+def pypdf_pages(file_path: Path) -> Iterator[str]:
+    """
+    Pages are parsed lazily, so only the page being extracted is held in memory.
+    """
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise RuntimeError("the pypdf backend needs the `pdf` extra installed") from e
+
+    reader = PdfReader(file_path)
+    for page in reader.pages:
+        yield page.extract_text() + "\n"
+
+
+PAGE_EXTRACTORS: dict[str, Callable[[Path], Iterator[str]]] = {
+    "pypdf": pypdf_pages,
+    "tika": tika_pages,
+}
+
+
+class ExtractionJob(NamedTuple):
+    file_path: Path
+    backend: str
+    # write text to this file, unless `upload_url` is given
+    destination: Path | None
+    upload_url: str | None = None
+
+
+class ExtractionReport(NamedTuple):
+    file_path: str
+    pages: int
+    characters: int
+    seconds: float
+    # the response of the upload endpoint, if uploaded
+    response: dict | None = None
+
+
+def extract(job: ExtractionJob) -> ExtractionReport:
+    """
+    Run in a worker process: extract a PDF page by page, writing or uploading each page
+    as soon as it is extracted.
+    """
+    start = time.perf_counter()
+    pages, characters = 0, 0
+
+    def counted(page_texts: Iterator[str]) -> Iterator[str]:
+        nonlocal pages, characters
+        for text in page_texts:
+            pages += 1
+            characters += len(text)
+            yield text
+
+    page_texts = counted(PAGE_EXTRACTORS[job.backend](job.file_path))
+    response_data = None
+    if job.upload_url:
+        params = {"name": job.file_path.stem, "filename": job.file_path.name}
+        # a generator body is sent with chunked transfer encoding
+        response = httpx.post(
+            job.upload_url,
+            params=params,
+            content=(text.encode() for text in page_texts),
+            headers={"content-type": "text/plain; charset=utf-8"},
+            timeout=None,
+        )
+        response.raise_for_status()
+        response_data = response.json()
+    elif job.destination:
+        with open(job.destination, "w") as file:
+            for text in page_texts:
+                file.write(text)
+
+    return ExtractionReport(
+        file_path=str(job.file_path),
+        pages=pages,
+        characters=characters,
+        seconds=round(time.perf_counter() - start, 3),
+        response=response_data,
     )
-    parser.add_argument("file_path", type=str, help="Path to the file")
-    args = parser.parse_args()
 
-    depositduck_port = 8000
-    check_port(f"http://0.0.0.0:{depositduck_port}")
 
-    infile_path = CURRENT_DIR / args.file_path
-    if check_pdf_file(infile_path):
-        tika_port = 9998
-        run_tika(host_port=tika_port)
+def find_pdfs(paths: list[str]) -> list[Path]:
+    """
+    Paths are relative to the working directory, or failing that to this directory.
+    """
+    pdfs: list[Path] = []
+    for path in (Path(p) if Path(p).exists() else CURRENT_DIR / p for p in paths):
+        if path.is_dir():
+            pdfs.extend(sorted(p for p in path.rglob("*") if p.suffix.lower() == ".pdf"))
+        elif check_pdf_file(path):
+            pdfs.append(path)
+    return pdfs
+
+
+def build_jobs(args: argparse.Namespace, pdfs: list[Path]) -> list[ExtractionJob]:
+    if args.upload:
+        endpoint = "uploadAndEmbed" if args.embed else "upload"
+        upload_url = f"{APP_ORIGIN}/llm/sourceTexts/{endpoint}"
+        return [ExtractionJob(pdf, args.backend, None, upload_url) for pdf in pdfs]
+    if len(pdfs) == 1:
+        # picked up by `raw_sourcetext_to_database.sh`
+        return [ExtractionJob(pdfs[0], args.backend, CURRENT_DIR / "sourcetext.tmp")]
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    return [ExtractionJob(pdf, args.backend, out_dir / f"{pdf.stem}.txt") for pdf in pdfs]
+
 
-        check_port(f"http://0.0.0.0:{tika_port}")
+def main(args: argparse.Namespace) -> int:
+    pdfs = find_pdfs(args.paths)
+    if not pdfs:
+        print("Error: no PDF files found.")
+        return 1
 
-        text = tika_extract_text(infile_path)
+    if args.upload:
+        check_port(APP_ORIGIN)
+    if args.backend == "tika":
+        run_tika(host_port=TIKA_PORT)
+        check_port(f"http://0.0.0.0:{TIKA_PORT}")
 
-        if text:
-            tmpfile_path = CURRENT_DIR / "sourcetext.tmp"
-            write_text_to_file(text, tmpfile_path)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(extract, job): job for job in build_jobs(args, pdfs)}
+        for future in as_completed(futures):
+            try:
+                print(json.dumps(future.result()._asdict()))
+            except Exception as e:
+                failed += 1
+                print(f"Error: could not extract '{futures[future].file_path}': {e}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract text from PDFs to save or upload as SourceTexts."
+    )
+    parser.add_argument(
+        "paths", type=str, nargs="+", help="PDF files, or directories to search for PDFs"
+    )
+    parser.add_argument("--backend", choices=list(PAGE_EXTRACTORS), default="pypdf")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--out-dir",
+        type=str,
+        default=str(CURRENT_DIR / "sourcetexts"),
+        help="where to write text extracted from several PDFs",
+    )
+    parser.add_argument(
+        "--upload",
+        action="store_true",
+        help="post each PDF's text to the app instead of writing it to a file",
+    )
+    parser.add_argument(
+        "--embed",
+        action="store_true",
+        help="with --upload, embed Snippets as they are created",
+    )
+    sys.exit(main(parser.parse_args()))
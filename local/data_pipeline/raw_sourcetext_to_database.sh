@@ -1,24 +1,32 @@
 #!/bin/bash
 
-# Insert the output of `pdf_to_raw_sourcetext.py` into the database.
+# Stream the output of `pdf_to_raw_sourcetext.py` to the llm app, which saves it as a
+# SourceText and splits it into Snippets as it arrives.
+#
+# Prerequisites: curl, the DepositDuck app running locally
 #
 # Usage:
-#  PGPASSWORD=password ./raw_sourcetext_to_database.sh
+#  ./raw_sourcetext_to_database.sh "Name of the source" ["Optional description"]
 #
 # (c) 2024 Alberto Morón Hernández
 
 set -ex
 
-DB_NAME="depositduck"
-TABLE_NAME="llm__source_text"
+APP_ORIGIN="${APP_ORIGIN:-http://0.0.0.0:8000}"
 TEXT_FILE="$(pwd)/local/data_pipeline/sourcetext.tmp"
 
-TEXT=$(cat $TEXT_FILE)
-# escape apostrophes using parameter expansion
-ESCAPED_TEXT=$(echo "$TEXT" | sed "s/'/''/g")
+NAME="${1:?a name for the SourceText is required}"
+DESCRIPTION="${2:-}"
 
-SQL_COMMAND="INSERT INTO $TABLE_NAME (name, description, content) VALUES ('','', '$ESCAPED_TEXT');"
+QUERY=$(python3 -c \
+  'import sys, urllib.parse; print(urllib.parse.urlencode({"name": sys.argv[1], "description": sys.argv[2]}))' \
+  "$NAME" "$DESCRIPTION")
 
-psql -h localhost -p 5432 -U postgres -d $DB_NAME -c "$SQL_COMMAND"
+# `--upload-file` streams the file from disk instead of reading it into memory
+curl --fail-with-body \
+  --upload-file "$TEXT_FILE" \
+  --request POST \
+  --header "Content-Type: text/plain; charset=utf-8" \
+  "$APP_ORIGIN/llm/sourceTexts/upload?$QUERY"
 
-rm $TEXT_FILE
+rm "$TEXT_FILE"
@@ -0,0 +1,198 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+from uuid import UUID, uuid4
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from depositduck.llm import backfill as backfill_module
+from depositduck.llm.backfill import find_page, run_backfill
+from depositduck.llm.embeddings import EmbeddingError
+from depositduck.llm.ingestion import SnippetToEmbed
+from depositduck.llm.resilience import TokenBucket
+from depositduck.models.dto.llm import EmbeddingsCreated
+from depositduck.models.llm import NOMIC
+from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
+
+
+def get_settings(**overrides) -> Settings:
+    return Settings(
+        **{
+            **get_valid_settings().model_dump(),
+            "backfill_max_rate": 1_000_000,
+            **overrides,
+        }
+    )
+
+
+def get_session_factory() -> MagicMock:
+    session_factory = MagicMock(spec=async_sessionmaker)
+
+    @asynccontextmanager
+    async def begin():
+        yield MagicMock()
+
+    session_factory.begin = begin
+    return session_factory
+
+
+def as_snippets(count: int) -> list[SnippetToEmbed]:
+    return sorted(
+        (SnippetToEmbed(uuid4(), uuid4(), "deposit", "hash") for _ in range(count)),
+        key=lambda snippet: snippet.id,
+    )
+
+
+class FakeBackfill:
+    """
+    Stands in for the database: serves `pages` of Snippets after the checkpoint and
+    records every checkpoint saved.
+    """
+
+    def __init__(self, monkeypatch, pages, resume_after=None, embedded=None):
+        self.pages = list(pages)
+        self.resume_after = resume_after
+        self.embedded = embedded or (
+            lambda snippets: EmbeddingsCreated(created_count=len(snippets))
+        )
+        self.afters: list[UUID | None] = []
+        self.settings: list[Settings] = []
+        self.rate_limits: list[TokenBucket | None] = []
+        self.checkpoints: list[tuple[UUID, int]] = []
+        self.completed = False
+        for name in (
+            "start_pass",
+            "find_page",
+            "embed_snippets",
+            "save_checkpoint",
+            "complete_pass",
+        ):
+            monkeypatch.setattr(backfill_module, name, getattr(self, name))
+
+    async def start_pass(self, session, model, restart=False):
+        return SimpleNamespace(last_snippet_id=self.resume_after)
+
+    async def find_page(self, session, model, after, limit):
+        self.afters.append(after)
+        return self.pages.pop(0) if self.pages else []
+
+    async def embed_snippets(
+        self,
+        settings,
+        db_session_factory,
+        client,
+        snippets,
+        model,
+        on_saved=None,
+        rate_limit=None,
+    ):
+        self.settings.append(settings)
+        self.rate_limits.append(rate_limit)
+        return self.embedded(snippets)
+
+    async def save_checkpoint(self, session, model, last_snippet_id, visited, created):
+        self.checkpoints.append((last_snippet_id, visited))
+
+    async def complete_pass(self, session, model):
+        self.completed = True
+
+
+@pytest.mark.asyncio
+async def test_find_page_walks_missing_snippets_by_keyset():
+    statements = []
+
+    async def execute(statement):
+        statements.append(statement)
+        return SimpleNamespace(all=lambda: [])
+
+    session = MagicMock()
+    session.execute = execute
+
+    await find_page(session, NOMIC, uuid4(), limit=100)
+
+    sql = str(statements[0])
+    assert "llm__snippet.id > :id_1" in sql
+    assert "llm__embedding_nomic.id IS NULL" in sql
+    assert "llm__snippet.near_duplicate_of_id IS NULL" in sql
+    assert sql.endswith("ORDER BY llm__snippet.id\n LIMIT :param_1")
+
+
+@pytest.mark.asyncio
+async def test_run_backfill_resumes_from_checkpoint(monkeypatch):
+    resume_after = uuid4()
+    pages = [as_snippets(3), as_snippets(2)]
+    fake = FakeBackfill(monkeypatch, pages, resume_after=resume_after)
+
+    progress = []
+
+    async def on_progress(done, total):
+        progress.append((done, total))
+
+    total, completed = await run_backfill(
+        get_settings(), get_session_factory(), None, NOMIC, on_progress=on_progress
+    )
+
+    assert fake.afters == [resume_after, pages[0][-1].id, pages[1][-1].id]
+    assert fake.checkpoints == [(pages[0][-1].id, 3), (pages[1][-1].id, 2)]
+    assert fake.completed and completed
+    assert total.created_count == 5
+    assert progress == [(3, None), (5, None)]
+
+
+@pytest.mark.asyncio
+async def test_run_backfill_failed_page_keeps_checkpoint(monkeypatch):
+    fake = FakeBackfill(
+        monkeypatch,
+        [as_snippets(2)],
+        embedded=lambda snippets: EmbeddingsCreated(
+            created_count=0, failed_count=len(snippets)
+        ),
+    )
+
+    with pytest.raises(EmbeddingError):
+        await run_backfill(get_settings(), get_session_factory(), None, NOMIC)
+
+    assert fake.checkpoints == []
+    assert not fake.completed
+
+
+@pytest.mark.asyncio
+async def test_run_backfill_stops_after_current_page(monkeypatch):
+    stopping = asyncio.Event()
+
+    def embedded(snippets):
+        stopping.set()
+        return EmbeddingsCreated(created_count=len(snippets))
+
+    pages = [as_snippets(2), as_snippets(2)]
+    fake = FakeBackfill(monkeypatch, pages, embedded=embedded)
+
+    _, completed = await run_backfill(
+        get_settings(), get_session_factory(), None, NOMIC, stopping=stopping
+    )
+
+    assert len(fake.checkpoints) == 1
+    assert not fake.completed and not completed
+
+
+@pytest.mark.asyncio
+async def test_run_backfill_rate_limits_every_request(monkeypatch):
+    fake = FakeBackfill(monkeypatch, [as_snippets(2), as_snippets(2)])
+    settings = get_settings(
+        backfill_concurrency=3, backfill_max_rate=25, drallam_embeddings_concurrency=8
+    )
+
+    await run_backfill(settings, get_session_factory(), None, NOMIC)
+
+    assert [s.drallam_embeddings_concurrency for s in fake.settings] == [3, 3]
+    # one bucket across pages, so the rate holds between them too
+    rate_limit = fake.rate_limits[0]
+    assert isinstance(rate_limit, TokenBucket) and rate_limit.rate == 25
+    assert fake.rate_limits == [rate_limit, rate_limit]
@@ -0,0 +1,134 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+import struct
+from unittest.mock import AsyncMock, MagicMock
+from uuid import uuid4
+
+import pytest
+from pgvector.utils import Vector
+
+from depositduck.llm.bulk import (
+    PGCOPY_HEADER,
+    PGCOPY_TRAILER,
+    column_encoder,
+    copy_rows,
+    encode_copy_binary,
+    encode_text,
+    encode_uuid,
+    encode_vector,
+    write_rows,
+)
+from depositduck.models.llm import BulkWriteMethod
+from depositduck.models.sql.llm import EmbeddingNomic, Snippet
+from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
+
+
+def test_encode_vector_matches_pgvector_binary_format():
+    vector = [0.5, -1.25, 3.0]
+
+    assert encode_vector(vector) == Vector(vector).to_binary()
+
+
+def test_column_encoder_follows_column_type():
+    snippet_table = Snippet.__table__  # type: ignore[attr-defined]
+    embedding_table = EmbeddingNomic.__table__  # type: ignore[attr-defined]
+
+    assert column_encoder(snippet_table.c.source_text_id) is encode_uuid
+    assert column_encoder(snippet_table.c.content) is encode_text
+    assert column_encoder(embedding_table.c.vector) is encode_vector
+    with pytest.raises(TypeError):
+        column_encoder(snippet_table.c.created_at)
+
+
+def test_encode_copy_binary_frames_fields():
+    snippet_id = uuid4()
+
+    payload = encode_copy_binary(
+        [(snippet_id, "deposit"), (snippet_id, None)], [encode_uuid, encode_text]
+    )
+
+    assert payload.startswith(PGCOPY_HEADER)
+    assert payload.endswith(PGCOPY_TRAILER)
+    first_row = (
+        struct.pack(">h", 2)
+        + struct.pack(">i", 16)
+        + snippet_id.bytes
+        + struct.pack(">i", 7)
+        + b"deposit"
+    )
+    second_row = (
+        struct.pack(">h", 2) + struct.pack(">i", 16) + snippet_id.bytes + b"\xff" * 4
+    )
+    assert payload == PGCOPY_HEADER + first_row + second_row + PGCOPY_TRAILER
+
+
+def mock_session(driver_connection: MagicMock) -> MagicMock:
+    raw_connection = MagicMock(driver_connection=driver_connection)
+    connection = MagicMock()
+    connection.get_raw_connection = AsyncMock(side_effect=[raw_connection])
+    session = MagicMock()
+    session.connection = AsyncMock(side_effect=[connection])
+    return session
+
+
+@pytest.mark.asyncio
+async def test_copy_rows_stages_then_inserts():
+    driver_connection = MagicMock()
+    inserted_id = uuid4()
+    driver_connection.execute = AsyncMock(side_effect=["SELECT 0", "DROP TABLE"])
+    driver_connection.copy_to_table = AsyncMock(side_effect=["COPY 2"])
+    driver_connection.fetch = AsyncMock(side_effect=[[{"id": inserted_id}]])
+    session = mock_session(driver_connection)
+    source_text_id = uuid4()
+    rows = [
+        {"source_text_id": source_text_id, "content": "a", "content_hash": "h"},
+        {"source_text_id": source_text_id, "content": "a", "content_hash": "h"},
+    ]
+
+    inserted = await copy_rows(session, Snippet.__table__, rows)  # type: ignore[attr-defined]
+
+    assert inserted == [inserted_id]
+    staging = driver_connection.copy_to_table.call_args.args[0]
+    copy_kwargs = driver_connection.copy_to_table.call_args.kwargs
+    assert copy_kwargs["columns"] == ["source_text_id", "content", "content_hash"]
+    assert copy_kwargs["format"] == "binary"
+    insert_statement = driver_connection.fetch.call_args.args[0]
+    assert insert_statement.startswith("INSERT INTO llm__snippet")
+    assert f"FROM {staging} ON CONFLICT DO NOTHING" in insert_statement
+    drop_statement = driver_connection.execute.call_args_list[1].args[0]
+    assert drop_statement == f"DROP TABLE {staging}"
+
+
+@pytest.mark.asyncio
+async def test_write_rows_insert_method_executes_insert():
+    settings_data = get_valid_settings().model_dump()
+    settings_data["ingestion_bulk_write_method"] = BulkWriteMethod.INSERT
+    settings = Settings(**settings_data)
+    snippet_id = uuid4()
+    result = MagicMock()
+    result.scalars.return_value.all.return_value = [snippet_id]
+    session = MagicMock()
+    session.execute = AsyncMock(side_effect=[result])
+    session.connection = AsyncMock(side_effect=AssertionError("COPY used"))
+
+    inserted = await write_rows(
+        settings,
+        session,
+        Snippet.__table__,  # type: ignore[attr-defined]
+        [{"source_text_id": uuid4(), "content": "a", "content_hash": "h"}],
+    )
+
+    assert inserted == [snippet_id]
+
+
+@pytest.mark.asyncio
+async def test_write_rows_no_rows():
+    session = MagicMock()
+    session.execute = AsyncMock(side_effect=AssertionError("nothing to write"))
+
+    inserted = await write_rows(get_valid_settings(), session, Snippet.__table__, [])  # type: ignore[attr-defined]
+
+    assert inserted == []
@@ -0,0 +1,135 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+import httpx
+import pytest
+import time_machine
+
+from depositduck.llm.cache import (
+    InProcessQueryEmbeddingCache,
+    InProcessSearchResultCache,
+    query_embedding_key,
+    search_result_key,
+)
+from depositduck.llm.embeddings import embed_query
+from depositduck.models.dto.llm import RelevantSnippet
+from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
+
+MODEL = "nomic-embed-text:v1.5"
+
+
+def test_query_embedding_key_normalises_query():
+    assert query_embedding_key(MODEL, "  What is  TDS?\n") == query_embedding_key(
+        MODEL, "what is tds?"
+    )
+    assert query_embedding_key(MODEL, "what is tds?") != query_embedding_key(
+        "all-minilm", "what is tds?"
+    )
+
+
+@pytest.mark.asyncio
+async def test_in_process_cache_evicts_least_recently_used():
+    cache = InProcessQueryEmbeddingCache(max_entries=2, ttl_seconds=60)
+    await cache.set(MODEL, "first", [1.0])
+    await cache.set(MODEL, "second", [2.0])
+    await cache.get(MODEL, "first")
+
+    await cache.set(MODEL, "third", [3.0])
+
+    assert await cache.get(MODEL, "second") is None
+    assert await cache.get(MODEL, "first") == [1.0]
+    assert await cache.get(MODEL, "third") == [3.0]
+    assert len(cache) == 2
+    assert cache.stats.evictions == 1
+    assert (cache.stats.hits, cache.stats.misses) == (3, 1)
+
+
+@pytest.mark.asyncio
+async def test_in_process_cache_expires_entries():
+    start = datetime(2024, 7, 1, 12, 0, 0, tzinfo=timezone.utc)
+    cache = InProcessQueryEmbeddingCache(max_entries=10, ttl_seconds=60)
+
+    with time_machine.travel(start, tick=False) as traveller:
+        await cache.set(MODEL, "query", [1.0])
+        traveller.shift(timedelta(seconds=59))
+        assert await cache.get(MODEL, "query") == [1.0]
+        traveller.shift(timedelta(seconds=1))
+        assert await cache.get(MODEL, "query") is None
+
+    assert cache.stats.evictions == 1
+    assert cache.stats.hit_rate == 0.5
+
+
+@pytest.mark.asyncio
+async def test_embed_query_skips_drallam_on_cache_hit():
+    settings = get_valid_settings()
+    cache = InProcessQueryEmbeddingCache(max_entries=10, ttl_seconds=60)
+    calls = 0
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal calls
+        calls += 1
+        return httpx.Response(200, json={"embedding": [0.5, 0.5]})
+
+    transport = httpx.MockTransport(handler)
+    async with httpx.AsyncClient(transport=transport, base_url="http://d") as client:
+        first = await embed_query(settings, client, cache, "Can I get my deposit back?")
+        second = await embed_query(settings, client, cache, "can i get my deposit back?")
+
+    assert first == second == [0.5, 0.5]
+    assert calls == 1
+
+
+def get_snippets() -> list[RelevantSnippet]:
+    return [
+        RelevantSnippet(
+            snippet_id=uuid4(), source_text_id=uuid4(), content="TDS", score=0.03
+        )
+    ]
+
+
+def test_search_result_key_varies_with_search_parameters():
+    settings = get_valid_settings()
+    key = search_result_key(settings, MODEL, "What is TDS?", 5)
+
+    assert key == search_result_key(settings, MODEL, "  what is tds? ", 5)
+    assert key != search_result_key(settings, MODEL, "What is TDS?", 10)
+    assert key != search_result_key(settings, MODEL, "What is TDS?", 5, 400)
+    assert key != search_result_key(settings, "all-minilm", "What is TDS?", 5)
+    reweighted = Settings(
+        **{**get_valid_settings().model_dump(), "search_text_weight": 0.5}
+    )
+    assert key != search_result_key(reweighted, MODEL, "What is TDS?", 5)
+
+
+@pytest.mark.asyncio
+async def test_search_result_cache_evicts_older_generations():
+    cache = InProcessSearchResultCache(max_entries=10, ttl_seconds=60)
+    snippets = get_snippets()
+    await cache.set("key", 1, snippets)
+
+    assert await cache.get("key", 1) == snippets
+    assert await cache.get("key", 2) is None
+    assert await cache.get("key", 1) is None
+    assert len(cache) == 0
+    assert cache.stats.evictions == 1
+    assert (cache.stats.hits, cache.stats.misses) == (1, 2)
+
+
+@pytest.mark.asyncio
+async def test_search_result_cache_keeps_newer_generation():
+    cache = InProcessSearchResultCache(max_entries=10, ttl_seconds=60)
+    newer = get_snippets()
+    await cache.set("key", 2, newer)
+
+    # a search that read the generation before the corpus last changed
+    await cache.set("key", 1, get_snippets())
+    assert await cache.get("key", 1) is None
+
+    assert await cache.get("key", 2) == newer
+    assert cache.stats.evictions == 0
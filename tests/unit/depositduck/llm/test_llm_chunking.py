@@ -0,0 +1,213 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+from typing import AsyncIterator, Iterable
+
+import pytest
+
+from depositduck.llm.chunking import (
+    MAX_PARAGRAPH_CHARACTERS,
+    ParagraphChunker,
+    ParagraphSplitter,
+    TokenChunker,
+    estimate_tokens,
+    get_chunker,
+    iter_paragraphs,
+    split_paragraphs,
+)
+from depositduck.models.llm import ChunkerName
+from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
+
+
+async def as_stream(chunks: Iterable) -> AsyncIterator:
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(stream: AsyncIterator) -> list:
+    return [item async for item in stream]
+
+
+PARAGRAPH_CHUNKS = [
+    ["first paragraph\n\nsecond\nparagraph\n\n\nthird"],
+    ["first para", "graph\n", "\nsecond\nparagraph\n", "\n", "\nthird"],
+    ["first paragraph\n\n", "  \n\n", "second\nparagraph", "\n\nthird\n\n"],
+]
+
+
+async def split(chunks: list[str], max_characters: int | None = None) -> list[str]:
+    return list(split_paragraphs(chunks, max_characters or MAX_PARAGRAPH_CHARACTERS))
+
+
+async def iterate(chunks: list[str], max_characters: int | None = None) -> list[str]:
+    paragraphs = iter_paragraphs(
+        as_stream(chunks), max_characters or MAX_PARAGRAPH_CHARACTERS
+    )
+    return await collect(paragraphs)
+
+
+# both go through the same `ParagraphSplitter`
+SPLITTERS = [split, iterate]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("paragraphs_of", SPLITTERS)
+@pytest.mark.parametrize("chunks", PARAGRAPH_CHUNKS)
+async def test_paragraphs_across_chunk_boundaries(paragraphs_of, chunks):
+    paragraphs = await paragraphs_of(chunks)
+
+    assert paragraphs == ["first paragraph", "second\nparagraph", "third"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("paragraphs_of", SPLITTERS)
+async def test_paragraphs_split_past_max_characters(paragraphs_of):
+    chunks = ["deposit scheme\nprotection ", "rules apply"]
+
+    paragraphs = await paragraphs_of(chunks, max_characters=20)
+
+    # at the last line break, then the last space, before the limit
+    assert paragraphs == ["deposit scheme", "protection rules", "apply"]
+
+
+def test_paragraph_splitter_holds_bounded_text_without_blank_lines():
+    splitter = ParagraphSplitter(max_characters=1000)
+
+    for _ in range(10_000):
+        splitter.add("one line of a document without blank lines\n")
+        assert splitter.length <= 1000
+
+    assert splitter.finish()
+
+
+@pytest.mark.asyncio
+async def test_iter_paragraphs_yields_before_stream_ends():
+    async def chunks() -> AsyncIterator[str]:
+        yield "first\n\nsecond"
+        raise RuntimeError("stream interrupted")
+
+    paragraphs = iter_paragraphs(chunks())
+
+    assert await paragraphs.__anext__() == "first"
+    with pytest.raises(RuntimeError):
+        await paragraphs.__anext__()
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("The deposit is £1,200.") == 8
+
+
+def test_paragraph_chunker_matches_blank_line_split():
+    text = "Short.\n\nA much longer second paragraph.\n\n\n\nThird"
+
+    chunks = list(ParagraphChunker().chunk([text]))
+
+    assert chunks == ["Short.", "A much longer second paragraph.", "Third"]
+
+
+def sentence(i: int) -> str:
+    # five tokens each
+    return f"Sentence number {i} here."
+
+
+def test_token_chunker_packs_sentences_up_to_target():
+    text = " ".join(sentence(i) for i in range(10))
+    chunker = TokenChunker(target_tokens=20, max_tokens=40)
+
+    chunks = list(chunker.chunk([text]))
+
+    assert len(chunks) == 3
+    assert chunks[0] == " ".join(sentence(i) for i in range(4))
+    assert chunks[2] == " ".join(sentence(i) for i in range(8, 10))
+
+
+def test_token_chunker_merges_short_paragraphs():
+    text = "Three word paragraph.\n\nAnother short one.\n\nAnd a third."
+    chunker = TokenChunker(target_tokens=50, max_tokens=100)
+
+    chunks = list(chunker.chunk([text]))
+
+    assert chunks == ["Three word paragraph.\n\nAnother short one.\n\nAnd a third."]
+
+
+def test_token_chunker_overlaps_trailing_sentences():
+    text = " ".join(sentence(i) for i in range(8))
+    chunker = TokenChunker(target_tokens=20, max_tokens=40, overlap_tokens=5)
+
+    chunks = list(chunker.chunk([text]))
+
+    assert chunks[0].endswith(sentence(3))
+    assert chunks[1].startswith(sentence(3))
+    assert chunks[-1].endswith(sentence(7))
+    # the overlap alone is never emitted as a chunk
+    assert all(estimate_tokens(c) > 5 for c in chunks)
+
+
+def test_token_chunker_never_exceeds_max_tokens():
+    long_sentence = " ".join(f"word{i}" for i in range(100))
+    text = f"{sentence(0)}\n\n{long_sentence}\n\n{sentence(1)}"
+    chunker = TokenChunker(target_tokens=10, max_tokens=30, overlap_tokens=5)
+
+    chunks = list(chunker.chunk([text]))
+
+    assert all(estimate_tokens(chunk) <= 30 for chunk in chunks)
+    assert " ".join(chunks).count("word99") == 1
+
+
+def test_token_chunker_does_not_split_abbreviations_or_decimals():
+    text = "See s.213 of the Housing Act 2004. Interest is 0.5 per cent."
+    chunker = TokenChunker(target_tokens=8, max_tokens=12)
+
+    chunks = list(chunker.chunk([text]))
+
+    assert chunks == ["See s.213 of the Housing Act 2004.", "Interest is 0.5 per cent."]
+
+
+def test_token_chunker_accepts_a_custom_token_counter():
+    text = " ".join(sentence(i) for i in range(4))
+    chunker = TokenChunker(target_tokens=1, max_tokens=1, count_tokens=lambda _: 1)
+
+    chunks = list(chunker.chunk([text]))
+
+    assert chunks == [sentence(i) for i in range(4)]
+
+
+@pytest.mark.asyncio
+async def test_token_chunker_streams_the_same_chunks_as_sync():
+    text = "\n\n".join(" ".join(sentence(i) for i in range(p, p + 3)) for p in range(6))
+    stream = [text[i : i + 7] for i in range(0, len(text), 7)]
+    chunker = TokenChunker(target_tokens=20, max_tokens=30, overlap_tokens=5)
+
+    chunks = await collect(chunker.achunk(as_stream(stream)))
+
+    assert chunks == list(chunker.chunk([text]))
+
+
+@pytest.mark.parametrize(
+    "target_tokens,max_tokens,overlap_tokens",
+    [(0, 10, 0), (20, 10, 0), (10, 20, 10)],
+)
+def test_token_chunker_rejects_inconsistent_sizes(
+    target_tokens, max_tokens, overlap_tokens
+):
+    with pytest.raises(ValueError):
+        TokenChunker(target_tokens, max_tokens, overlap_tokens)
+
+
+def test_get_chunker_defaults_to_settings():
+    settings = Settings(
+        **{
+            **get_valid_settings().model_dump(),
+            "chunker": ChunkerName.TOKEN,
+            "chunker_target_tokens": 100,
+        }
+    )
+
+    chunker = get_chunker(settings)
+    assert isinstance(chunker, TokenChunker)
+    assert chunker.target_tokens == 100
+    assert isinstance(get_chunker(settings, ChunkerName.PARAGRAPH), ParagraphChunker)
+    # as loaded from the database
+    assert isinstance(get_chunker(settings, "paragraph"), ParagraphChunker)  # type: ignore[arg-type]
@@ -0,0 +1,145 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+from uuid import uuid4
+
+import pytest
+
+from depositduck.llm.dedup import (
+    NearDuplicateIndex,
+    collapse_near_duplicates,
+    hamming_distance,
+    simhash,
+    simhash_bands,
+)
+from depositduck.models.llm import NOMIC
+
+CLAUSE = (
+    "The tenant must return the property in the same condition as at the start of "
+    "the tenancy, allowing for fair wear and tear, or the landlord may deduct the "
+    "cost of any repairs from the deposit."
+)
+REWORDED_CLAUSE = (
+    "The tenant must return the property in the same condition as at the start of "
+    "the tenancy, allowing for fair wear & tear, otherwise the landlord may deduct "
+    "the cost of any repairs from the deposit."
+)
+UNRELATED = (
+    "Your deposit is held in a government-backed scheme and must be protected "
+    "within thirty days of the landlord receiving it."
+)
+
+
+def test_simhash_ignores_case_and_punctuation():
+    assert simhash(CLAUSE) == simhash(CLAUSE.upper().replace(",", ""))
+
+
+def test_simhash_near_duplicates_differ_in_few_bits():
+    assert hamming_distance(simhash(CLAUSE), simhash(REWORDED_CLAUSE)) <= 3
+    assert hamming_distance(simhash(CLAUSE), simhash(UNRELATED)) > 10
+
+
+def test_simhash_fits_a_bigint():
+    signatures = [simhash(text) for text in (CLAUSE, REWORDED_CLAUSE, UNRELATED)]
+
+    assert all(-(1 << 63) <= signature < 1 << 63 for signature in signatures)
+    assert simhash("") == 0
+
+
+def test_hamming_distance_of_negative_signatures():
+    assert hamming_distance(-1, 0) == 64
+    assert hamming_distance(-1, -2) == 1
+
+
+def test_simhash_bands_near_duplicates_share_a_band():
+    signature = simhash(CLAUSE)
+    flipped = signature ^ (1 << 3) ^ (1 << 20) ^ (1 << 40)
+
+    shared = set(enumerate(simhash_bands(signature))) & set(
+        enumerate(simhash_bands(flipped))
+    )
+
+    assert len(shared) == 1
+
+
+def test_near_duplicate_index_finds_nearest_within_distance():
+    index = NearDuplicateIndex(max_distance=3)
+    clause_id, unrelated_id = uuid4(), uuid4()
+    index.add(clause_id, simhash(CLAUSE))
+    index.add(unrelated_id, simhash(UNRELATED))
+
+    assert index.find(simhash(REWORDED_CLAUSE)) == clause_id
+    assert NearDuplicateIndex(max_distance=0).find(simhash(CLAUSE)) is None
+
+
+@pytest.mark.asyncio
+async def test_collapse_near_duplicates():
+    embedded_id, new_id, reworded_id, unrelated_id = uuid4(), uuid4(), uuid4(), uuid4()
+    statements = []
+
+    async def execute(statement, params=None):
+        statements.append((statement, params))
+        # the only embedded Snippet is an earlier copy of the reworded clause
+        rows = [(new_id, embedded_id, simhash(REWORDED_CLAUSE))]
+        return SimpleNamespace(all=lambda: rows)
+
+    session = MagicMock()
+    session.execute = execute
+    source_text_id = uuid4()
+    snippets = {
+        new_id: (source_text_id, CLAUSE),
+        reworded_id: (source_text_id, REWORDED_CLAUSE),
+        unrelated_id: (source_text_id, UNRELATED),
+    }
+
+    duplicates = await collapse_near_duplicates(session, snippets, NOMIC, 3)
+
+    assert duplicates == {new_id: embedded_id}
+    # band expressions must match the indexes, so their constants are not parameters
+    candidates, _ = statements[0]
+    assert 'llm__snippet_1.source_text_id = "new".source_text_id' in str(candidates)
+    assert "(llm__snippet_1.simhash >> 48) & 65535" in str(candidates)
+    _, saved = statements[-1]
+    assert {row["id"]: row["near_duplicate_of_id"] for row in saved} == {
+        new_id: embedded_id,
+        reworded_id: None,
+        unrelated_id: None,
+    }
+
+
+@pytest.mark.asyncio
+async def test_collapse_near_duplicates_within_a_source_text():
+    clause_id, reworded_id, other_source_reworded_id = uuid4(), uuid4(), uuid4()
+
+    async def execute(statement, params=None):
+        return SimpleNamespace(all=lambda: [])
+
+    session = MagicMock()
+    session.execute = execute
+    source_text_id, other_source_text_id = uuid4(), uuid4()
+    snippets = {
+        clause_id: (source_text_id, CLAUSE),
+        reworded_id: (source_text_id, REWORDED_CLAUSE),
+        other_source_reworded_id: (other_source_text_id, REWORDED_CLAUSE),
+    }
+
+    duplicates = await collapse_near_duplicates(session, snippets, NOMIC, 3)
+
+    assert duplicates == {reworded_id: clause_id}
+
+
+def test_simhash_of_a_changed_number_differs_in_few_bits():
+    # why near-duplicates are off by default: these clauses must not share a Snippet
+    clause = (
+        "The landlord must protect the deposit in a government-backed scheme and give "
+        "the tenant the prescribed information within 30 days of receiving it, and "
+        "must tell the tenant how to get it back at the end of the tenancy, how "
+        "disputes are settled and what deductions may be made."
+    )
+
+    changed = clause.replace("30 days", "14 days")
+
+    assert hamming_distance(simhash(clause), simhash(changed)) <= 3
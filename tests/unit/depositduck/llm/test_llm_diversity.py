@@ -0,0 +1,65 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+from uuid import uuid4
+
+import numpy as np
+import pytest
+
+from depositduck.llm.diversity import diversify, mmr_order
+from depositduck.models.dto.llm import RelevantSnippet
+from depositduck.models.llm import EmbeddingModel
+
+# the first two candidates say the same thing
+VECTORS = [[1.0, 0.0, 0.0], [0.99, 0.1, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+RELEVANCE = [0.9, 0.85, 0.5, 0.1]
+
+
+def test_mmr_order_pure_relevance_keeps_ranking():
+    assert mmr_order(RELEVANCE, VECTORS, limit=3, lambda_=1.0) == [0, 1, 2]
+
+
+def test_mmr_order_demotes_near_duplicates():
+    assert mmr_order(RELEVANCE, VECTORS, limit=3, lambda_=0.5) == [0, 2, 3]
+
+
+def test_mmr_order_candidates_without_vectors_are_never_redundant():
+    vectors = [[1.0, 0.0], [0.0, 0.0], [1.0, 0.0]]
+
+    assert mmr_order([0.9, 0.2, 0.8], vectors, limit=3, lambda_=0.3) == [0, 1, 2]
+
+
+def test_mmr_order_limit_beyond_pool():
+    assert mmr_order([0.3, 0.6], [[1.0, 0.0], [0.0, 1.0]], limit=5, lambda_=0.7) == [
+        1,
+        0,
+    ]
+    assert mmr_order([], np.empty((0, 3)), limit=5, lambda_=0.7) == []
+
+
+@pytest.mark.asyncio
+async def test_diversify_reads_pool_embeddings():
+    snippets = [
+        RelevantSnippet(
+            snippet_id=uuid4(), source_text_id=uuid4(), content="", score=score
+        )
+        for score in RELEVANCE
+    ]
+    rows = [
+        SimpleNamespace(snippet_id=snippet.snippet_id, vector=np.array(vector))
+        for snippet, vector in zip(snippets, VECTORS)
+    ]
+    session = MagicMock()
+
+    async def select_vectors(statement):
+        return SimpleNamespace(all=lambda: rows)
+
+    session.execute = select_vectors
+    model = EmbeddingModel(name="test-embed", version="v1", dimensions=3)
+
+    diverse = await diversify(session, snippets, limit=2, lambda_=0.5, model=model)
+
+    assert diverse == [snippets[0], snippets[2]]
@@ -0,0 +1,78 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+import httpx
+import pytest
+
+from depositduck.llm.drallam import build_drallam_client, get_pool_stats
+from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
+
+
+def test_build_drallam_client_follows_settings():
+    settings_data = get_valid_settings().model_dump()
+    settings_data.update(
+        drallam_origin="http://drallam:11434",
+        drallam_timeout=12.0,
+        drallam_connect_timeout=2.0,
+    )
+    settings = Settings(**settings_data)
+
+    client = build_drallam_client(settings)
+
+    assert client.base_url == "http://drallam:11434"
+    assert client.timeout.read == 12.0
+    assert client.timeout.connect == 2.0
+
+
+@pytest.mark.asyncio
+async def test_get_pool_stats_new_client_has_empty_pool():
+    settings = get_valid_settings()
+
+    async with build_drallam_client(settings) as client:
+        stats = get_pool_stats(settings, client)
+
+    assert stats.max_connections == settings.drallam_max_connections
+    assert stats.open_connections == 0
+    assert stats.queued_requests == 0
+    assert stats.utilisation == 0
+
+
+@pytest.mark.asyncio
+async def test_get_pool_stats_custom_transport():
+    settings = get_valid_settings()
+    transport = httpx.MockTransport(lambda request: httpx.Response(200))
+
+    async with httpx.AsyncClient(transport=transport) as client:
+        stats = get_pool_stats(settings, client)
+
+    assert stats.open_connections == 0
+
+
+@pytest.mark.asyncio
+async def test_get_pool_stats_counts_requests_until_responses_close():
+    settings = Settings(
+        **{
+            **get_valid_settings().model_dump(),
+            "drallam_standin": True,
+            "drallam_max_connections": 1,
+        }
+    )
+
+    async with build_drallam_client(settings) as client:
+        responses = [
+            await client.send(client.build_request("GET", "/"), stream=True)
+            for _ in range(2)
+        ]
+        busy = get_pool_stats(settings, client)
+        for response in responses:
+            await response.aclose()
+        idle = get_pool_stats(settings, client)
+
+    assert busy.active_connections == 1
+    assert busy.queued_requests == 1
+    assert busy.utilisation == 1
+    assert idle.active_connections == 0
+    assert idle.idle_connections == 1
+    assert idle.open_connections == 1
@@ -0,0 +1,97 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+import math
+
+import httpx
+import pytest
+
+from depositduck.llm.drallam import build_drallam_client
+from depositduck.llm.drallam_standin import create_app, standin_embedding
+from depositduck.llm.embeddings import embed_documents
+from depositduck.models.llm import MXBAI_EMBED_LARGE, NOMIC
+from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
+
+
+def cosine(a: list[float], b: list[float]) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+
+def test_standin_embedding_is_deterministic_unit_vector():
+    embedding = standin_embedding("The deposit was returned in full.", 768)
+
+    assert embedding == standin_embedding("The deposit was returned in full.", 768)
+    assert len(embedding) == 768
+    assert math.isclose(math.sqrt(sum(v * v for v in embedding)), 1.0)
+
+
+def test_standin_embedding_texts_sharing_words_are_closer():
+    query = standin_embedding("deposit deductions for cleaning", 768)
+    related = standin_embedding("deductions from the deposit for cleaning", 768)
+    unrelated = standin_embedding("boiler service every year", 768)
+
+    assert cosine(query, related) > cosine(query, unrelated)
+
+
+def standin_client(app) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url="http://drallam", transport=httpx.ASGITransport(app=app)
+    )
+
+
+@pytest.mark.asyncio
+async def test_standin_embed_uses_model_dimensions():
+    async with standin_client(create_app()) as client:
+        response = await client.post(
+            "/api/embed", json={"model": MXBAI_EMBED_LARGE.tag, "input": ["a", "b"]}
+        )
+
+    embeddings = response.json()["embeddings"]
+    assert len(embeddings) == 2
+    assert {len(e) for e in embeddings} == {MXBAI_EMBED_LARGE.dimensions}
+
+
+@pytest.mark.asyncio
+async def test_standin_unknown_model_not_found():
+    async with standin_client(create_app()) as client:
+        response = await client.post(
+            "/api/embeddings", json={"model": "llama3:8b", "prompt": "hi"}
+        )
+
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_standin_error_rate():
+    async with standin_client(create_app(error_rate=1.0)) as client:
+        response = await client.post(
+            "/api/embeddings", json={"model": NOMIC.tag, "prompt": "hi"}
+        )
+
+    assert response.status_code == 500
+
+
+@pytest.mark.asyncio
+async def test_standin_generate_not_streamed():
+    async with standin_client(create_app()) as client:
+        response = await client.post(
+            "/api/generate", json={"model": "llama3:8b", "prompt": "hi", "stream": False}
+        )
+
+    assert response.json()["done"] is True
+
+
+@pytest.mark.asyncio
+async def test_build_drallam_client_standin_embeds_documents():
+    settings_data = get_valid_settings().model_dump()
+    settings_data.update(drallam_standin=True, drallam_embeddings_batch_input=True)
+    settings = Settings(**settings_data)
+    docs = ["deposit", "inventory", "tenancy"]
+
+    async with build_drallam_client(settings) as client:
+        result = await embed_documents(settings, client, docs)
+
+    assert result.failed_indices == []
+    assert result.embeddings[1] == standin_embedding("inventory", NOMIC.dimensions)
@@ -0,0 +1,196 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+import asyncio
+import json
+import math
+
+import httpx
+import pytest
+
+from depositduck.llm.cache import InProcessQueryEmbeddingCache
+from depositduck.llm.embeddings import (
+    EmbeddingError,
+    embed_documents,
+    embed_queries,
+    truncate_embedding,
+)
+from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
+
+
+def get_settings_with(**overrides) -> Settings:
+    settings_data = get_valid_settings().model_dump()
+    settings_data.update(overrides)
+    return Settings(**settings_data)
+
+
+def get_drallam_client(handler) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=httpx.MockTransport(handler), base_url="http://drallam"
+    )
+
+
+@pytest.mark.asyncio
+async def test_embed_documents_bounds_concurrency():
+    # arrange
+    settings = get_settings_with(drallam_embeddings_concurrency=3)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        prompt = json.loads(request.content)["prompt"]
+        return httpx.Response(200, json={"embedding": [float(len(prompt))]})
+
+    docs = ["a" * n for n in range(1, 21)]
+
+    # act
+    async with get_drallam_client(handler) as client:
+        result = await embed_documents(settings, client, docs)
+
+    # assert
+    assert max_in_flight == 3
+    assert len(result.batches) == len(docs)
+    assert result.embeddings == {i: [float(i + 1)] for i in range(len(docs))}
+    assert result.failed_indices == []
+
+
+@pytest.mark.asyncio
+async def test_embed_documents_multi_input_batches():
+    # arrange
+    settings = get_settings_with(
+        drallam_embeddings_batch_input=True, drallam_embeddings_batch_size=4
+    )
+    requests_seen = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        inputs = json.loads(request.content)["input"]
+        requests_seen.append((request.url.path, len(inputs)))
+        return httpx.Response(200, json={"embeddings": [[1.0] for _ in inputs]})
+
+    # act
+    async with get_drallam_client(handler) as client:
+        result = await embed_documents(settings, client, ["doc"] * 10)
+
+    # assert
+    assert {path for path, _ in requests_seen} == {"/api/embed"}
+    assert sorted(size for _, size in requests_seen) == [2, 4, 4]
+    assert [b.size for b in result.batches] == [4, 4, 2]
+    assert len(result.embeddings) == 10
+
+
+@pytest.mark.asyncio
+async def test_embed_documents_keeps_partial_progress():
+    # arrange
+    settings = get_settings_with(
+        drallam_embeddings_batch_input=True, drallam_embeddings_batch_size=2
+    )
+    saved: list[int] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        inputs = json.loads(request.content)["input"]
+        if "bad" in inputs:
+            return httpx.Response(200, json={"error": "model not loaded"})
+        return httpx.Response(200, json={"embeddings": [[1.0] for _ in inputs]})
+
+    async def on_batch(indices: list[int], embeddings: list[list[float]]) -> None:
+        saved.extend(indices)
+
+    # act
+    async with get_drallam_client(handler) as client:
+        result = await embed_documents(
+            settings, client, ["ok", "ok", "bad", "ok", "ok"], on_batch=on_batch
+        )
+
+    # assert
+    assert sorted(saved) == [0, 1, 4]
+    assert sorted(result.embeddings) == [0, 1, 4]
+    assert result.failed_indices == [2, 3]
+    assert result.batches[1].error is not None
+    assert all(b.latency_ms >= 0 for b in result.batches)
+
+
+@pytest.mark.asyncio
+async def test_embed_documents_failed_on_batch_fails_only_its_batch():
+    # arrange
+    settings = get_settings_with(
+        drallam_embeddings_batch_input=True, drallam_embeddings_batch_size=2
+    )
+    saved: list[int] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        inputs = json.loads(request.content)["input"]
+        return httpx.Response(200, json={"embeddings": [[1.0] for _ in inputs]})
+
+    async def on_batch(indices: list[int], embeddings: list[list[float]]) -> None:
+        if 2 in indices:
+            raise RuntimeError("connection lost")
+        saved.extend(indices)
+
+    # act
+    async with get_drallam_client(handler) as client:
+        result = await embed_documents(
+            settings, client, ["a", "b", "c", "d", "e"], on_batch=on_batch
+        )
+
+    # assert
+    assert sorted(saved) == [0, 1, 4]
+    assert sorted(result.embeddings) == [0, 1, 4]
+    assert result.failed_indices == [2, 3]
+    assert "connection lost" in result.batches[1].error
+
+
+@pytest.mark.asyncio
+async def test_embed_queries_only_sends_distinct_uncached_queries():
+    # arrange
+    settings = get_valid_settings()
+    cache = InProcessQueryEmbeddingCache(max_entries=10, ttl_seconds=60)
+    await cache.set(settings.drallam_embeddings_model, "deposit", [0.0])
+    prompts = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        prompt = json.loads(request.content)["prompt"]
+        prompts.append(prompt)
+        return httpx.Response(200, json={"embedding": [float(len(prompt))]})
+
+    queries = ["deposit", "tenancy", "deposit", "tenancy", "TDS"]
+
+    # act
+    async with get_drallam_client(handler) as client:
+        embeddings = await embed_queries(settings, client, cache, queries)
+
+    # assert
+    assert sorted(prompts) == ["TDS", "tenancy"]
+    assert embeddings == [[0.0], [7.0], [0.0], [7.0], [3.0]]
+    assert await cache.get(settings.drallam_embeddings_model, "TDS") == [3.0]
+
+
+@pytest.mark.asyncio
+async def test_embed_queries_raises_if_a_query_fails():
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if json.loads(request.content)["prompt"] == "TDS":
+            return httpx.Response(200, json={"error": "model not loaded"})
+        return httpx.Response(200, json={"embedding": [1.0]})
+
+    async with get_drallam_client(handler) as client:
+        with pytest.raises(EmbeddingError):
+            await embed_queries(get_valid_settings(), client, None, ["deposit", "TDS"])
+
+
+def test_truncate_embedding_keeps_leading_dimensions_at_unit_length():
+    embedding = [3.0, 4.0, 12.0, 84.0]
+
+    truncated = truncate_embedding(embedding, 2)
+
+    assert truncated == [0.6, 0.8]
+    assert math.isclose(math.sqrt(sum(value * value for value in truncated)), 1.0)
+
+
+def test_truncate_embedding_of_zero_vector():
+    assert truncate_embedding([0.0] * 4, 2) == [0.0, 0.0]
@@ -0,0 +1,204 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import AsyncIterator, Iterable
+from unittest.mock import AsyncMock, MagicMock
+from uuid import UUID, uuid4
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from depositduck.llm import ingestion as ingestion_module
+from depositduck.llm.drallam import build_drallam_client
+from depositduck.llm.ingestion import (
+    decode_stream,
+    ingest_and_embed_stream,
+    ingest_source_text_stream,
+)
+from depositduck.models.llm import ChunkerName, SourceTextBase
+from depositduck.models.sql.llm import Snippet
+from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
+
+
+async def as_stream(chunks: Iterable) -> AsyncIterator:
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(stream: AsyncIterator) -> list:
+    return [item async for item in stream]
+
+
+@pytest.mark.asyncio
+async def test_decode_stream_handles_split_multibyte_characters():
+    encoded = "Deposit of £1,200 ✓".encode()
+    chunks = [encoded[i : i + 1] for i in range(len(encoded))]
+
+    decoded = await collect(decode_stream(as_stream(chunks)))
+
+    assert "".join(decoded) == "Deposit of £1,200 ✓"
+
+
+@pytest.mark.asyncio
+async def test_ingest_and_embed_stream_embeds_batches_as_they_are_saved(monkeypatch):
+    settings = Settings(
+        **{
+            **get_valid_settings().model_dump(),
+            "chunker": ChunkerName.PARAGRAPH,
+            "drallam_standin": True,
+            "ingestion_pipeline_batch_size": 2,
+        }
+    )
+    source_text_id = uuid4()
+    session = MagicMock()
+    session.execute = AsyncMock(
+        side_effect=[MagicMock(scalar_one=lambda: source_text_id)]
+    )
+    session_factory = MagicMock(spec=async_sessionmaker)
+
+    @asynccontextmanager
+    async def begin():
+        yield session
+
+    session_factory.begin = begin
+    saved_content: list[str] = []
+    embedded_snippet_ids: list[UUID] = []
+
+    async def save_content(settings, session, source_text_id, spool):
+        spool.seek(0)
+        saved_content.append(spool.read())
+        return len(saved_content[-1])
+
+    async def write_rows(settings, session, table, rows):
+        if table is Snippet.__table__:
+            return [row["id"] for row in rows]
+        embedded_snippet_ids.extend(row["snippet_id"] for row in rows)
+        return [uuid4() for _ in rows]
+
+    monkeypatch.setattr(ingestion_module, "_save_content", save_content)
+    monkeypatch.setattr(ingestion_module, "write_rows", write_rows)
+    monkeypatch.setattr(
+        ingestion_module,
+        "reuse_cached_embeddings",
+        AsyncMock(side_effect=[set(), set(), set()]),
+    )
+
+    async def collapse_near_duplicates(session, snippets, model, max_distance):
+        return {}
+
+    monkeypatch.setattr(
+        ingestion_module, "collapse_near_duplicates", collapse_near_duplicates
+    )
+    text = "Deposit.\n\nInventory.\n\nCheck-out.\n\nDeductions.\n\nDispute."
+    source_text_meta = SourceTextBase(name="Guide", description="", content="")
+
+    async with build_drallam_client(settings) as drallam_client:
+        result = await ingest_and_embed_stream(
+            settings,
+            session_factory,
+            drallam_client,
+            source_text_meta,
+            as_stream([text.encode()]),
+        )
+
+    assert result.source_text_id == source_text_id
+    assert result.snippet_count == 5
+    assert result.character_count == len(text)
+    assert "".join(saved_content) == text
+    assert result.embeddings.created_count == 5
+    assert result.embeddings.failed_count == 0
+    assert len(set(embedded_snippet_ids)) == 5
+    assert result.first_searchable_ms is not None
+
+
+def get_recording_session_factory(source_text_id: UUID) -> tuple[MagicMock, list]:
+    """
+    A session factory recording the statements executed in each transaction.
+    """
+    transactions: list[list] = []
+    session_factory = MagicMock(spec=async_sessionmaker)
+
+    @asynccontextmanager
+    async def begin():
+        statements: list = []
+        transactions.append(statements)
+
+        async def execute(statement):
+            statements.append(statement)
+            return SimpleNamespace(scalar_one=lambda: source_text_id)
+
+        yield SimpleNamespace(execute=execute)
+
+    session_factory.begin = begin
+    return session_factory, transactions
+
+
+@pytest.mark.asyncio
+async def test_ingest_source_text_stream_saves_content_in_pieces(monkeypatch):
+    settings = Settings(
+        **{
+            **get_valid_settings().model_dump(),
+            "chunker": ChunkerName.PARAGRAPH,
+            "ingestion_flush_characters": 8,
+            "ingestion_snippet_batch_size": 2,
+        }
+    )
+    source_text_id = uuid4()
+    session_factory, transactions = get_recording_session_factory(source_text_id)
+    saved_snippets: list[list[str]] = []
+
+    async def write_rows(settings, session, table, rows):
+        saved_snippets.append([row["content"] for row in rows])
+        return [uuid4() for _ in rows]
+
+    monkeypatch.setattr(ingestion_module, "write_rows", write_rows)
+    text = "Deposit.\n\nInventory.\n\nCheck-out.\n\nDeductions.\n\nDispute."
+    source_text_meta = SourceTextBase(name="Guide", description="", content="")
+    chunks = [text[i : i + 3].encode() for i in range(0, len(text), 3)]
+
+    result = await ingest_source_text_stream(
+        settings, session_factory, source_text_meta, as_stream(chunks)
+    )
+
+    assert result.source_text_id == source_text_id
+    assert result.snippet_count == 5
+    assert result.character_count == len(text)
+    assert saved_snippets == [
+        ["Deposit.", "Inventory."],
+        ["Check-out.", "Deductions."],
+        ["Dispute."],
+    ]
+    # the SourceText, each full batch, then the last batch along with the content
+    assert len(transactions) == 4
+    appended = [
+        statement.compile().params["content_1"]
+        for statement in transactions[-1]
+        if str(statement).startswith("UPDATE llm__source_text")
+    ]
+    assert all(len(piece) <= 8 for piece in appended)
+    assert "".join(appended) == text
+
+
+@pytest.mark.asyncio
+async def test_ingest_source_text_stream_deletes_interrupted_upload(monkeypatch):
+    source_text_id = uuid4()
+    session_factory, transactions = get_recording_session_factory(source_text_id)
+
+    async def interrupted_upload():
+        yield b"Deposit.\n\n"
+        raise ConnectionError("client went away")
+
+    source_text_meta = SourceTextBase(name="Guide", description="", content="")
+
+    with pytest.raises(ConnectionError):
+        await ingest_source_text_stream(
+            get_valid_settings(), session_factory, source_text_meta, interrupted_upload()
+        )
+
+    deleted = [str(statement) for statement in transactions[-1]]
+    assert deleted[0].startswith("DELETE FROM llm__snippet")
+    assert deleted[1].startswith("DELETE FROM llm__source_text")
@@ -0,0 +1,389 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+from uuid import uuid4
+
+import httpx
+import pytest
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from depositduck.llm import worker as worker_module
+from depositduck.llm.embeddings import EmbeddingError
+from depositduck.llm.ingestion import SourceTextNotFoundError
+from depositduck.llm.jobs import (
+    JobInterruptedError,
+    JobPayloadError,
+    claim_job,
+    dedupe_key,
+    enqueue_job,
+    fail_job,
+    requeue_job,
+    retry_delay,
+)
+from depositduck.llm.worker import Worker
+from depositduck.models.dto.llm import EmbeddingsCreated
+from depositduck.models.llm import JobKind, JobStatus
+from depositduck.models.sql.llm import Job
+from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
+
+
+def compile_pg(statement) -> str:
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def get_job(attempts: int = 1, max_attempts: int = 3) -> Job:
+    return Job(
+        id=uuid4(),
+        kind=JobKind.SNIPPETS_FROM_SOURCE_TEXT,
+        payload={"source_text_id": str(uuid4())},
+        attempts=attempts,
+        max_attempts=max_attempts,
+        status=JobStatus.RUNNING,
+    )
+
+
+def get_session_factory(session: AsyncMock) -> MagicMock:
+    @asynccontextmanager
+    async def begin():
+        yield session
+
+    session_factory = MagicMock(spec=async_sessionmaker)
+    session_factory.begin = begin
+    return session_factory
+
+
+def test_retry_delay_doubles_up_to_maximum():
+    settings = Settings(
+        **{
+            **get_valid_settings().model_dump(),
+            "job_retry_backoff": 10.0,
+            "job_retry_backoff_max": 60.0,
+        }
+    )
+
+    for attempts, max_delay in [(1, 10.0), (2, 20.0), (3, 40.0), (4, 60.0), (9, 60.0)]:
+        delay = retry_delay(settings, attempts)
+        assert max_delay / 2 <= delay <= max_delay
+
+
+@pytest.mark.asyncio
+async def test_enqueue_job_returns_the_unfinished_identical_job():
+    existing = get_job()
+    statements = []
+
+    async def execute(statement):
+        statements.append(statement)
+        # the insert conflicts, the select finds the job it conflicted with
+        job = existing if len(statements) == 2 else None
+        return SimpleNamespace(scalar_one_or_none=lambda: job)
+
+    payload = {"source_text_id": str(uuid4())}
+    session = SimpleNamespace(execute=execute)
+
+    job = await enqueue_job(
+        session, get_valid_settings(), JobKind.SNIPPETS_FROM_SOURCE_TEXT, payload
+    )
+
+    assert job is existing
+    insert = compile_pg(statements[0])
+    assert insert.startswith("INSERT INTO llm__job")
+    assert (
+        "ON CONFLICT (kind, dedupe_key) WHERE status IN ('queued', 'running') DO NOTHING"
+    ) in insert
+    assert "llm__job.dedupe_key = %(dedupe_key_1)s" in compile_pg(statements[1])
+
+
+def test_dedupe_key_ignores_payload_key_order():
+    source_text_id = str(uuid4())
+
+    assert dedupe_key({"source_text_id": source_text_id, "llm_name": "nomic"}) == (
+        dedupe_key({"llm_name": "nomic", "source_text_id": source_text_id})
+    )
+
+
+@pytest.mark.asyncio
+async def test_enqueue_job_dedupes_backfills_by_model():
+    keys = []
+
+    async def execute(statement):
+        keys.append(statement.compile().params["dedupe_key"])
+        return SimpleNamespace(scalar_one_or_none=lambda: get_job())
+
+    session = SimpleNamespace(execute=execute)
+    for payload in [{"llm_name": "nomic"}, {"llm_name": "nomic", "restart": True}]:
+        await enqueue_job(
+            session, get_valid_settings(), JobKind.EMBEDDINGS_BACKFILL, payload
+        )
+
+    # both would move the same checkpoint, so cannot be queued side by side
+    assert keys[0] == keys[1] == dedupe_key({"llm_name": "nomic"})
+
+
+@pytest.mark.asyncio
+async def test_requeue_job_does_not_use_up_an_attempt():
+    session = AsyncMock()
+
+    await requeue_job(session, get_job(), "worker-1", {"restart": False})
+
+    statement = compile_pg(session.execute.call_args.args[0])
+    assert "status=%(status)s" in statement
+    assert "attempts=(llm__job.attempts - %(attempts_1)s)" in statement
+    assert "payload=%(payload)s" in statement
+    assert "llm__job.worker_id = %(worker_id_1)s" in statement
+
+
+@pytest.mark.asyncio
+async def test_claim_job_skips_locked_jobs():
+    session = AsyncMock()
+
+    await claim_job(session, get_valid_settings(), "worker-1")
+
+    statement = compile_pg(session.execute.call_args.args[0])
+    assert "FOR UPDATE SKIP LOCKED" in statement
+    assert statement.startswith("UPDATE llm__job SET")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "attempts,retry,expected_status",
+    [
+        (1, True, JobStatus.QUEUED),
+        (3, True, JobStatus.FAILED),
+        (1, False, JobStatus.FAILED),
+    ],
+)
+async def test_fail_job_retries_while_attempts_remain(attempts, retry, expected_status):
+    session = AsyncMock()
+    job = get_job(attempts=attempts, max_attempts=3)
+
+    status = await fail_job(
+        session, get_valid_settings(), job, "worker-1", "error", retry=retry
+    )
+
+    assert status == expected_status
+    statement = compile_pg(session.execute.call_args.args[0])
+    # retried jobs are pushed back, failed ones are finished
+    assert ("run_after" in statement) is (expected_status == JobStatus.QUEUED)
+    assert ("finished_at" in statement) is (expected_status == JobStatus.FAILED)
+
+
+@pytest.mark.asyncio
+async def test_worker_returns_false_when_queue_is_empty(monkeypatch):
+    monkeypatch.setattr(worker_module, "claim_job", AsyncMock(side_effect=[None]))
+    session_factory = get_session_factory(AsyncMock())
+    worker = Worker(get_valid_settings(), session_factory, httpx.AsyncClient())
+
+    assert await worker.run_once() is False
+
+
+@pytest.mark.asyncio
+async def test_worker_completes_successful_job(monkeypatch):
+    job = get_job()
+    handler = AsyncMock(side_effect=[{"created_count": 3}])
+    complete_job = AsyncMock()
+    monkeypatch.setattr(worker_module, "claim_job", AsyncMock(side_effect=[job]))
+    monkeypatch.setattr(worker_module, "complete_job", complete_job)
+    monkeypatch.setitem(worker_module.JOB_HANDLERS, JobKind(job.kind), handler)
+    session = AsyncMock()
+    worker = Worker(
+        get_valid_settings(), get_session_factory(session), httpx.AsyncClient(), "w1"
+    )
+
+    assert await worker.run_once() is True
+
+    assert handler.call_args.args[0].job is job
+    complete_job.assert_awaited_once_with(session, job, "w1", {"created_count": 3})
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "error,retry",
+    [
+        (httpx.ConnectError("refused"), True),
+        (ValueError("unexpected response"), True),
+        (SourceTextNotFoundError("no SourceText"), False),
+        (JobPayloadError("no source_text_id"), False),
+    ],
+)
+async def test_worker_records_failed_job(monkeypatch, error, retry):
+    job = get_job()
+    fail_job = AsyncMock(side_effect=[JobStatus.QUEUED])
+    monkeypatch.setattr(worker_module, "claim_job", AsyncMock(side_effect=[job]))
+    monkeypatch.setattr(worker_module, "fail_job", fail_job)
+    monkeypatch.setitem(
+        worker_module.JOB_HANDLERS, JobKind(job.kind), AsyncMock(side_effect=error)
+    )
+    worker = Worker(
+        get_valid_settings(), get_session_factory(AsyncMock()), httpx.AsyncClient()
+    )
+
+    assert await worker.run_once() is True
+
+    assert fail_job.call_args.kwargs["retry"] is retry
+
+
+@pytest.mark.asyncio
+async def test_worker_cancels_job_that_lost_its_heartbeat(monkeypatch):
+    job = get_job()
+    fail_job = AsyncMock(side_effect=[JobStatus.QUEUED])
+    handler_cancelled = asyncio.Event()
+
+    async def handler(ctx):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            handler_cancelled.set()
+            raise
+
+    async def lose_heartbeat(job, runner_id):
+        raise ConnectionError("database unavailable")
+
+    monkeypatch.setattr(worker_module, "claim_job", AsyncMock(side_effect=[job]))
+    monkeypatch.setattr(worker_module, "fail_job", fail_job)
+    monkeypatch.setitem(worker_module.JOB_HANDLERS, JobKind(job.kind), handler)
+    worker = Worker(
+        get_valid_settings(), get_session_factory(AsyncMock()), httpx.AsyncClient()
+    )
+    monkeypatch.setattr(worker, "_heartbeat", lose_heartbeat)
+
+    assert await asyncio.wait_for(worker.run_once(), 1) is True
+
+    assert handler_cancelled.is_set()
+    assert fail_job.call_args.kwargs["retry"] is True
+    assert fail_job.call_args.kwargs["error"].startswith("ConnectionError")
+
+
+@pytest.mark.asyncio
+async def test_worker_requeues_interrupted_job(monkeypatch):
+    job = get_job()
+    requeue_job = AsyncMock()
+    fail_job = AsyncMock()
+    interrupted = JobInterruptedError("worker stopping", {"resume": True})
+    monkeypatch.setattr(worker_module, "claim_job", AsyncMock(side_effect=[job]))
+    monkeypatch.setattr(worker_module, "requeue_job", requeue_job)
+    monkeypatch.setattr(worker_module, "fail_job", fail_job)
+    monkeypatch.setitem(
+        worker_module.JOB_HANDLERS, JobKind(job.kind), AsyncMock(side_effect=interrupted)
+    )
+    session = AsyncMock()
+    worker = Worker(
+        get_valid_settings(), get_session_factory(session), httpx.AsyncClient(), "w1"
+    )
+
+    assert await worker.run_once() is True
+
+    requeue_job.assert_awaited_once_with(session, job, "w1", {"resume": True})
+    fail_job.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_worker_runners_claim_jobs_with_ids_of_their_own(monkeypatch):
+    runner_ids: list[str] = []
+    worker = Worker(
+        get_valid_settings(), get_session_factory(AsyncMock()), httpx.AsyncClient(), "w1"
+    )
+
+    async def claim_job(session, settings, worker_id):
+        runner_ids.append(worker_id)
+        if len(runner_ids) == 2:
+            worker.stop()
+        return None
+
+    monkeypatch.setattr(worker_module, "claim_job", claim_job)
+
+    await asyncio.wait_for(worker.run(concurrency=2), 1)
+
+    assert sorted(runner_ids) == ["w1/0", "w1/1"]
+
+
+@pytest.mark.asyncio
+async def test_embeddings_job_with_missing_embeddings_fails_on_last_attempt(
+    monkeypatch,
+):
+    async def embed_source_text(*args, **kwargs):
+        return EmbeddingsCreated(created_count=2, failed_count=1)
+
+    monkeypatch.setattr(worker_module, "embed_source_text", embed_source_text)
+    job = get_job(attempts=3, max_attempts=3)
+    job.kind = JobKind.EMBEDDINGS_FROM_SOURCE_TEXT
+    ctx = worker_module.JobContext(
+        settings=get_valid_settings(),
+        db_session_factory=get_session_factory(AsyncMock()),
+        drallam_client=httpx.AsyncClient(),
+        job=job,
+        report_progress=AsyncMock(),
+    )
+
+    with pytest.raises(EmbeddingError, match="1 snippets could not be embedded"):
+        await worker_module.run_embeddings_from_source_text(ctx)
+
+
+@pytest.mark.parametrize("attempts, restart", [(1, True), (2, False)])
+@pytest.mark.asyncio
+async def test_embeddings_backfill_runs_the_backfill(monkeypatch, attempts, restart):
+    calls = []
+
+    async def run_backfill(settings, db_session_factory, client, model, **kwargs):
+        calls.append((model, kwargs))
+        return EmbeddingsCreated(created_count=2), True
+
+    monkeypatch.setattr(worker_module, "run_backfill", run_backfill)
+    # a retry resumes from the checkpoint saved by the attempt that restarted
+    job = get_job(attempts=attempts)
+    job.kind = JobKind.EMBEDDINGS_BACKFILL
+    job.payload = {"llm_name": "mxbai-embed-large:v1", "restart": True}
+    stopping = asyncio.Event()
+    report_progress = AsyncMock()
+    ctx = worker_module.JobContext(
+        settings=get_valid_settings(),
+        db_session_factory=get_session_factory(AsyncMock()),
+        drallam_client=httpx.AsyncClient(),
+        job=job,
+        report_progress=report_progress,
+        stopping=stopping,
+    )
+
+    result = await worker_module.run_embeddings_backfill(ctx)
+
+    assert result["created_count"] == 2
+    [(model, kwargs)] = calls
+    assert model.tag == "mxbai-embed-large:v1"
+    assert kwargs == {
+        "restart": restart,
+        "stopping": stopping,
+        "on_progress": report_progress,
+    }
+
+
+@pytest.mark.asyncio
+async def test_interrupted_embeddings_backfill_resumes_without_restarting(monkeypatch):
+    async def run_backfill(settings, db_session_factory, client, model, **kwargs):
+        return EmbeddingsCreated(created_count=2), False
+
+    monkeypatch.setattr(worker_module, "run_backfill", run_backfill)
+    job = get_job()
+    job.kind = JobKind.EMBEDDINGS_BACKFILL
+    job.payload = {"llm_name": "mxbai-embed-large:v1", "restart": True}
+    ctx = worker_module.JobContext(
+        settings=get_valid_settings(),
+        db_session_factory=get_session_factory(AsyncMock()),
+        drallam_client=httpx.AsyncClient(),
+        job=job,
+        report_progress=AsyncMock(),
+        stopping=asyncio.Event(),
+    )
+
+    with pytest.raises(JobInterruptedError) as interrupted:
+        await worker_module.run_embeddings_backfill(ctx)
+
+    assert interrupted.value.payload == {
+        "llm_name": "mxbai-embed-large:v1",
+        "restart": False,
+    }
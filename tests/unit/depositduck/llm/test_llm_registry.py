@@ -0,0 +1,70 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from depositduck.llm.registry import embedding_row, embedding_table, embeddings_of
+from depositduck.models.llm import (
+    MXBAI_EMBED_LARGE,
+    NOMIC,
+    NOMIC_COARSE_DIMENSIONS,
+    embedding_index_name,
+    get_embedding_model,
+)
+from depositduck.models.sql.llm import Embedding, EmbeddingNomic
+
+
+def compile_pg(statement) -> str:
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def test_get_embedding_model_by_tag():
+    assert get_embedding_model("nomic-embed-text:v1.5") is NOMIC
+    with pytest.raises(LookupError):
+        get_embedding_model("nomic-embed-text")
+
+
+def test_embedding_index_name():
+    assert (
+        embedding_index_name(MXBAI_EMBED_LARGE)
+        == "ix_llm__embedding_mxbai_embed_large_v1"
+    )
+
+
+def test_nomic_embeddings_have_their_own_table():
+    snippet_id = uuid4()
+
+    row = embedding_row(NOMIC, snippet_id, [1.0] * NOMIC.dimensions)
+
+    assert embedding_table(NOMIC) is EmbeddingNomic
+    assert embeddings_of(NOMIC) is EmbeddingNomic.__table__  # type: ignore[attr-defined]
+    assert row["snippet_id"] == snippet_id
+    assert len(row["vector_coarse"]) == NOMIC_COARSE_DIMENSIONS
+
+
+def test_other_embeddings_share_a_table():
+    snippet_id = uuid4()
+
+    row = embedding_row(MXBAI_EMBED_LARGE, snippet_id, [1.0] * 1024)
+    embeddings = embeddings_of(MXBAI_EMBED_LARGE)
+
+    assert embedding_table(MXBAI_EMBED_LARGE) is Embedding
+    assert row == {
+        "snippet_id": snippet_id,
+        "llm_name": "mxbai-embed-large:v1",
+        "vector": [1.0] * 1024,
+    }
+    statement = str(
+        select(embeddings.c.vector).compile(
+            dialect=postgresql.dialect(), compile_kwargs={"render_postcompile": True}
+        )
+    )
+    # matches the expression & predicate of the model's partial index, with the tag
+    # as a literal so a prepared statement's generic plan can still use the index
+    assert "CAST(llm__embedding.vector AS VECTOR(1024))" in statement
+    assert "WHERE llm__embedding.llm_name = 'mxbai-embed-large:v1'" in statement
@@ -0,0 +1,201 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from depositduck.llm.embeddings import EmbeddingError, embed_document
+from depositduck.llm.resilience import (
+    CircuitBreaker,
+    CircuitState,
+    LatencyHistogram,
+    Outcome,
+    TokenBucket,
+    get_drallam_guard,
+)
+from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
+
+
+def get_settings(**overrides) -> Settings:
+    return Settings(
+        **{
+            **get_valid_settings().model_dump(),
+            "drallam_embeddings_retry_backoff": 0.001,
+            **overrides,
+        }
+    )
+
+
+def get_client(handler) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url="http://drallam", transport=httpx.MockTransport(handler)
+    )
+
+
+def test_latency_histogram_buckets_are_cumulative():
+    histogram = LatencyHistogram()
+    for latency_ms in [3, 7, 7, 20_000]:
+        histogram.observe(latency_ms)
+
+    stats = histogram.stats()
+
+    assert stats.buckets["5"] == 1
+    assert stats.buckets["10"] == 3
+    assert stats.buckets["10000"] == 3
+    assert stats.buckets["+Inf"] == stats.count == 4
+
+
+def test_circuit_breaker_opens_then_lets_one_probe_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_after=0.0)
+    breaker.record_failure()
+    assert breaker.state == CircuitState.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+
+    assert breaker.allow() is True
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert breaker.allow() is False
+    breaker.record_success()
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_circuit_breaker_open_refuses_requests():
+    breaker = CircuitBreaker(failure_threshold=1, reset_after=60.0)
+    breaker.record_failure()
+
+    assert breaker.allow() is False
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_paces_units():
+    bucket = TokenBucket(rate=100)
+
+    start = time.perf_counter()
+    for _ in range(10):
+        await bucket.acquire(2)
+
+    assert 0.2 <= time.perf_counter() - start < 0.3
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_charges_units_beyond_capacity():
+    # 150 units at 100 a second wait for a full bucket, leaving 50 units of debt that
+    # the next unit waits to pay off
+    bucket = TokenBucket(rate=100)
+
+    start = time.perf_counter()
+    await bucket.acquire(150)
+    await bucket.acquire(1)
+
+    assert 1.5 <= time.perf_counter() - start < 1.6
+
+
+@pytest.mark.asyncio
+async def test_embed_document_retries_server_errors():
+    settings = get_settings()
+    responses = iter([500, 503, 200])
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(next(responses), json={"embedding": [0.1, 0.2]})
+
+    async with get_client(handler) as client:
+        embedding = await embed_document(settings, client, "deposit")
+        stats = get_drallam_guard(settings, client).stats()
+
+    assert embedding == [0.1, 0.2]
+    assert stats.retried_count == 2
+    assert stats.latency_ms[Outcome.ERROR].count == 2
+    assert stats.latency_ms[Outcome.OK].count == 1
+
+
+@pytest.mark.asyncio
+async def test_embed_document_client_error_not_retried():
+    settings = get_settings()
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(404, json={"error": "model not found"})
+
+    async with get_client(handler) as client:
+        with pytest.raises(EmbeddingError):
+            await embed_document(settings, client, "deposit")
+        guard = get_drallam_guard(settings, client)
+
+    assert len(requests) == 1
+    assert guard.breaker.state == CircuitState.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_embed_document_missing_embedding_raises():
+    settings = get_settings()
+
+    async with get_client(lambda request: httpx.Response(200, json={})) as client:
+        with pytest.raises(EmbeddingError):
+            await embed_document(settings, client, "deposit")
+
+
+@pytest.mark.asyncio
+async def test_embed_document_deadline():
+    settings = get_settings(drallam_embeddings_deadline=0.05)
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(1)
+        return httpx.Response(200, json={"embedding": [0.1]})
+
+    async with get_client(handler) as client:
+        with pytest.raises(EmbeddingError):
+            await embed_document(settings, client, "deposit")
+        stats = get_drallam_guard(settings, client).stats()
+
+    assert stats.latency_ms[Outcome.TIMEOUT].count == 1
+
+
+@pytest.mark.asyncio
+async def test_embed_document_open_circuit_sends_no_request():
+    settings = get_settings(
+        drallam_embeddings_retries=0, drallam_circuit_failure_threshold=1
+    )
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(500)
+
+    async with get_client(handler) as client:
+        for _ in range(2):
+            with pytest.raises(EmbeddingError):
+                await embed_document(settings, client, "deposit")
+        stats = get_drallam_guard(settings, client).stats()
+
+    assert len(requests) == 1
+    assert stats.circuit_state == CircuitState.OPEN
+    assert stats.latency_ms[Outcome.REJECTED].count == 1
+
+
+@pytest.mark.asyncio
+async def test_embed_document_hedges_slow_requests():
+    settings = get_settings(drallam_embeddings_hedge=True)
+    calls = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(5)
+        return httpx.Response(200, json={"embedding": [float(calls)]})
+
+    async with get_client(handler) as client:
+        guard = get_drallam_guard(settings, client)
+        guard.recent_ms.extend([1.0] * 20)
+        embedding = await asyncio.wait_for(
+            embed_document(settings, client, "deposit"), timeout=1
+        )
+
+    assert embedding == [2.0]
+    assert guard.hedged_count == 1
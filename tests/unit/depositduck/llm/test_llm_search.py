@@ -0,0 +1,343 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from depositduck.llm.search import (
+    batch_hybrid_search,
+    choose_filter_strategy,
+    distance_to,
+    fuse_results,
+    hybrid_search,
+    quantised_distance_to,
+    set_search_params,
+    vector_candidates,
+)
+from depositduck.models.dto.llm import RelevantSnippet, SnippetFilters
+from depositduck.models.llm import (
+    MXBAI_EMBED_LARGE,
+    FilterStrategy,
+    VectorDistance,
+    VectorQuantisation,
+)
+from depositduck.models.sql import tables
+from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
+
+
+def compile_pg(statement) -> str:
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+@pytest.mark.parametrize(
+    "distance, operator",
+    [
+        (VectorDistance.L2, "<->"),
+        (VectorDistance.COSINE, "<=>"),
+        (VectorDistance.INNER_PRODUCT, "<#>"),
+    ],
+)
+def test_distance_to_uses_operator_for_setting(distance, operator):
+    settings_data = get_valid_settings().model_dump()
+    settings_data["vector_distance"] = distance
+    settings = Settings(**settings_data)
+    column = tables.EmbeddingNomic.vector
+
+    statement = select(tables.EmbeddingNomic.id).order_by(
+        distance_to(settings, column, [0.0] * 768)  # type: ignore[arg-type]
+    )
+
+    assert f"llm__embedding_nomic.vector {operator}" in compile_pg(statement)
+
+
+def get_search_settings(**overrides) -> Settings:
+    return Settings(**{**get_valid_settings().model_dump(), **overrides})
+
+
+@pytest.mark.parametrize(
+    "quantisation, expression",
+    [
+        (
+            VectorQuantisation.HALFVEC,
+            "CAST(llm__embedding_nomic.vector AS HALFVEC(768)) <=>",
+        ),
+        (
+            VectorQuantisation.BINARY,
+            "CAST(binary_quantize(llm__embedding_nomic.vector) AS BIT(768)) <~>",
+        ),
+        (VectorQuantisation.MATRYOSHKA, "llm__embedding_nomic.vector_coarse <=>"),
+    ],
+)
+def test_quantised_distance_to_matches_index_expression(quantisation, expression):
+    settings = get_search_settings(vector_quantisation=quantisation)
+
+    statement = select(tables.EmbeddingNomic.id).order_by(
+        quantised_distance_to(settings, [1.0] * 768)
+    )
+
+    assert expression in compile_pg(statement)
+
+
+def test_quantised_distance_to_needs_quantisation():
+    with pytest.raises(ValueError):
+        quantised_distance_to(get_search_settings(), [0.0] * 768)
+
+
+@pytest.mark.parametrize(
+    "quantisation, reranks",
+    [
+        (VectorQuantisation.NONE, False),
+        (VectorQuantisation.HALFVEC, True),
+        (VectorQuantisation.BINARY, True),
+    ],
+)
+def test_vector_candidates_rerank_quantised_shortlist(quantisation, reranks):
+    settings = get_search_settings(vector_quantisation=quantisation)
+
+    statement = compile_pg(vector_candidates(settings, [0.0] * 768))
+
+    assert ("AS shortlist ORDER BY shortlist.vector <=>" in statement) is reranks
+
+
+def test_vector_candidates_rerank_candidates_per_query():
+    settings = get_search_settings(vector_quantisation=VectorQuantisation.MATRYOSHKA)
+
+    statement = vector_candidates(settings, [1.0] * 768, rerank_candidates=400)
+
+    compiled = statement.compile(dialect=postgresql.dialect())
+    assert 400 in compiled.params.values()
+    assert settings.vector_rerank_candidates not in compiled.params.values()
+
+
+def test_vector_candidates_for_another_model():
+    # quantisation only applies to nomic-embed-text
+    settings = get_search_settings(vector_quantisation=VectorQuantisation.BINARY)
+
+    statement = compile_pg(
+        vector_candidates(settings, [1.0] * 1024, model=MXBAI_EMBED_LARGE)
+    )
+
+    assert "FROM llm__embedding" in statement
+    assert "embeddings.vector <=>" in statement
+    assert "llm__embedding_nomic" not in statement
+    assert "shortlist" not in statement
+
+
+def test_settings_rerank_at_least_search_candidates():
+    with pytest.raises(ValueError):
+        get_search_settings(search_candidates=100, vector_rerank_candidates=50)
+
+
+@pytest.mark.parametrize(
+    "vector_weight, text_weight, query_vector, uses_vector, uses_text",
+    [
+        (1.0, 1.0, [0.0] * 768, True, True),
+        (1.0, 0.0, [0.0] * 768, True, False),
+        (0.0, 1.0, [0.0] * 768, False, True),
+        (1.0, 1.0, None, False, True),
+    ],
+)
+def test_hybrid_search_fuses_enabled_retrievers(
+    vector_weight, text_weight, query_vector, uses_vector, uses_text
+):
+    settings = get_search_settings(
+        search_vector_weight=vector_weight, search_text_weight=text_weight
+    )
+
+    statement = compile_pg(hybrid_search(settings, "TDS s.213", query_vector, 5))
+
+    assert ("llm__embedding_nomic.vector <=>" in statement) is uses_vector
+    assert ("llm__snippet.content_tsv @@ websearch_to_tsquery" in statement) is uses_text
+    assert ("UNION ALL" in statement) is (uses_vector and uses_text)
+    assert "ORDER BY score DESC" in statement
+
+
+def test_hybrid_search_needs_a_retriever():
+    settings = get_search_settings(search_text_weight=0.0)
+
+    with pytest.raises(ValueError):
+        hybrid_search(settings, "TDS", None, 5)
+
+
+def test_settings_require_a_search_retriever():
+    with pytest.raises(ValueError):
+        get_search_settings(search_vector_weight=0.0, search_text_weight=0.0)
+
+
+def test_hybrid_search_projects_scores_without_vectors():
+    settings = get_search_settings()
+
+    statement = hybrid_search(settings, "TDS", [0.0] * 768, 5)
+
+    assert list(statement.selected_columns.keys()) == [
+        "snippet_id",
+        "source_text_id",
+        "content",
+        "score",
+        "distance",
+    ]
+    # vectors are only compared to the query, never selected
+    sql = compile_pg(statement)
+    assert "llm__embedding_nomic.vector," not in sql
+    assert "llm__embedding_nomic.vector AS" not in sql
+    assert "CAST(NULL AS FLOAT) AS distance" in sql
+
+
+def test_relevant_snippet_from_search_row():
+    row = {
+        "snippet_id": uuid4(),
+        "source_text_id": uuid4(),
+        "content": "Deposits must be protected within 30 days.",
+        "score": 1 / 61,
+        "distance": None,
+    }
+
+    snippet = RelevantSnippet.model_validate(row)
+
+    assert snippet.snippet_id == row["snippet_id"]
+    assert snippet.distance is None
+
+
+def test_batch_hybrid_search_is_one_statement_per_query():
+    settings = get_search_settings()
+    queries = ["deposit protection", "TDS", "s.213"]
+
+    statement = batch_hybrid_search(settings, queries, [[0.0] * 768] * 3, 5)
+
+    assert list(statement.selected_columns.keys())[0] == "query_index"
+    sql = compile_pg(statement)
+    for index in range(len(queries)):
+        assert f"AS query_{index}" in sql
+    assert sql.endswith("ORDER BY query_index, score DESC, snippet_id")
+
+
+def test_vector_candidates_iterative_scan_filters_nearest():
+    settings = get_search_settings()
+    filters = SnippetFilters(tags=["tds"], current_only=True)
+
+    statement = compile_pg(
+        vector_candidates(settings, [0.0] * 768, filters=filters, filter_strategy=None)
+    )
+
+    # the filter is applied to the approximate index scan itself
+    assert "WHERE llm__embedding_nomic.snippet_id IN (SELECT llm__snippet.id" in statement
+    assert "llm__source_text.tags &&" in statement
+    assert "llm__source_text.deleted_at IS NULL" in statement
+    assert "ORDER BY llm__embedding_nomic.vector <=>" in statement
+    assert "MATERIALIZED" not in statement
+
+
+def test_vector_candidates_prefilter_compares_exactly():
+    settings = get_search_settings(vector_quantisation=VectorQuantisation.BINARY)
+    filters = SnippetFilters(source_text_ids=[uuid4()])
+
+    statement = compile_pg(
+        vector_candidates(
+            settings,
+            [0.0] * 768,
+            filters=filters,
+            filter_strategy=FilterStrategy.PREFILTER,
+        )
+    )
+
+    assert "WITH prefiltered AS MATERIALIZED" in statement
+    assert "ORDER BY prefiltered.vector <=>" in statement
+    assert "shortlist" not in statement
+
+
+def test_hybrid_search_filters_both_retrievers():
+    settings = get_search_settings()
+    filters = SnippetFilters(created_after="2024-07-01T00:00:00Z")
+
+    statement = compile_pg(
+        hybrid_search(settings, "TDS", [0.0] * 768, 5, None, None, filters)
+    )
+
+    assert statement.count("llm__source_text.created_at >=") == 2
+
+
+def test_hybrid_search_unset_filters_search_everything():
+    settings = get_search_settings()
+
+    statement = compile_pg(
+        hybrid_search(settings, "TDS", [0.0] * 768, 5, None, None, SnippetFilters())
+    )
+
+    assert "llm__source_text" not in statement
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "matching, strategy",
+    [(10, FilterStrategy.PREFILTER), (11, FilterStrategy.ITERATIVE_SCAN)],
+)
+async def test_choose_filter_strategy_by_matching_snippets(matching, strategy):
+    settings = get_search_settings(search_prefilter_max_snippets=10)
+    session = MagicMock()
+
+    async def count_matching(statement):
+        return SimpleNamespace(scalar_one=lambda: matching)
+
+    session.execute = count_matching
+
+    chosen = await choose_filter_strategy(session, settings, SnippetFilters(tags=["tds"]))
+
+    assert chosen == strategy
+
+
+@pytest.mark.asyncio
+async def test_choose_filter_strategy_without_filters():
+    session = MagicMock()
+    session.execute = AsyncMock()
+
+    assert await choose_filter_strategy(session, get_search_settings(), None) is None
+    session.execute.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_set_search_params_enables_iterative_scan():
+    session = MagicMock()
+    session.execute = AsyncMock()
+
+    await set_search_params(session, get_search_settings(), FilterStrategy.ITERATIVE_SCAN)
+
+    params = [
+        list(call.args[0].compile(dialect=postgresql.dialect()).params.values())
+        for call in session.execute.call_args_list
+    ]
+    assert ["hnsw.ef_search", "40", True] in params
+    assert ["hnsw.iterative_scan", "relaxed_order", True] in params
+
+
+def get_relevant_snippet(snippet_id, distance=None) -> RelevantSnippet:
+    return RelevantSnippet(
+        snippet_id=snippet_id,
+        source_text_id=uuid4(),
+        content="",
+        score=1.0,
+        distance=distance,
+    )
+
+
+def test_fuse_results_favours_snippets_found_by_several_queries():
+    settings = get_search_settings(search_rrf_k=60)
+    a, b, c = uuid4(), uuid4(), uuid4()
+    results = [
+        [get_relevant_snippet(a, 0.3), get_relevant_snippet(b, 0.1)],
+        [get_relevant_snippet(b), get_relevant_snippet(c, 0.2)],
+    ]
+
+    fused = fuse_results(settings, results, 2)
+
+    assert [snippet.snippet_id for snippet in fused] == [b, a]
+    assert fused[0].score == pytest.approx(1 / 62 + 1 / 61)
+    assert fused[0].distance == 0.1
+    # inputs are not modified
+    assert results[0][1].score == 1.0
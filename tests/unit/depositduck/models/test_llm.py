@@ -0,0 +1,23 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+import uuid
+
+from depositduck.models.llm import SnippetBase, hash_content
+
+
+class TestSnippetBase:
+    def test_content_hash_set_from_content(self):
+        snippet = SnippetBase(
+            content="Deposits must be protected.", source_text_id=uuid.uuid4()
+        )
+
+        assert snippet.content_hash == hash_content("Deposits must be protected.")
+
+    def test_identical_content_shares_hash(self):
+        snippet = SnippetBase(content="£500 deposit", source_text_id=uuid.uuid4())
+        other = SnippetBase(content="£500 deposit", source_text_id=uuid.uuid4())
+
+        assert snippet.content_hash == other.content_hash
+        assert snippet.content_hash != hash_content("£501 deposit")
@@ -0,0 +1,47 @@
+"""
+(c) 2024 Alberto Morón Hernández
+"""
+
+import importlib.util
+from pathlib import Path
+from types import ModuleType
+from unittest.mock import MagicMock
+
+import depositduck.models
+
+VERSIONS = Path(depositduck.models.__file__).parent / "migrations" / "versions"
+
+
+def load_migration(revision: str) -> ModuleType:
+    (path,) = VERSIONS.glob(f"*_{revision}_*.py")
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)  # type: ignore[arg-type]
+    spec.loader.exec_module(module)  # type: ignore[union-attr]
+    return module
+
+
+def executed_sql(op: MagicMock) -> list[str]:
+    return [" ".join(call.args[0].split()) for call in op.execute.call_args_list]
+
+
+def test_snippet_filters_bump_corpus_generation_on_source_text_writes(monkeypatch):
+    migration = load_migration("b3e8f61a2c57")
+    op = MagicMock()
+    monkeypatch.setattr(migration, "op", op)
+
+    migration.upgrade()
+
+    # retagging or soft-deleting a SourceText changes the results of filtered searches
+    assert (
+        "CREATE CONSTRAINT TRIGGER llm__source_text_bump_corpus_generation "
+        "AFTER INSERT OR UPDATE OR DELETE ON llm__source_text "
+        "DEFERRABLE INITIALLY DEFERRED FOR EACH ROW "
+        "EXECUTE FUNCTION llm__bump_corpus_generation()"
+    ) in executed_sql(op)
+
+    op.reset_mock()
+    migration.downgrade()
+
+    assert (
+        "DROP TRIGGER llm__source_text_bump_corpus_generation ON llm__source_text"
+    ) in executed_sql(op)
@@ -7,6 +7,7 @@ from datetime import date, timedelta
 import httpx
 import pytest
 from fastapi import HTTPException, Request
+from starlette.datastructures import State
 from starlette.templating import _TemplateResponse
 
 from depositduck.auth import TDS_DISPUTE_WINDOW_IN_DAYS
@@ -21,6 +22,7 @@ from depositduck.dependables import (
 from depositduck.models.sql.auth import User
 from depositduck.models.sql.deposit import Tenancy
 from depositduck.settings import Settings
+from tests.unit.conftest import get_valid_settings
 
 
 def test_get_settings():
@@ -160,12 +162,29 @@ async def test_get_templates_debug_extension_follows_debug_setting(mock_settings
 
 
 @pytest.mark.asyncio
-async def test_get_drallam_client(mock_settings):
-    drallam_origin = "https://example.com"
-    mock_settings.drallam_origin = drallam_origin
+async def test_get_drallam_client_without_lifespan_creates_client(mock_request):
+    settings_data = get_valid_settings().model_dump()
+    settings_data["drallam_origin"] = "https://example.com"
+    settings = Settings(**settings_data)
+    mock_request.state = State()
 
-    dependency = get_drallam_client(settings=mock_settings)
+    dependency = get_drallam_client(request=mock_request, settings=settings)
     client = await dependency.__anext__()
 
     assert isinstance(client, httpx.AsyncClient)
-    assert client.base_url == drallam_origin
+    assert client.base_url == "https://example.com"
+    await dependency.aclose()
+    assert client.is_closed
+
+
+@pytest.mark.asyncio
+async def test_get_drallam_client_yields_shared_client(mock_request, mock_settings):
+    shared_client = httpx.AsyncClient()
+    mock_request.state = State({"drallam_client": shared_client})
+
+    dependency = get_drallam_client(request=mock_request, settings=mock_settings)
+    client = await dependency.__anext__()
+    await dependency.aclose()
+
+    assert client is shared_client
+    assert not client.is_closed
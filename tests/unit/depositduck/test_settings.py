@@ -67,3 +67,27 @@ def test_trailing_slash_removed():
 
     assert settings.app_origin == app_origin[:-1]
     assert settings.static_origin == static_origin[:-1]
+
+
+def test_unregistered_embeddings_model():
+    settings_data = get_valid_settings().model_dump()
+    settings_data["drallam_embeddings_model"] = "unknown-embed:v1"
+
+    with pytest.raises(ValueError):
+        Settings(**settings_data)
+
+
+def test_standin_error_rate_above_one():
+    settings_data = get_valid_settings().model_dump()
+    settings_data["drallam_standin_error_rate"] = 1.5
+
+    with pytest.raises(ValueError):
+        Settings(**settings_data)
+
+
+def test_near_duplicate_distance_too_wide_for_simhash_bands():
+    settings_data = get_valid_settings().model_dump()
+    settings_data["ingestion_near_duplicate_distance"] = 4
+
+    with pytest.raises(ValueError):
+        Settings(**settings_data)